@@ -1 +1,38 @@
-from .cita import *  # noqa
+# Submodules are imported on first attribute access (PEP 562), so `import bcncita` stays cheap
+# and does not load selenium until something needs it.
+import importlib
+
+EXPORTS = {
+    "cita": [
+        "try_cita",
+        "start_with",
+        "init_wedriver",
+        "CustomerProfile",
+        "DocType",
+        "OperationType",
+        "Office",
+        "Province",
+    ],
+    "daemon": ["Daemon", "run_daemon"],
+    "metrics": ["registry", "start_metrics_server"],
+    "orchestrator": ["Orchestrator", "orchestrate"],
+    "poller": ["HttpPoller", "poll_cita"],
+    "pool": ["DriverPool"],
+}
+
+_modules = {name: module for module, names in EXPORTS.items() for name in names}
+
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    module = _modules.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
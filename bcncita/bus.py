@@ -0,0 +1,72 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+__all__ = ["Sighting", "SightingBus", "sighting_bus"]
+
+Key = Tuple[str, str]  # (province value, operation code value)
+
+
+@dataclass
+class Sighting:
+    province: str
+    operation: str
+    office: Optional[str] = None
+    time: float = field(default_factory=time.time)
+
+    @property
+    def key(self) -> Key:
+        return (self.province, self.operation)
+
+
+class SightingBus:
+    """In-process pub/sub of slot sightings per province and operation.
+
+    Workers pacing themselves sleep on the bus instead of time.sleep, so a sighting by any other
+    worker of the process wakes them within milliseconds to attempt right away."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.latest: Dict[Key, Sighting] = {}
+        self.counts: Dict[Key, int] = {}
+        self.subscribers: List[Callable[[Sighting], None]] = []
+
+    def publish(self, sighting: Sighting):
+        with self.cond:
+            self.latest[sighting.key] = sighting
+            self.counts[sighting.key] = self.counts.get(sighting.key, 0) + 1
+            subscribers = list(self.subscribers)
+            self.cond.notify_all()
+        for callback in subscribers:
+            callback(sighting)
+
+    def subscribe(self, callback: Callable[[Sighting], None]):
+        with self.cond:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[Sighting], None]):
+        with self.cond:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def recent(self, key: Key, window: float) -> Optional[Sighting]:
+        """Last sighting for the key if it is less than ``window`` seconds old"""
+        with self.cond:
+            sighting = self.latest.get(key)
+        return sighting if sighting and time.time() - sighting.time < window else None
+
+    def sleep(self, key: Key, seconds: float) -> bool:
+        """Sleeps like time.sleep, True if cut short by a sighting for the key"""
+        deadline = time.monotonic() + seconds
+        with self.cond:
+            seen = self.counts.get(key, 0)
+            while self.counts.get(key, 0) == seen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+
+sighting_bus = SightingBus()
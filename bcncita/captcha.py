@@ -0,0 +1,290 @@
+import logging
+import threading
+import time
+from base64 import b64encode
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+__all__ = [
+    "AntiCaptchaImageBackend",
+    "HedgedImageSolver",
+    "ImageCaptchaAnswer",
+    "ImageCaptchaBackend",
+    "RecaptchaTokenPool",
+]
+
+TOKEN_TTL = 110  # reCAPTCHA tokens live 120 s, keep a margin for the form submit
+RETRY_AFTER = 30  # pause refills of a key after the solver failed on it
+IMAGE_TIMEOUT = 60  # max seconds to wait for an image captcha answer
+
+
+def new_recaptcha_solver(api_key: str, website_url: str, site_key: str, action: str):
+    from anticaptchaofficial.recaptchav3proxyless import recaptchaV3Proxyless
+
+    solver = recaptchaV3Proxyless()
+    solver.set_verbose(1)
+    solver.set_key(api_key)
+    solver.set_website_url(website_url)
+    solver.set_website_key(site_key)
+    solver.set_page_action(action)
+    solver.set_min_score(0.9)
+    return solver
+
+
+class RecaptchaTokenPool:
+    """Keeps a few fresh reCAPTCHA v3 tokens per (site key, action) solved in the background"""
+
+    def __init__(self, api_key: str, website_url: str, size: int = 2, ttl: float = TOKEN_TTL):
+        self.api_key = api_key
+        self.website_url = website_url
+        self.size = size
+        self.ttl = ttl
+        self.keys: List[Tuple[str, str]] = []
+        self.tokens: Dict[Tuple[str, str], Deque[Tuple[float, str, Any]]] = defaultdict(deque)
+        self.pending: Counter = Counter()
+        self.paused_until: Dict[Tuple[str, str], float] = {}
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="recaptcha-pool", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def register(self, site_key: str, action: str):
+        with self.cond:
+            if (site_key, action) not in self.keys:
+                logging.info(f"Anticaptcha: pre-solving tokens for {site_key} / {action}")
+                self.keys.append((site_key, action))
+
+    def _expire(self, key: Tuple[str, str], now: float):
+        tokens = self.tokens[key]
+        while tokens and tokens[0][0] <= now:
+            tokens.popleft()
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.cond:
+                now = time.monotonic()
+                for key in self.keys:
+                    self._expire(key, now)
+                    if self.paused_until.get(key, 0) > now:
+                        continue
+                    for i in range(self.size - len(self.tokens[key]) - self.pending[key]):
+                        self.pending[key] += 1
+                        threading.Thread(
+                            target=self.solve, args=(key,), name="recaptcha-solve", daemon=True
+                        ).start()
+            self.stopped.wait(1)
+
+    def solve(self, key: Tuple[str, str]):
+        solver = new_recaptcha_solver(self.api_key, self.website_url, *key)
+        try:
+            token = solver.solve_and_return_solution()
+        except Exception as e:
+            solver.err_string = str(e)
+            token = 0
+
+        with self.cond:
+            self.pending[key] -= 1
+            if token != 0:
+                self.tokens[key].append((time.monotonic() + self.ttl, token, solver))
+                self.cond.notify_all()
+            else:
+                logging.error("Anticaptcha: " + solver.err_string)
+                self.paused_until[key] = time.monotonic() + RETRY_AFTER
+
+    def get(self, site_key: str, action: str, timeout: float = 0) -> Optional[Tuple[str, Any]]:
+        """Oldest still valid token and the solver that produced it, None if nothing is ready"""
+        key = (site_key, action)
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._expire(key, now)
+                if self.tokens[key]:
+                    _, token, solver = self.tokens[key].popleft()
+                    return token, solver
+                if now >= deadline:
+                    return None
+                self.cond.wait(deadline - now)
+
+
+_pools: Dict[Tuple[str, str], RecaptchaTokenPool] = {}
+_pools_lock = threading.Lock()
+
+
+def token_pool(api_key: str, website_url: str, size: int) -> RecaptchaTokenPool:
+    """One shared pool per API key and site, so all profiles draw from the same tokens"""
+    with _pools_lock:
+        pool = _pools.get((api_key, website_url))
+        if pool is None:
+            pool = _pools[(api_key, website_url)] = RecaptchaTokenPool(
+                api_key, website_url, size=size
+            ).start()
+        pool.size = max(pool.size, size)
+        return pool
+
+
+@dataclass
+class ImageCaptchaAnswer:
+    text: str
+    backend: "ImageCaptchaBackend"
+    task: Any = None  # backend specific handle, used to report the answer
+    latency: float = 0
+
+
+class ImageCaptchaBackend:
+    """Solves captcha images from memory. Implementations should stop early once cancelled is set"""
+
+    name = "backend"
+
+    def solve(self, image: bytes, cancelled: threading.Event) -> Optional[ImageCaptchaAnswer]:
+        raise NotImplementedError
+
+    def report_incorrect(self, answer: ImageCaptchaAnswer):
+        pass
+
+
+class AntiCaptchaImageBackend(ImageCaptchaBackend):
+    name = "anti-captcha"
+
+    def __init__(self, api_key: str, timeout: int = IMAGE_TIMEOUT):
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def solve(self, image: bytes, cancelled: threading.Event) -> Optional[ImageCaptchaAnswer]:
+        from anticaptchaofficial.imagecaptcha import imagecaptcha
+
+        solver = imagecaptcha()
+        solver.set_key(self.api_key)
+        task = {"type": "ImageToTextTask", "body": b64encode(image).decode("ascii")}
+        if solver.create_task({"clientKey": self.api_key, "task": task}) != 1:
+            logging.error("Anticaptcha: " + solver.err_string)
+            return None
+
+        deadline = time.monotonic() + self.timeout
+        while not cancelled.wait(1) and time.monotonic() < deadline:
+            result = solver.make_request(
+                "getTaskResult", {"clientKey": self.api_key, "taskId": solver.task_id}
+            )
+            if result == 0 or result.get("errorId"):
+                logging.error(f"Anticaptcha: {solver.err_string or result}")
+                return None
+            if result.get("status") == "ready":
+                return ImageCaptchaAnswer(result["solution"]["text"], self, solver)
+
+        return None
+
+    def report_incorrect(self, answer: ImageCaptchaAnswer):
+        answer.task.report_incorrect_image_captcha()
+
+
+@dataclass
+class BackendStats:
+    solved: int = 0
+    failed: int = 0
+    incorrect: int = 0
+    latency: float = 0  # moving average, seconds
+
+    @property
+    def accuracy(self) -> float:
+        return 1 - self.incorrect / self.solved if self.solved else 1
+
+    def score(self) -> float:
+        """Expected seconds per correct answer, lower is better"""
+        if not self.solved:
+            return self.failed * IMAGE_TIMEOUT  # untried backends go first
+        reliability = self.solved / (self.solved + self.failed)
+        return self.latency / max(self.accuracy * reliability, 0.05)
+
+
+class HedgedImageSolver:
+    """Races the best backends (or duplicate submissions) and takes the first answer. Every
+    submission is paid for, so a single one is sent unless ``hedge`` asks for more"""
+
+    def __init__(
+        self, backends: List[ImageCaptchaBackend], hedge: int = 1, timeout: int = IMAGE_TIMEOUT
+    ):
+        self.backends = backends
+        self.hedge = max(1, hedge)
+        self.timeout = timeout
+        self.stats: Dict[str, BackendStats] = {b.name: BackendStats() for b in backends}
+        self.last_answer: Optional[ImageCaptchaAnswer] = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=len(backends) * self.hedge)
+
+    def ranked(self) -> List[ImageCaptchaBackend]:
+        with self.lock:
+            return sorted(self.backends, key=lambda b: self.stats[b.name].score())
+
+    def _solve(self, backend: ImageCaptchaBackend, image: bytes, cancelled: threading.Event):
+        start = time.monotonic()
+        try:
+            answer = backend.solve(image, cancelled)
+        except Exception as e:
+            logging.error(f"Image captcha backend {backend.name}: {e}")
+            answer = None
+
+        if cancelled.is_set():
+            return answer
+
+        with self.lock:
+            stats = self.stats[backend.name]
+            if answer:
+                answer.latency = time.monotonic() - start
+                stats.latency = (
+                    answer.latency
+                    if not stats.solved
+                    else 0.7 * stats.latency + 0.3 * answer.latency
+                )
+                stats.solved += 1
+            else:
+                stats.failed += 1
+        return answer
+
+    def solve(self, image: bytes) -> Optional[ImageCaptchaAnswer]:
+        ranked = self.ranked()
+        chosen = [ranked[i % len(ranked)] for i in range(self.hedge)]
+        cancelled = threading.Event()
+        pending = {self.executor.submit(self._solve, b, image, cancelled) for b in chosen}
+
+        deadline = time.monotonic() + self.timeout
+        try:
+            while pending and time.monotonic() < deadline:
+                done, pending = wait(
+                    pending, timeout=deadline - time.monotonic(), return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    answer = future.result()
+                    if answer:
+                        logging.info(
+                            f"Image captcha solved by {answer.backend.name} in {answer.latency:.1f}s"
+                        )
+                        self.last_answer = answer
+                        return answer
+            return None
+        finally:
+            cancelled.set()
+            for future in pending:
+                future.cancel()
+
+    def report_correct(self):
+        self.last_answer = None
+
+    def report_incorrect(self):
+        answer, self.last_answer = self.last_answer, None
+        if not answer:
+            return
+
+        with self.lock:
+            self.stats[answer.backend.name].incorrect += 1
+        try:
+            answer.backend.report_incorrect(answer)
+        except Exception as e:
+            logging.error(e)
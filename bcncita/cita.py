@@ -3,21 +3,16 @@ import json
 import logging
 import os
 import random
-import re
 import sys
-import tempfile
 import time
 from base64 import b64decode
 from dataclasses import dataclass, field
 from datetime import datetime as dt
 from enum import Enum
 from json.decoder import JSONDecodeError
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Optional, Tuple
 
 import backoff
-import requests
-from anticaptchaofficial.imagecaptcha import imagecaptcha
-from anticaptchaofficial.recaptchav3proxyless import recaptchaV3Proxyless
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
@@ -26,7 +21,20 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.support.wait import WebDriverWait
 
-from .speaker import new_speaker
+from .bus import Sighting, sighting_bus
+from .captcha import AntiCaptchaImageBackend, HedgedImageSolver, new_recaptcha_solver, token_pool
+from .cluster import coordinator, lease_key
+from .metrics import browser_recycles, outcome, start_metrics_server, timed
+from .page import PAGE_RULES, PageState
+from .preferences import SlotMatcher, office_value
+from .ratecontrol import EndpointUnavailable, rate_controller
+from .recorder import SessionRecorder
+from .schedule import AdaptiveScheduler, release_keys, release_model
+from .sms import SMS_CODE_PATTERN, sms_receiver
+from .speaker import DesktopSink, FileSink, Notifier, WebhookSink
+from .state import load_cookies, site_cookies, state_key, state_store
+from .traffic import TrafficMeter, enable_lean
+from .watchdog import MemoryWatchdog
 
 __all__ = [
     "try_cita",
@@ -44,7 +52,76 @@ REFRESH_PAGE_CYCLES = 12
 
 DELAY = 30  # timeout for page load
 
-speaker = new_speaker()
+# Whole slot grid in one round trip: {dates: [...], rows: [[time, [HUECO id or null per date]]]}
+SLOT_GRID_JS = """
+const table = document.getElementById("CitaMAP_HORAS");
+if (!table) { return null; }
+const text = (el) => (el ? el.innerText || el.textContent || "" : "").trim();
+return {
+  dates: [...table.querySelectorAll("thead [class^=colFecha]")].map(text),
+  rows: [...table.querySelectorAll("tbody tr")].map((tr) => [
+    text(tr.querySelector("th")),
+    [...tr.querySelectorAll("td")].map((td) => {
+      const hueco = td.querySelector("[id^=HUECO]");
+      return hueco ? hueco.id : null;
+    }),
+  ]),
+};
+"""
+DATE_SLOTS_JS = """
+return [...document.querySelectorAll("[id^=lCita_]")].map(
+  (el) => (el.innerText || el.textContent || "").trim()
+);
+"""
+
+# Fills a whole form in one round trip and fires the events typing would.
+# Arguments: [[radio id alternatives]], {input id: value}, {select id: option text}.
+# Returns the ids that were not found.
+FILL_FORM_JS = """
+const [radios, fields, selects] = arguments;
+const missing = [];
+const fire = (el, ...types) => types.forEach((type) => el.dispatchEvent(new Event(type, { bubbles: true })));
+for (const ids of radios) {
+  const el = ids.map((id) => document.getElementById(id)).find((found) => found);
+  if (!el) { missing.push(ids[0]); continue; }
+  if (!el.checked) { el.click(); }
+}
+for (const [id, value] of Object.entries(fields)) {
+  const el = document.getElementById(id);
+  if (!el) { missing.push(id); continue; }
+  el.focus();
+  el.value = value;
+  fire(el, "input", "change");
+  el.blur();
+}
+for (const [id, text] of Object.entries(selects)) {
+  const el = document.getElementById(id);
+  const option = el && [...el.options].find((o) => (o.text || "").trim() === text);
+  if (!option) { missing.push(id); continue; }
+  el.value = option.value;
+  fire(el, "change");
+}
+return missing;
+"""
+
+# Names the current page from PAGE_RULES without sending its text over, null until <body> exists
+CLASSIFY_JS = """
+const rules = arguments[0];
+if (!document.body) { return null; }
+const text = document.body.innerText || document.body.textContent || "";
+for (const [state, kind, marker] of rules) {
+  if (kind === "id" ? document.getElementById(marker) : text.includes(marker)) { return state; }
+}
+return "unknown";
+"""
+
+ICP_URL = "https://icp.administracionelectronica.gob.es"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36"
+
+SIGHTING_WINDOW = 300  # seconds another node's slot sighting overrides the scheduler's pauses
+CLUSTER_RETRY = 30  # seconds between worker lease attempts while other nodes hold them
+
+speaker = Notifier()  # Shared by all profiles, speaks and notifies in the background
 
 
 class DocType(str, Enum):
@@ -157,6 +234,40 @@ class Province(str, Enum):
     ZARAGOZA = "50"
 
 
+DOC_TYPE_RADIOS = {
+    DocType.DNI: ("rdbTipoDocDni",),
+    DocType.NIE: ("rdbTipoDocNie",),
+    DocType.PASSPORT: ("rdbTipoDocPas", "rdbTipoDocPasDdi"),
+}
+
+
+@dataclass(frozen=True)
+class FormSpec:
+    """Personal info form of an operation. Document number and name are always there"""
+
+    doc_types: Tuple[DocType, ...] = (DocType.PASSPORT, DocType.NIE)  # radios offered
+    year_of_birth: bool = False
+    country: bool = False
+    wait_for: str = "txtIdCitado"
+
+
+FORM_SPECS = {
+    OperationType.AUTORIZACION_DE_REGRESO: FormSpec(),
+    OperationType.BREXIT: FormSpec(),
+    OperationType.CARTA_INVITACION: FormSpec(doc_types=(DocType.PASSPORT, DocType.DNI)),
+    OperationType.CERTIFICADOS_NIE: FormSpec(doc_types=tuple(DocType)),
+    OperationType.CERTIFICADOS_NIE_NO_COMUN: FormSpec(doc_types=tuple(DocType)),
+    OperationType.CERTIFICADOS_RESIDENCIA: FormSpec(doc_types=tuple(DocType)),
+    OperationType.CERTIFICADOS_UE: FormSpec(doc_types=tuple(DocType)),
+    OperationType.RECOGIDA_DE_TARJETA: FormSpec(),
+    OperationType.SOLICITUD_ASILO: FormSpec(year_of_birth=True, country=True),
+    OperationType.TOMA_HUELLAS: FormSpec(country=True, wait_for="txtPaisNac"),
+    OperationType.ASIGNACION_NIE: FormSpec(
+        doc_types=(DocType.PASSPORT,), year_of_birth=True, country=True
+    ),
+}
+
+
 @dataclass
 class CustomerProfile:
     name: str
@@ -181,10 +292,48 @@ class CustomerProfile:
     max_date: Optional[str] = None  # "dd/mm/yyyy"
     min_time: Optional[str] = None  # "hh:mm"
     max_time: Optional[str] = None  # "hh:mm"
+    date_windows: Optional[
+        list
+    ] = None  # [["dd/mm/yyyy", "dd/mm/yyyy"], ...], either end may be None
+    time_windows: Optional[list] = None  # [["hh:mm", "hh:mm"], ...]
+    weekdays: Optional[list] = None  # Accepted weekdays, 0 = Monday ... 6 = Sunday
     save_artifacts: bool = False
     sms_webhook_token: Optional[str] = None
+    sms_receiver_port: Optional[int] = None  # Local webhook for SMS forwarders
+    sms_receiver_host: str = "127.0.0.1"  # 0.0.0.0 to take posts from other machines
+    sms_receiver_token: Optional[str] = None  # POST to /<token>/<phone>, or CITA_SMS_TOKEN
     wait_exact_time: Optional[list] = None  # [[minute, second]]
     reason_or_type: str = "solicitud de asilo"
+    exit_on_success: bool = True  # Quit the browser and the process once the cita is booked
+    readiness_waits: bool = False  # Wait for page conditions instead of fixed sleeps
+    step_budget: float = 10  # Max seconds a single readiness wait may take
+    icp_url: str = ICP_URL  # Point to a local simulator for testing
+    recaptcha_prefetch: int = 0  # Keep this many reCAPTCHA tokens solved in advance
+    recaptcha_site_key: Optional[str] = None  # Known in advance? Pre-solving starts right away
+    recaptcha_action: Optional[str] = None
+    image_captcha_backends: Optional[
+        list
+    ] = None  # ImageCaptchaBackend list, Anti-Captcha if empty
+    image_captcha_hedge: int = 1  # Image captcha submissions raced per attempt, each one paid
+    schedule_file: Optional[
+        str
+    ] = None  # Learn slot release times in this JSON file and pace by them
+    record_session: Optional[str] = None  # Append every visited page to this .jsonl.gz archive
+    notify_webhook: Optional[str] = None  # Also POST alerts as JSON to this URL
+    notify_file: Optional[str] = None  # Also append alerts to this file
+    notify_desktop: bool = False  # Also show alerts as desktop notifications
+    office_scan: int = 0  # poll_cita tries this many offices at once, each in its own session
+    metrics_port: Optional[int] = None  # Serve Prometheus metrics on http://127.0.0.1:port/metrics
+    state_file: Optional[str] = None  # Keep cookies and captcha setup here to skip cold starts
+    lean_browser: bool = False  # Block images, fonts and trackers the bot never reads
+    count_traffic: bool = False  # Log requests and bytes per cycle, cita_step_bytes_total metric
+    cluster_db: Optional[str] = None  # SQLite file or http:// coordinator shared between nodes
+    cluster_workers: int = 1  # Nodes polling this profile at the same time
+    cluster_token: Optional[str] = None  # Shared secret of an http:// coordinator
+    max_browser_mb: int = (
+        0  # Recycle the browser between cycles once its processes use more, 0 = never
+    )
+    max_browser_fds: int = 0  # Same for open files and sockets, 0 = never
 
     # Internals
     bot_result: bool = False
@@ -193,10 +342,25 @@ class CustomerProfile:
     recaptcha_solver: Any = None
     image_captcha_solver: Any = None
     current_solver: Any = None
+    recaptcha_pool: Any = None
+    sms_receiver: Any = None
+    slot_matcher: Any = None
+    recorder: Any = None
+    scheduler: Any = None
+    state: Any = None
+    traffic: Any = None
+    coordinator: Any = None
+    watchdog: Any = None
+    wait_for_endpoint: bool = True  # Sleep through endpoint cooldowns, the orchestrator requeues
+    current_office: Optional[str] = None
 
     def __post_init__(self):
         if self.operation_code == OperationType.RECOGIDA_DE_TARJETA:
             assert len(self.offices) == 1, "Indicate the office where you need to pick up the card"
+        self.compile_preferences()
+
+    def compile_preferences(self):
+        self.slot_matcher = SlotMatcher.from_profile(self)
 
 
 def init_wedriver(context: CustomerProfile):
@@ -207,8 +371,6 @@ def init_wedriver(context: CustomerProfile):
     if context.chrome_profile_name:
         options.add_argument(f"profile-directory={context.chrome_profile_name}")
 
-    ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36"
-
     options.add_experimental_option("excludeSwitches", ["enable-automation", "enable-logging"])
     options.add_experimental_option("useAutomationExtension", False)
     options.add_argument("--ignore-certificate-errors")
@@ -226,26 +388,19 @@ def init_wedriver(context: CustomerProfile):
     }
     options.add_experimental_option("prefs", prefs)
     options.add_argument("--kiosk-printing")
+    if context.count_traffic:
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
 
     browser = webdriver.Chrome(context.chrome_driver_path, options=options)
     browser.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-    browser.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": ua})
+    browser.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": USER_AGENT})
+    if context.lean_browser:
+        enable_lean(browser, context.icp_url)
 
     return browser
 
 
-def try_cita(context: CustomerProfile, cycles: int = CYCLES):
-    driver = init_wedriver(context)
-    start_with(driver, context, cycles)
-
-
-def start_with(driver: webdriver, context: CustomerProfile, cycles: int = CYCLES):
-    logging.basicConfig(
-        format="%(asctime)s - %(message)s", level=logging.INFO, **context.log_settings  # type: ignore
-    )
-    if context.sms_webhook_token:
-        delete_message(context.sms_webhook_token)
-
+def operation_params(context: CustomerProfile):
     operation_category = "icpplus"
     operation_param = "tramiteGrupo[1]"
 
@@ -270,31 +425,70 @@ def start_with(driver: webdriver, context: CustomerProfile, cycles: int = CYCLES
     ]:
         operation_param = "tramiteGrupo[0]"
 
-    fast_forward_url = "https://icp.administracionelectronica.gob.es/{}/citar?p={}".format(
-        operation_category, context.province
+    return operation_category, operation_param
+
+
+def endpoint_key(context: CustomerProfile):
+    """Requests are paced per province and operation category, shared by all workers"""
+    return context.province.value, operation_params(context)[0]
+
+
+def throttle(context: CustomerProfile):
+    key = endpoint_key(context)
+    wait = rate_controller.acquire(key)
+    if wait > 0:
+        if rate_controller.retry_after(key):
+            time.sleep(wait)  # open circuit: a sighting does not make the site answer
+        elif sighting_bus.sleep(sighting_key(context), wait):
+            logging.info("[Bus] Slots seen by another worker, refreshing now")
+
+
+def sighting_key(context: CustomerProfile):
+    return (context.province.value, context.operation_code.value)
+
+
+def publish_sighting(context: CustomerProfile):
+    """Wakes the workers of this process waiting on the same province and operation"""
+    sighting_bus.publish(
+        Sighting(context.province.value, context.operation_code.value, context.current_office)
     )
-    fast_forward_url2 = "https://icp.administracionelectronica.gob.es/{}/acInfo?{}={}".format(
-        operation_category, operation_param, context.operation_code
+
+
+def fast_forward_urls(context: CustomerProfile):
+    operation_category, operation_param = operation_params(context)
+    fast_forward_url = "{}/{}/citar?p={}".format(
+        context.icp_url, operation_category, context.province
     )
+    fast_forward_url2 = "{}/{}/acInfo?{}={}".format(
+        context.icp_url, operation_category, operation_param, context.operation_code
+    )
+    return fast_forward_url, fast_forward_url2
+
+
+def try_cita(context: CustomerProfile, cycles: int = CYCLES):
+    driver = init_wedriver(context)
+    start_with(driver, context, cycles)
+
+
+def start_with(driver: webdriver, context: CustomerProfile, cycles: int = CYCLES):
+    logging.basicConfig(
+        format="%(asctime)s - %(message)s", level=logging.INFO, **context.log_settings  # type: ignore
+    )
+    prepare_profile(context)
+    fast_forward_url, fast_forward_url2 = fast_forward_urls(context)
 
     success = False
-    result = False
     for i in range(cycles):
-        try:
-            logging.info(f"\033[33m[Attempt {i + 1}/{cycles}]\033[0m")
-            result = cycle_cita(driver, context, fast_forward_url, fast_forward_url2)
-        except KeyboardInterrupt:
-            raise
-        except TimeoutException:
-            logging.error("Timeout exception")
-        except Exception as e:
-            logging.error(f"SMTH BROKEN: {e}")
-            continue
-
+        if not pace(context):
+            driver.quit()
+            return
+        logging.info(f"\033[33m[Attempt {i + 1}/{cycles}]\033[0m")
+        result = attempt_cita(driver, context, fast_forward_url, fast_forward_url2)
         if result:
             success = True
             logging.info("WIN")
             break
+        driver = recycle_if_bloated(driver, context)
 
     if not success:
         logging.error("FAIL")
@@ -302,194 +496,269 @@ def start_with(driver: webdriver, context: CustomerProfile, cycles: int = CYCLES
         driver.quit()
 
 
-def toma_huellas_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtPaisNac")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
+def prepare_profile(context: CustomerProfile):
+    if context.sms_webhook_token:
+        delete_message(context.sms_webhook_token)
+    if context.sms_receiver_port and not context.sms_receiver:
+        context.sms_receiver = sms_receiver(
+            context.sms_receiver_port, context.sms_receiver_token, context.sms_receiver_host
+        )
+    if context.notify_webhook:
+        speaker.add_sink(WebhookSink(context.notify_webhook))
+    if context.notify_file:
+        speaker.add_sink(FileSink(context.notify_file))
+    if context.notify_desktop and DesktopSink.is_applicable():
+        speaker.add_sink(DesktopSink())
+    if context.schedule_file and not context.scheduler:
+        context.scheduler = AdaptiveScheduler(release_model(context.schedule_file))
+    if context.record_session and not context.recorder:
+        context.recorder = SessionRecorder(context.record_session)
+    if context.metrics_port is not None:
+        start_metrics_server(context.metrics_port)
+    if (context.max_browser_mb or context.max_browser_fds) and not context.watchdog:
+        context.watchdog = MemoryWatchdog(context.max_browser_mb, context.max_browser_fds)
+    if context.cluster_db and not context.coordinator:
+        context.coordinator = coordinator(context.cluster_db, context.cluster_token)
+    if context.count_traffic and not context.traffic:
+        context.traffic = TrafficMeter()
+    if context.state_file and not context.state:
+        context.state = state_store(context.state_file)
+        context.state.restore_captcha(context)
+    start_recaptcha_prefetch(context)
+
+
+def observe_release(context: CustomerProfile, hit: bool):
+    if context.scheduler:
+        context.scheduler.observe(context, hit)
+    if hit:
+        publish_sighting(context)
+    if hit and context.coordinator:
+        try:
+            context.coordinator.sight(release_keys(context)[0], context.current_office)
+        except Exception as e:
+            logging.error(f"[Cluster] {e}")
 
-    # Select country
-    select = Select(driver.find_element(By.ID, "txtPaisNac"))
-    select.select_by_visible_text(context.country)
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
+def schedule_delay(context: CustomerProfile) -> float:
+    """Scheduler pause, skipped while another worker or node has just seen slots for the procedure"""
+    if not context.scheduler or sighting_bus.recent(sighting_key(context), SIGHTING_WINDOW):
+        return 0
+    if context.coordinator:
+        try:
+            seen = context.coordinator.last_sighting(release_keys(context)[0])
+        except Exception as e:
+            logging.error(f"[Cluster] {e}")
+            seen = None
+        if seen and time.time() - seen < SIGHTING_WINDOW:
+            return 0
+    return context.scheduler.delay(context)
 
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
 
-    return True
+def cluster_key(context: CustomerProfile) -> str:
+    return lease_key(state_key(context))
 
 
-def recogida_de_tarjeta_step2(driver: webdriver, context: CustomerProfile):
+def cluster_turn(context: CustomerProfile) -> bool:
+    """True when this node holds one of the profile's worker leases (or runs alone)"""
+    if not context.coordinator:
+        return True
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
-
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
-
-    return True
+        return context.coordinator.claim_worker(cluster_key(context), context.cluster_workers)
+    except Exception as e:
+        logging.error(f"[Cluster] {e}")
+        return False
 
 
-def solicitud_asilo_step2(driver: webdriver, context: CustomerProfile):
+def cluster_booked(context: CustomerProfile) -> bool:
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
+        return bool(context.coordinator) and context.coordinator.is_booked(cluster_key(context))
+    except Exception as e:
+        logging.error(f"[Cluster] {e}")
+        return False
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
 
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name, Keys.TAB, context.year_of_birth)
+def booking_lease(context: CustomerProfile) -> bool:
+    """Only one node goes on to confirm: a double booking would burn both citas"""
+    if not context.coordinator:
+        return True
+    try:
+        return context.coordinator.acquire_booking(cluster_key(context))
+    except Exception as e:
+        logging.error(f"[Cluster] {e}")
+        return False
 
-    # Select country
-    select = Select(driver.find_element(By.ID, "txtPaisNac"))
-    select.select_by_visible_text(context.country)
 
+def booking_done(context: CustomerProfile, booked: Optional[bool] = None):
+    if context.coordinator:
+        try:
+            context.coordinator.finish_booking(
+                cluster_key(context), context.bot_result if booked is None else booked
+            )
+        except Exception as e:
+            logging.error(f"[Cluster] {e}")
+
+
+def pace(context: CustomerProfile) -> bool:
+    """Sleeps through the hours the release model considers dead and until this node's turn.
+    False once another node booked the profile"""
+    delay = schedule_delay(context)
+    if delay > 1:
+        logging.info(f"[Scheduler] Slots unlikely now, next attempt in {delay:.0f}s")
+    if delay > 0 and sighting_bus.sleep(sighting_key(context), delay):
+        logging.info("[Bus] Slots seen by another worker, attempting now")
+
+    while not cluster_turn(context):
+        if cluster_booked(context):
+            logging.info(f"[Cluster] {context.name} was booked by another node")
+            return False
+        time.sleep(CLUSTER_RETRY)
     return True
 
 
-def brexit_step2(driver: webdriver, context: CustomerProfile):
+def quit_driver(driver: webdriver):
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
+        driver.quit()
+    except Exception as e:
+        logging.error(e)
+
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
+def recycle_browser(
+    driver: webdriver,
+    context: CustomerProfile,
+    launch: Callable = init_wedriver,
+    dispose: Callable = quit_driver,
+):
+    """Swaps the browser for a fresh one that carries on with the same site session"""
+    try:
+        cookies = site_cookies(driver, context.icp_url)
+    except Exception as e:
+        logging.error(f"[Watchdog] Session not carried over: {e}")
+        cookies = []
+    dispose(driver)
+    driver = launch(context)
+    try:
+        load_cookies(driver, context.icp_url, cookies)
+        context.first_load = not cookies  # a fresh browser without a session starts cold
+    except Exception as e:
+        logging.error(f"[Watchdog] Session not carried over: {e}")
+        context.first_load = True
+    return driver
 
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
 
-    return True
+def recycle_if_bloated(
+    driver: webdriver,
+    context: CustomerProfile,
+    launch: Callable = init_wedriver,
+    dispose: Callable = quit_driver,
+):
+    """Called between cycles: a browser past the profile's memory or file limits is replaced"""
+    reason = context.watchdog.bloated(driver) if context.watchdog else None
+    if not reason:
+        return driver
+    logging.info(f"[Watchdog] Recycling browser: {reason}")
+    browser_recycles.inc()
+    return recycle_browser(driver, context, launch, dispose)
 
 
-def carta_invitacion_step2(driver: webdriver, context: CustomerProfile):
+def attempt_cita(driver: webdriver, context: CustomerProfile, fast_forward_url, fast_forward_url2):
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
+        return cycle_cita(driver, context, fast_forward_url, fast_forward_url2)
+    except KeyboardInterrupt:
+        raise
+    except EndpointUnavailable as e:
+        logging.error(f"[Rate] {e}")
+        outcome("throttled")
     except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
+        logging.error("Timeout exception")
+        outcome("timeout")
+    except Exception as e:
+        logging.error(f"SMTH BROKEN: {e}")
+        outcome("error")
+    finally:
+        if context.traffic:
+            context.traffic.end_cycle(driver)
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.DNI:
-        driver.find_element(By.ID, "rdbTipoDocDni").send_keys(Keys.SPACE)
+    return None
 
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
 
-    return True
+def personal_info_values(context: CustomerProfile):
+    """What FILL_FORM_JS gets: [radio id alternatives], {input id: value}, {select id: option text}"""
+    spec = FORM_SPECS.get(context.operation_code, FormSpec())
+    radios = [DOC_TYPE_RADIOS[context.doc_type]] if context.doc_type in spec.doc_types else []
+    fields = {"txtIdCitado": context.doc_value, "txtDesCitado": context.name}
+    if spec.year_of_birth and context.year_of_birth:
+        fields["txtAnnoCitado"] = context.year_of_birth
+    selects = {"txtPaisNac": context.country} if spec.country else {}
+    return radios, fields, selects
 
 
-def certificados_step2(driver: webdriver, context: CustomerProfile):
+def personal_info(driver: webdriver, context: CustomerProfile):
+    spec = FORM_SPECS.get(context.operation_code, FormSpec())
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
+        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, spec.wait_for)))
     except TimeoutException:
         logging.error("Timed out waiting for form to load")
         return None
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.DNI:
-        driver.find_element(By.ID, "rdbTipoDocDni").send_keys(Keys.SPACE)
-
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
+    missing = driver.execute_script(FILL_FORM_JS, *personal_info_values(context))
+    if missing:
+        logging.error(f"Personal info form has no {', '.join(missing)}")
+        return None
 
     return True
 
 
-def autorizacion_de_regreso_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
-
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
+def wait_exact_time(driver: webdriver, context: CustomerProfile):
+    if context.wait_exact_time:
+        WebDriverWait(driver, 1200).until(
+            lambda _x: [dt.now().minute, dt.now().second] in context.wait_exact_time
+        )
 
-    return True
 
+def page_loaded(driver: webdriver):
+    return driver.execute_script("return document.readyState") == "complete"
 
-def asignacion_nie_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        option = driver.find_element(By.ID, "rdbTipoDocPas")
-        if option:
-            option.send_keys(Keys.SPACE)
+def captcha_ready(driver: webdriver):
+    return page_loaded(driver) and (
+        not driver.find_elements(By.ID, "reCAPTCHA_site_key")
+        or len(driver.find_elements(By.ID, "g-recaptcha-response")) > 0
+    )
 
-    # Enter doc number, name and year of birth
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name, Keys.TAB, context.year_of_birth)
 
-    # Select country
-    select = Select(driver.find_element(By.ID, "txtPaisNac"))
-    select.select_by_visible_text(context.country)
+def settle(driver: webdriver, context: CustomerProfile, seconds: float, condition=page_loaded):
+    """Sleep for a fixed time or, with readiness_waits, until the page condition holds"""
+    if not context.readiness_waits:
+        time.sleep(seconds)
+        return True
 
-    return True
+    try:
+        WebDriverWait(driver, context.step_budget, poll_frequency=0.1).until(condition)
+        return True
+    except TimeoutException:
+        logging.info(f"Page not ready within {context.step_budget}s budget, going on")
+        return False
 
 
-def wait_exact_time(driver: webdriver, context: CustomerProfile):
-    if context.wait_exact_time:
-        WebDriverWait(driver, 1200).until(
-            lambda _x: [dt.now().minute, dt.now().second] in context.wait_exact_time
-        )
+def snapshot(driver: webdriver, context: CustomerProfile, step: str):
+    if context.traffic:
+        context.traffic.collect(driver, step)
+    if context.recorder:
+        try:
+            context.recorder.record(step, driver.current_url, driver.page_source)
+        except Exception as e:
+            logging.error(e)
 
 
-def body_text(driver: webdriver):
+def page_state(driver: webdriver) -> PageState:
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-        return driver.find_element(By.TAG_NAME, "body").text
+        state = WebDriverWait(driver, DELAY).until(
+            lambda d: d.execute_script(CLASSIFY_JS, PAGE_RULES)
+        )
+        return PageState(state)
     except TimeoutException:
         logging.info("Timed out waiting for body to load")
-        return ""
+        return PageState.UNKNOWN
 
 
 def process_captcha(driver: webdriver, context: CustomerProfile):
@@ -512,73 +781,98 @@ def process_captcha(driver: webdriver, context: CustomerProfile):
         logging.info(
             "HEY, DO SOMETHING HUMANE TO TRICK THE CAPTCHA (select text, move cursor etc.) and press ENTER"
         )
-        for i in range(10):
-            speaker.say("ALARM")
+        speaker.say("ALARM", repeat=10, prompt=True)
         input()
 
     return True
 
 
+def start_recaptcha_prefetch(context: CustomerProfile):
+    if not (context.auto_captcha and context.anticaptcha_api_key and context.recaptcha_prefetch):
+        return
+
+    context.recaptcha_pool = token_pool(
+        context.anticaptcha_api_key, context.icp_url, context.recaptcha_prefetch
+    )
+    if context.recaptcha_site_key and context.recaptcha_action:
+        context.recaptcha_pool.register(context.recaptcha_site_key, context.recaptcha_action)
+
+
 def solve_recaptcha(driver: webdriver, context: CustomerProfile):
+    if not context.recaptcha_site_key or not context.recaptcha_action:
+        context.recaptcha_site_key = driver.find_element(
+            By.ID, "reCAPTCHA_site_key"
+        ).get_attribute("value")
+        context.recaptcha_action = driver.find_element(By.ID, "action").get_attribute("value")
+        logging.info("Anticaptcha: site key: " + context.recaptcha_site_key)
+        logging.info("Anticaptcha: action: " + context.recaptcha_action)
+
+    if context.recaptcha_pool:
+        context.recaptcha_pool.register(context.recaptcha_site_key, context.recaptcha_action)
+        prefetched = context.recaptcha_pool.get(
+            context.recaptcha_site_key, context.recaptcha_action
+        )
+        if prefetched:
+            g_response, context.recaptcha_solver = prefetched
+            context.current_solver = type(context.recaptcha_solver)
+            logging.info("Anticaptcha: using pre-solved g-response")
+            fill_recaptcha_response(driver, g_response)
+            return True
+
     if not context.recaptcha_solver:
-        site_key = driver.find_element(By.ID, "reCAPTCHA_site_key").get_attribute("value")
-        page_action = driver.find_element(By.ID, "action").get_attribute("value")
-        logging.info("Anticaptcha: site key: " + site_key)
-        logging.info("Anticaptcha: action: " + page_action)
-
-        context.recaptcha_solver = recaptchaV3Proxyless()
-        context.recaptcha_solver.set_verbose(1)
-        context.recaptcha_solver.set_key(context.anticaptcha_api_key)
-        context.recaptcha_solver.set_website_url("https://icp.administracionelectronica.gob.es")
-        context.recaptcha_solver.set_website_key(site_key)
-        context.recaptcha_solver.set_page_action(page_action)
-        context.recaptcha_solver.set_min_score(0.9)
+        context.recaptcha_solver = new_recaptcha_solver(
+            context.anticaptcha_api_key,  # type: ignore
+            context.icp_url,
+            context.recaptcha_site_key,  # type: ignore
+            context.recaptcha_action,  # type: ignore
+        )
 
     context.current_solver = type(context.recaptcha_solver)
 
     g_response = context.recaptcha_solver.solve_and_return_solution()
     if g_response != 0:
         logging.info("Anticaptcha: g-response: " + g_response)
-        driver.execute_script(
-            f"document.getElementById('g-recaptcha-response').value = '{g_response}'"
-        )
+        fill_recaptcha_response(driver, g_response)
         return True
     else:
         logging.error("Anticaptcha: " + context.recaptcha_solver.err_string)
         return None
 
 
+def fill_recaptcha_response(driver: webdriver, g_response: str):
+    driver.execute_script(
+        "document.getElementById('g-recaptcha-response').value = arguments[0]", g_response
+    )
+
+
 def solve_image_captcha(driver: webdriver, context: CustomerProfile):
     if not context.image_captcha_solver:
-        context.image_captcha_solver = imagecaptcha()
-        context.image_captcha_solver.set_verbose(1)
-        context.image_captcha_solver.set_key(context.anticaptcha_api_key)
+        backends = context.image_captcha_backends or [
+            AntiCaptchaImageBackend(context.anticaptcha_api_key)  # type: ignore
+        ]
+        context.image_captcha_solver = HedgedImageSolver(
+            backends, hedge=context.image_captcha_hedge
+        )
 
     context.current_solver = type(context.image_captcha_solver)
 
-    try:
-        img = driver.find_elements(By.CSS_SELECTOR, "img.img-thumbnail")[0]
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        tmp.write(b64decode(img.get_attribute("src").split(",")[1].strip()))
-        tmp.close()
-
-        captcha_result = context.image_captcha_solver.solve_and_return_solution(tmp.name)
-        if captcha_result != 0:
-            logging.info("Anticaptcha: captcha text: " + captcha_result)
-            element = driver.find_element(By.ID, "captcha")
-            element.send_keys(captcha_result)
-            return True
-        else:
-            logging.error("Anticaptcha: " + context.image_captcha_solver.err_string)
-            return None
-    finally:
-        os.unlink(tmp.name)
+    img = driver.find_elements(By.CSS_SELECTOR, "img.img-thumbnail")[0]
+    image = b64decode(img.get_attribute("src").split(",")[1].strip())
+
+    answer = context.image_captcha_solver.solve(image)
+    if answer:
+        logging.info("Anticaptcha: captcha text: " + answer.text)
+        element = driver.find_element(By.ID, "captcha")
+        element.send_keys(answer.text)
+        return True
+    else:
+        logging.error("Anticaptcha: image captcha not solved")
+        return None
 
 
 def find_best_date_slots(driver: webdriver, context: CustomerProfile):
     try:
-        els = driver.find_elements(By.CSS_SELECTOR, "[id^=lCita_]")
-        dates = sorted([*map(lambda x: x.text, els)])
+        dates = driver.execute_script(DATE_SLOTS_JS) or []
         best_date = find_best_date(dates, context)
         if best_date:
             return dates.index(best_date) + 1
@@ -588,39 +882,36 @@ def find_best_date_slots(driver: webdriver, context: CustomerProfile):
     return None
 
 
+def read_slot_grid(driver: webdriver) -> Optional[dict]:
+    return driver.execute_script(SLOT_GRID_JS)
+
+
 def find_best_date(dates, context: CustomerProfile):
-    if not context.min_date and not context.max_date:
-        return dates[0]
+    idx = context.slot_matcher.best_label(dates)
+    if idx is not None:
+        return dates[idx]
 
-    pattern = re.compile(r"\d{2}/\d{2}/\d{4}")
-    date_format = "%d/%m/%Y"
+    log_nothing_found(context)
+    return None
 
-    for date in dates:
-        try:
-            found = pattern.findall(date)[0]
-            if found:
-                appt_date = dt.strptime(found, date_format)
-                if context.min_date:
-                    if appt_date < dt.strptime(context.min_date, date_format):
-                        continue
-                if context.max_date:
-                    if appt_date > dt.strptime(context.max_date, date_format):
-                        continue
-
-                return date
-        except Exception as e:
-            logging.error(e)
-            continue
 
+def find_best_slot(grid: dict, context: CustomerProfile):
+    best = context.slot_matcher.best_slot(grid, context.current_office)
+    if not best:
+        log_nothing_found(context)
+    return best
+
+
+def log_nothing_found(context: CustomerProfile):
     logging.info(
-        f"Nothing found for dates {context.min_date} - {context.max_date}, {context.min_time} - {context.max_time}, skipping"
+        f"Nothing found for dates {context.min_date} - {context.max_date}, {context.min_time} - {context.max_time}"
+        f", windows {context.date_windows} {context.time_windows}, weekdays {context.weekdays}, skipping"
     )
-    return None
 
 
 def select_office(driver: webdriver, context: CustomerProfile):
     if not context.auto_office:
-        speaker.say("MAKE A CHOICE")
+        speaker.say("MAKE A CHOICE", prompt=True)
         logging.info("Select office and press ENTER")
         input()
         return True
@@ -635,7 +926,8 @@ def select_office(driver: webdriver, context: CustomerProfile):
         if context.offices:
             for office in context.offices:
                 try:
-                    select.select_by_value(office.value)
+                    select.select_by_value(office_value(office))
+                    context.current_office = office_value(office)
                     return True
                 except Exception as e:
                     logging.error(e)
@@ -647,24 +939,41 @@ def select_office(driver: webdriver, context: CustomerProfile):
             default_count = len(select.options)
             first_element = 0 if len(options) == default_count else 1
             select.select_by_index(random.randint(first_element, default_count - 1))
-            if el.get_attribute("value") not in context.except_offices:  # type: ignore
+            context.current_office = el.get_attribute("value")
+            if context.slot_matcher.accepts_office(context.current_office):
                 return True
             continue
 
         return None
 
 
+def office_candidates(values: list, context: CustomerProfile) -> list:
+    """Offered offices to try, preferred ones in order, then the others not excluded at random"""
+    preferred, others = context.slot_matcher.rank_offices([value for value in values if value])
+    if context.offices and context.operation_code == OperationType.RECOGIDA_DE_TARJETA:
+        return preferred
+    random.shuffle(others)
+    return preferred + others
+
+
+def refresh(driver: webdriver, context: CustomerProfile):
+    throttle(context)
+    start = time.monotonic()
+    driver.refresh()
+    rate_controller.record(endpoint_key(context), True, time.monotonic() - start)
+
+
 def office_selection(driver: webdriver, context: CustomerProfile):
     driver.execute_script("enviar('solicitud');")
 
     for i in range(REFRESH_PAGE_CYCLES):
-        resp_text = body_text(driver)
+        state = page_state(driver)
+        snapshot(driver, context, "office_selection")
 
-        if "Seleccione la oficina donde solicitar la cita" in resp_text:
+        if state is PageState.OFFICES:
             logging.info("[Step 2/6] Office selection")
 
             # Office selection:
-            time.sleep(0.3)
             try:
                 WebDriverWait(driver, DELAY).until(
                     EC.presence_of_element_located((By.ID, "btnSiguiente"))
@@ -675,19 +984,26 @@ def office_selection(driver: webdriver, context: CustomerProfile):
 
             res = select_office(driver, context)
             if res is None:
-                time.sleep(5)
-                driver.refresh()
+                outcome("no_offices")
+                observe_release(context, False)
+                refresh(driver, context)
                 continue
 
+            publish_sighting(context)
             btn = driver.find_element(By.ID, "btnSiguiente")
             btn.send_keys(Keys.ENTER)
             return True
-        elif "En este momento no hay citas disponibles" in resp_text:
-            time.sleep(5)
-            driver.refresh()
+        elif state is PageState.NO_CITAS:
+            outcome("no_citas")
+            observe_release(context, False)
+            refresh(driver, context)
             continue
         else:
+            if state is PageState.REJECTED:
+                rate_controller.record(endpoint_key(context), False)
             logging.info("[Step 2/6] Office selection -> No offices")
+            outcome("no_offices")
+            observe_release(context, False)
             return None
 
 
@@ -697,25 +1013,29 @@ def phone_mail(driver: webdriver, context: CustomerProfile):
             EC.presence_of_element_located((By.ID, "txtTelefonoCitado"))
         )
         logging.info("[Step 3/6] Contact info")
+        snapshot(driver, context, "contact_info")
     except TimeoutException:
         logging.error("Timed out waiting for contact info page to load")
         return None
 
-    element = driver.find_element(By.ID, "txtTelefonoCitado")
-    element.send_keys(context.phone)
+    with timed("contact_info"):
+        element = driver.find_element(By.ID, "txtTelefonoCitado")
+        element.send_keys(context.phone)
 
-    try:
-        element = driver.find_element(By.ID, "emailUNO")
-        element.send_keys(context.email)
+        try:
+            element = driver.find_element(By.ID, "emailUNO")
+            element.send_keys(context.email)
 
-        element = driver.find_element(By.ID, "emailDOS")
-        element.send_keys(context.email)
-    except Exception:
-        pass
+            element = driver.find_element(By.ID, "emailDOS")
+            element.send_keys(context.email)
+        except Exception:
+            pass
 
-    add_reason(driver, context)
+        add_reason(driver, context)
 
-    driver.execute_script("enviar();")
+        if context.sms_receiver:
+            context.sms_receiver.arm(context.phone)
+        driver.execute_script("enviar();")
 
     return cita_selection(driver, context)
 
@@ -727,10 +1047,11 @@ def confirm_appointment(driver: webdriver, context: CustomerProfile):
     btn = driver.find_element(By.ID, "btnConfirmar")
     btn.send_keys(Keys.ENTER)
 
-    resp_text = body_text(driver)
+    state = page_state(driver)
+    snapshot(driver, context, "booking")
     ctime = dt.now()
 
-    if "CITA CONFIRMADA Y GRABADA" in resp_text:
+    if state is PageState.BOOKED:
         context.bot_result = True
         code = driver.find_element(By.ID, "justificanteFinal").text
         logging.info(f"[Step 6/6] Justificante cita: {code}")
@@ -744,7 +1065,7 @@ def confirm_appointment(driver: webdriver, context: CustomerProfile):
             # time.sleep(5)
 
         return True
-    elif "Lo sentimos, el código introducido no es correcto" in resp_text:
+    elif state is PageState.WRONG_CODE:
         logging.error("Incorrect code entered")
     else:
         error_name = f"error-{ctime}.png".replace(":", "-")
@@ -757,43 +1078,76 @@ def log_backoff(details):
     logging.error(f"Unable to load the initial page, backing off {details['wait']:0.1f} seconds")
 
 
+def endpoint_failed(context: CustomerProfile) -> EndpointUnavailable:
+    key = endpoint_key(context)
+    rate_controller.record(key, False)
+    return EndpointUnavailable(key, rate_controller.backoff(key), context.wait_for_endpoint)
+
+
+def session_failed(context: CustomerProfile):
+    """Next load starts from a clean browser, and a saved session is not offered again"""
+    context.first_load = True
+    if context.state:
+        context.state.forget(context)
+
+
 @backoff.on_exception(
-    backoff.constant,
-    TimeoutException,
-    interval=350,
+    backoff.runtime,
+    EndpointUnavailable,
+    value=lambda e: e.retry_after,
+    jitter=None,
+    giveup=lambda e: not e.wait,  # type: ignore[attr-defined]
     max_tries=(10 if os.environ.get("CITA_TEST") else None),
     on_backoff=log_backoff,
     logger=None,
 )
 def initial_page(driver: webdriver, context: CustomerProfile, fast_forward_url, fast_forward_url2):
-    if context.first_load:
+    key = endpoint_key(context)
+    retry_after = rate_controller.retry_after(key)
+    if retry_after:
+        raise EndpointUnavailable(key, retry_after, context.wait_for_endpoint)
+
+    if context.first_load and not (context.state and context.state.restore(driver, context)):
         driver.delete_all_cookies()
 
     driver.set_page_load_timeout(300 if context.first_load else 50)
-    # Fix chromedriver 103 bug
-    time.sleep(1)
-    driver.get(fast_forward_url)
-    time.sleep(5)
-    if context.first_load:
-        try:
-            driver.execute_script("window.localStorage.clear();")
-            driver.execute_script("window.sessionStorage.clear();")
-        except Exception as e:
-            logging.error(e)
-            pass
-    driver.get(fast_forward_url2)
-    time.sleep(5)
-
-    resp_text = body_text(driver)
-    if "INTERNET CITA PREVIA" not in resp_text:
-        context.first_load = True
-        raise TimeoutException
-
+    if not context.readiness_waits:
+        time.sleep(1)  # Fix chromedriver 103 bug
+    throttle(context)
+    start = time.monotonic()
+    try:
+        driver.get(fast_forward_url)
+        settle(driver, context, 5)
+        if context.first_load:
+            try:
+                driver.execute_script("window.localStorage.clear();")
+                driver.execute_script("window.sessionStorage.clear();")
+            except Exception as e:
+                logging.error(e)
+                pass
+        driver.get(fast_forward_url2)
+    except TimeoutException:
+        session_failed(context)
+        raise endpoint_failed(context)
+    latency = time.monotonic() - start
+    settle(driver, context, 5, EC.presence_of_element_located((By.ID, "btnEntrar")))
+
+    state = page_state(driver)
+    snapshot(driver, context, "initial_page")
+    if state is not PageState.INSTRUCTIONS:
+        session_failed(context)
+        raise endpoint_failed(context)
+
+    rate_controller.record(key, True, latency)
     context.first_load = False
+    if context.state:
+        context.state.remember(driver, context)
 
 
 def cycle_cita(driver: webdriver, context: CustomerProfile, fast_forward_url, fast_forward_url2):
-    initial_page(driver, context, fast_forward_url, fast_forward_url2)
+    context.current_office = None
+    with timed("initial_page"):
+        initial_page(driver, context, fast_forward_url, fast_forward_url2)
 
     # 1. Instructions page:
     try:
@@ -810,34 +1164,14 @@ def cycle_cita(driver: webdriver, context: CustomerProfile, fast_forward_url, fa
 
     # 2. Personal info:
     logging.info("[Step 1/6] Personal info")
-    success = False
-    if context.operation_code == OperationType.TOMA_HUELLAS:
-        success = toma_huellas_step2(driver, context)
-    elif context.operation_code == OperationType.RECOGIDA_DE_TARJETA:
-        success = recogida_de_tarjeta_step2(driver, context)
-    elif context.operation_code == OperationType.SOLICITUD_ASILO:
-        success = solicitud_asilo_step2(driver, context)
-    elif context.operation_code == OperationType.BREXIT:
-        success = brexit_step2(driver, context)
-    elif context.operation_code == OperationType.CARTA_INVITACION:
-        success = carta_invitacion_step2(driver, context)
-    elif context.operation_code in [
-        OperationType.CERTIFICADOS_NIE,
-        OperationType.CERTIFICADOS_NIE_NO_COMUN,
-        OperationType.CERTIFICADOS_RESIDENCIA,
-        OperationType.CERTIFICADOS_UE,
-    ]:
-        success = certificados_step2(driver, context)
-    elif context.operation_code == OperationType.AUTORIZACION_DE_REGRESO:
-        success = autorizacion_de_regreso_step2(driver, context)
-    elif context.operation_code == OperationType.ASIGNACION_NIE:
-        success = asignacion_nie_step2(driver, context)
+    with timed("personal_info"):
+        success = personal_info(driver, context)
 
-    if not success:
-        return None
+        if not success:
+            return None
 
-    time.sleep(2)
-    driver.find_element(By.ID, "btnEnviar").send_keys(Keys.ENTER)
+        settle(driver, context, 2, EC.element_to_be_clickable((By.ID, "btnEnviar")))
+        driver.find_element(By.ID, "btnEnviar").send_keys(Keys.ENTER)
 
     try:
         WebDriverWait(driver, 7).until(EC.presence_of_element_located((By.ID, "btnConsultar")))
@@ -851,7 +1185,8 @@ def cycle_cita(driver: webdriver, context: CustomerProfile, fast_forward_url, fa
         return None
 
     # 3. Solicitar cita:
-    selection_result = office_selection(driver, context)
+    with timed("office_selection"):
+        selection_result = office_selection(driver, context)
     if selection_result is None:
         return None
 
@@ -861,19 +1196,24 @@ def cycle_cita(driver: webdriver, context: CustomerProfile, fast_forward_url, fa
 
 # 5. Cita selection
 def cita_selection(driver: webdriver, context: CustomerProfile):
-    resp_text = body_text(driver)
+    state = page_state(driver)
+    snapshot(driver, context, "slot_selection")
 
-    if "DISPONE DE 5 MINUTOS" in resp_text:
+    if state is PageState.SLOT_LIST:
         logging.info("[Step 4/6] Cita attempt -> selection hit!")
+        outcome("selection_hit")
+        observe_release(context, True)
         if context.save_artifacts:
             driver.save_screenshot(f"citas-{dt.now()}.png".replace(":", "-"))
 
-        position = find_best_date_slots(driver, context)
+        with timed("slot_selection"):
+            position = find_best_date_slots(driver, context)
         if not position:
             return None
 
-        time.sleep(2)
-        success = process_captcha(driver, context)
+        with timed("captcha"):
+            settle(driver, context, 2, captcha_ready)
+            success = process_captcha(driver, context)
         if not success:
             return None
 
@@ -886,136 +1226,167 @@ def cita_selection(driver: webdriver, context: CustomerProfile):
             pass
 
         driver.execute_script("envia();")
-        time.sleep(0.5)
+        settle(driver, context, 0.5, EC.alert_is_present())
         driver.switch_to.alert.accept()
-    elif "Seleccione una de las siguientes citas disponibles" in resp_text:
+    elif state is PageState.SLOT_GRID:
         logging.info("[Step 4/6] Cita attempt -> selection hit!")
+        outcome("selection_hit")
+        observe_release(context, True)
         if context.save_artifacts:
             driver.save_screenshot(f"citas-{dt.now()}.png".replace(":", "-"))
 
         try:
-            date_els = driver.find_elements(
-                By.CSS_SELECTOR, "#CitaMAP_HORAS thead [class^=colFecha]"
-            )
-            dates = sorted([*map(lambda x: x.text, date_els)])
-            slots: Dict[str, list] = {}
-            slot_table = driver.find_element(By.CSS_SELECTOR, "#CitaMAP_HORAS tbody")
-            for row in slot_table.find_elements(By.CSS_SELECTOR, "tr"):
-                appt_time = row.find_elements(By.TAG_NAME, "th")[0].text
-                if context.min_time:
-                    if appt_time < context.min_time:
-                        continue
-                if context.max_time:
-                    if appt_time > context.max_time:
-                        break
-
-                for idx, cell in enumerate(row.find_elements(By.TAG_NAME, "td")):
-                    try:
-                        if slots.get(dates[idx]):
-                            continue
-                        slot = cell.find_element(By.CSS_SELECTOR, "[id^=HUECO]").get_attribute(
-                            "id"
-                        )
-                        slots[dates[idx]] = [slot]
-                    except Exception:
-                        pass
-
-            best_date = find_best_date(sorted(slots), context)
-            if not best_date:
+            with timed("slot_selection"):
+                grid = read_slot_grid(driver)
+                best = find_best_slot(grid, context) if grid else None
+            if not grid:
+                logging.error("Slot grid CitaMAP_HORAS not found")
+                return None
+            if not best:
                 return None
-            slot = slots[best_date][0]
+            _, slot = best
 
-            time.sleep(2)
-            success = process_captcha(driver, context)
+            with timed("captcha"):
+                settle(driver, context, 2, captcha_ready)
+                success = process_captcha(driver, context)
             if not success:
                 return None
 
             driver.execute_script(f"confirmarHueco({{id: '{slot}'}}, {slot[5:]});")
+            settle(driver, context, 0, EC.alert_is_present())
             driver.switch_to.alert.accept()
         except Exception as e:
             logging.error(e)
             return None
     else:
         logging.info("[Step 4/6] Cita attempt -> missed selection")
+        outcome("missed_selection")
+        observe_release(context, False)
         return None
 
     # 6. Confirmation
-    resp_text = body_text(driver)
+    state = page_state(driver)
+    snapshot(driver, context, "confirmation")
 
-    if "Debe confirmar los datos de la cita asignada" in resp_text:
+    if state is PageState.CONFIRMATION:
         logging.info("[Step 5/6] Cita attempt -> confirmation hit!")
-        if context.current_solver == recaptchaV3Proxyless:
+        outcome("confirmation_hit")
+        if context.current_solver is type(context.recaptcha_solver):
             context.recaptcha_solver.report_correct_recaptcha()
+        elif context.current_solver == HedgedImageSolver:
+            context.image_captcha_solver.report_correct()
 
+        if not booking_lease(context):
+            logging.info("[Cluster] Another node is confirming a cita for this profile")
+            return None
         try:
-            sms_verification = driver.find_element(By.ID, "txtCodigoVerificacion")
-        except Exception as e:
-            logging.error(e)
-            sms_verification = None
-            pass
-
-        if context.sms_webhook_token:
-            if sms_verification:
-                code = get_code(context)
-                if code:
-                    logging.info(f"Received code: {code}")
-                    sms_verification = driver.find_element(By.ID, "txtCodigoVerificacion")
-                    sms_verification.send_keys(code)
+            return confirm_cita(driver, context)
+        finally:
+            booking_done(context)
 
-            confirm_appointment(driver, context)
+    else:
+        logging.info("[Step 5/6] Cita attempt -> missed confirmation")
+        outcome("missed_confirmation")
+        if context.current_solver is type(context.recaptcha_solver):
+            context.recaptcha_solver.report_incorrect_recaptcha()
+        elif context.current_solver == HedgedImageSolver:
+            context.image_captcha_solver.report_incorrect()
 
-            if context.save_artifacts:
-                driver.save_screenshot(f"FINAL-SCREEN-{dt.now()}.png".replace(":", "-"))
+        if context.save_artifacts:
+            driver.save_screenshot(f"failed-confirmation-{dt.now()}.png".replace(":", "-"))
+        return None
 
-            if context.bot_result:
-                driver.quit()
-                os._exit(0)
-            return None
-        else:
-            if not sms_verification:
-                confirm_appointment(driver, context)
 
-            speaker.say("ENTER THE SHORT CODE FROM SMS")
+def confirm_cita(driver: webdriver, context: CustomerProfile):
+    try:
+        sms_verification = driver.find_element(By.ID, "txtCodigoVerificacion")
+    except Exception as e:
+        logging.error(e)
+        sms_verification = None
+        pass
 
-            logging.info("Press Any button to CLOSE browser")
-            input()
-            driver.quit()
-            os._exit(0)
+    if context.sms_webhook_token or context.sms_receiver:
+        if sms_verification:
+            code = get_code(context)
+            if code:
+                logging.info(f"Received code: {code}")
+                sms_verification = driver.find_element(By.ID, "txtCodigoVerificacion")
+                sms_verification.send_keys(code)
 
-    else:
-        logging.info("[Step 5/6] Cita attempt -> missed confirmation")
-        if context.current_solver == recaptchaV3Proxyless:
-            context.recaptcha_solver.report_incorrect_recaptcha()
-        elif context.current_solver == imagecaptcha:
-            context.image_captcha_solver.report_incorrect_image_captcha()
+        with timed("confirmation"):
+            confirm_appointment(driver, context)
 
         if context.save_artifacts:
-            driver.save_screenshot(f"failed-confirmation-{dt.now()}.png".replace(":", "-"))
+            driver.save_screenshot(f"FINAL-SCREEN-{dt.now()}.png".replace(":", "-"))
+
+        if context.bot_result:
+            return booked(driver, context)
         return None
+    else:
+        if not sms_verification:
+            confirm_appointment(driver, context)
+
+        speaker.say("ENTER THE SHORT CODE FROM SMS", prompt=True)
+
+        logging.info("Press Any button to CLOSE browser")
+        input()
+        return booked(driver, context)
+
+
+def booked(driver: webdriver, context: CustomerProfile):
+    outcome("booked")
+    booking_done(context, True)
+    speaker.say(f"CITA BOOKED FOR {context.name}")
+    if context.exit_on_success:
+        driver.quit()
+        speaker.flush()
+        os._exit(0)
+    return True
+
+
+webhook_session = None
+
+
+def webhook():
+    global webhook_session
+    if webhook_session is None:
+        import requests
+
+        webhook_session = requests.Session()
+    return webhook_session
 
 
 def get_messages(sms_webhook_token):
     try:
         url = f"https://webhook.site/token/{sms_webhook_token}/requests?page=1&sorting=newest"
-        return requests.get(url).json()["data"]
+        return webhook().get(url).json()["data"]
     except JSONDecodeError:
         raise Exception("sms_webhook_token is incorrect")
 
 
 def delete_message(sms_webhook_token, message_id=""):
     url = f"https://webhook.site/token/{sms_webhook_token}/request/{message_id}"
-    requests.delete(url)
+    webhook().delete(url)
 
 
 def get_code(context: CustomerProfile):
     for i in range(60):
+        if context.sms_receiver:
+            # Pushed codes wake us up at once, webhook.site is polled in between
+            code = context.sms_receiver.wait(context.phone, timeout=5)
+            if code:
+                return code
+            if not context.sms_webhook_token:
+                continue
+
         messages = get_messages(context.sms_webhook_token)
         if not messages:
-            time.sleep(5)
+            if not context.sms_receiver:
+                time.sleep(5)
             continue
 
         content = messages[0].get("text_content")
-        match = re.search("CODIGO (.*), DE", content)
+        match = SMS_CODE_PATTERN.search(content)
         if match:
             delete_message(context.sms_webhook_token, messages[0].get("uuid"))
             return match.group(1)
@@ -0,0 +1,304 @@
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+from urllib.request import Request, urlopen
+
+__all__ = ["Coordinator", "RemoteCoordinator", "coordinator", "lease_key", "serve"]
+
+# Seconds a worker lease lasts without an attempt renewing it: longer than one attempt, whose
+# first page load alone may take 300s, so a slow attempt never loses its lease midway
+WORKER_TTL = 900
+BOOKING_TTL = 600  # seconds a node may spend confirming, SMS code included
+SIGHTING_TTL = 24 * 3600  # sightings older than this are dropped
+TOKEN_ENV = "CITA_CLUSTER_TOKEN"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+    profile TEXT, slot INTEGER, node TEXT, expires REAL, PRIMARY KEY (profile, slot)
+);
+CREATE TABLE IF NOT EXISTS bookings (
+    profile TEXT PRIMARY KEY, node TEXT, expires REAL, booked INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sightings (time REAL, key TEXT, office TEXT, node TEXT);
+CREATE INDEX IF NOT EXISTS sightings_key ON sightings (key, time);
+"""
+
+# Coordinator methods a RemoteCoordinator may call
+REMOTE_METHODS = (
+    "claim_worker",
+    "release_worker",
+    "acquire_booking",
+    "finish_booking",
+    "is_booked",
+    "sight",
+    "last_sighting",
+)
+
+
+def lease_key(key: str) -> str:
+    """Profile keys hold document numbers: only their hash is sent to and stored by the cluster"""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def node_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Coordinator:
+    """Leases and sightings shared by every node using the same SQLite file.
+
+    A profile is polled by at most ``workers`` nodes at a time, each holding a worker lease it renews
+    on every attempt, and only the node holding its booking lease may confirm a cita."""
+
+    def __init__(
+        self,
+        path: str,
+        node: Optional[str] = None,
+        worker_ttl: float = WORKER_TTL,
+        booking_ttl: float = BOOKING_TTL,
+    ):
+        self.path = path
+        self.node = node or node_name()
+        self.worker_ttl = worker_ttl
+        self.booking_ttl = booking_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def transaction(self, fn, *args):
+        """Runs fn(cursor, now, *args) under an immediate (write-locked) transaction"""
+        with self.lock:
+            cursor = self.db.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(cursor, time.time(), *args)
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            return result
+
+    def claim_worker(self, profile: str, workers: int = 1, node: Optional[str] = None) -> bool:
+        """Takes or renews one of the profile's ``workers`` leases, False if all are held elsewhere"""
+
+        def claim(cursor, now):
+            if cursor.execute(
+                "SELECT 1 FROM bookings WHERE profile = ? AND booked", (profile,)
+            ).fetchone():
+                return False
+            cursor.execute("DELETE FROM workers WHERE profile = ? AND expires < ?", (profile, now))
+            held = dict(
+                cursor.execute("SELECT slot, node FROM workers WHERE profile = ?", (profile,))
+            )
+            mine = [slot for slot, owner in held.items() if owner == (node or self.node)]
+            free = [slot for slot in range(workers) if slot not in held]
+            slot = mine[0] if mine else free[0] if free else None
+            if slot is None:
+                return False
+            cursor.execute(
+                "INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)",
+                (profile, slot, node or self.node, now + self.worker_ttl),
+            )
+            return True
+
+        return self.transaction(claim)
+
+    def release_worker(self, profile: str, node: Optional[str] = None):
+        self.transaction(
+            lambda cursor, now: cursor.execute(
+                "DELETE FROM workers WHERE profile = ? AND node = ?", (profile, node or self.node)
+            )
+        )
+
+    def acquire_booking(self, profile: str, node: Optional[str] = None) -> bool:
+        """Only one node at a time may go on to confirm a cita for the profile, none once booked"""
+
+        def acquire(cursor, now):
+            row = cursor.execute(
+                "SELECT node, expires, booked FROM bookings WHERE profile = ?", (profile,)
+            ).fetchone()
+            if row and (row[2] or (row[0] != (node or self.node) and row[1] > now)):
+                return False
+            cursor.execute(
+                "INSERT OR REPLACE INTO bookings VALUES (?, ?, ?, 0)",
+                (profile, node or self.node, now + self.booking_ttl),
+            )
+            return True
+
+        return self.transaction(acquire)
+
+    def finish_booking(self, profile: str, booked: bool, node: Optional[str] = None):
+        def finish(cursor, now):
+            if booked:
+                cursor.execute(
+                    "UPDATE bookings SET booked = 1 WHERE profile = ? AND node = ?",
+                    (profile, node or self.node),
+                )
+            else:
+                cursor.execute(
+                    "DELETE FROM bookings WHERE profile = ? AND node = ? AND NOT booked",
+                    (profile, node or self.node),
+                )
+
+        self.transaction(finish)
+
+    def is_booked(self, profile: str) -> bool:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM bookings WHERE profile = ? AND booked", (profile,)
+            ).fetchone()
+        return row is not None
+
+    def sight(self, key: str, office: Optional[str] = None, node: Optional[str] = None):
+        """Records slots seen for a province/operation, for every node to read"""
+
+        def insert(cursor, now):
+            cursor.execute("DELETE FROM sightings WHERE time < ?", (now - SIGHTING_TTL,))
+            cursor.execute(
+                "INSERT INTO sightings VALUES (?, ?, ?, ?)", (now, key, office, node or self.node)
+            )
+
+        self.transaction(insert)
+
+    def last_sighting(self, key: str) -> Optional[float]:
+        """Epoch time slots were last seen for the key by any node"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MAX(time) FROM sightings WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class RemoteCoordinator:
+    """Same interface as Coordinator, served by ``python -m bcncita.cluster`` on another machine"""
+
+    def __init__(self, url: str, token: str, node: Optional[str] = None, timeout: float = 10):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.node = node or node_name()
+        self.timeout = timeout
+
+    def call(self, method: str, *args) -> Any:
+        data = json.dumps({"method": method, "args": list(args), "node": self.node}).encode()
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {self.token}"}
+        request = Request(f"{self.url}/call", data=data, headers=headers)
+        with urlopen(request, timeout=self.timeout) as resp:
+            return json.loads(resp.read())["result"]
+
+    def claim_worker(self, profile: str, workers: int = 1) -> bool:
+        return self.call("claim_worker", profile, workers)
+
+    def release_worker(self, profile: str):
+        self.call("release_worker", profile)
+
+    def acquire_booking(self, profile: str) -> bool:
+        return self.call("acquire_booking", profile)
+
+    def finish_booking(self, profile: str, booked: bool):
+        self.call("finish_booking", profile, booked)
+
+    def is_booked(self, profile: str) -> bool:
+        return self.call("is_booked", profile)
+
+    def sight(self, key: str, office: Optional[str] = None):
+        self.call("sight", key, office)
+
+    def last_sighting(self, key: str) -> Optional[float]:
+        return self.call("last_sighting", key)
+
+
+def serve(path: str, port: int, token: str, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Shares a Coordinator over HTTP: POST /call {"method", "args", "node"} -> {"result"}, for
+    clients sending "Authorization: Bearer <token>". Use a tunnel or TLS proxy between machines"""
+    if not token:
+        raise ValueError("A cluster token is required")
+    store = Coordinator(path)
+    expected = f"Bearer {token}".encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            given = self.headers.get("Authorization", "").encode("utf-8")
+            if not hmac.compare_digest(given, expected):
+                self.send_error(401)
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if self.path != "/call" or body.get("method") not in REMOTE_METHODS:
+                    self.send_error(404)
+                    return
+                method = getattr(store, body["method"])
+                args = body.get("args", [])
+                if body["method"] in ("is_booked", "last_sighting"):
+                    result = method(*args)
+                else:
+                    result = method(*args, node=body.get("node"))
+            except (ValueError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            data = json.dumps({"result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    logging.info(f"Cluster coordinator on http://{host}:{server.server_address[1]}")
+    return server
+
+
+_coordinators: Dict[str, Any] = {}
+_coordinators_lock = threading.Lock()
+
+
+def coordinator(target: str, token: Optional[str] = None) -> Any:
+    """One coordinator per SQLite path or http:// URL, shared by the profiles of a process"""
+    with _coordinators_lock:
+        if target not in _coordinators:
+            if target.startswith(("http://", "https://")):
+                token = token or os.environ.get(TOKEN_ENV)
+                if not token:
+                    raise ValueError(f"Set cluster_token or {TOKEN_ENV} to use {target}")
+                _coordinators[target] = RemoteCoordinator(target, token)
+            else:
+                _coordinators[target] = Coordinator(target)
+        return _coordinators[target]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve cluster leases to bots on other machines")
+    parser.add_argument("db", help="SQLite file holding the leases")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--token", default=os.environ.get(TOKEN_ENV), help=f"Shared secret (or {TOKEN_ENV})"
+    )
+    args = parser.parse_args()
+    if not args.token:
+        parser.error(f"a shared token is required: --token or {TOKEN_ENV}")
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+    try:
+        serve(args.db, args.port, args.token, args.host).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
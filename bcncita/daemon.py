@@ -0,0 +1,234 @@
+import argparse
+import json
+import logging
+import os
+import threading
+from dataclasses import fields
+from typing import Dict, Optional
+
+from .cita import CustomerProfile, DocType, Office, OperationType, Province
+from .orchestrator import Orchestrator
+from .pool import DriverPool
+
+__all__ = ["Daemon", "run_daemon"]
+
+POLL_INTERVAL = 2  # seconds between config file checks
+DAEMON_CYCLES = 10**9  # profiles run until booked or removed from the config
+
+ENUM_FIELDS = {"province": Province, "operation_code": OperationType, "doc_type": DocType}
+OFFICE_FIELDS = ("offices", "except_offices")
+# Read afresh on every attempt: changing these retunes the running profile in place
+RETUNE_FIELDS = {
+    "phone",
+    "email",
+    "country",
+    "year_of_birth",
+    "reason_or_type",
+    "offices",
+    "except_offices",
+    "min_date",
+    "max_date",
+    "min_time",
+    "max_time",
+    "date_windows",
+    "time_windows",
+    "weekdays",
+    "auto_office",
+    "auto_captcha",
+    "save_artifacts",
+    "readiness_waits",
+    "step_budget",
+    "wait_exact_time",
+    "office_scan",
+    "cluster_workers",
+}
+# Any other option makes it another person or procedure, or is read when the profile is set up
+# (browsers, solvers, files, servers): the profile is replaced instead of retuned in place
+REPLACE_FIELDS = tuple(f.name for f in fields(CustomerProfile) if f.name not in RETUNE_FIELDS)
+PROFILE_FIELDS = {f.name for f in fields(CustomerProfile)}
+
+
+def enum_value(enum, value):
+    """Accepts members, names ("BARCELONA") and values ("8")"""
+    if isinstance(value, enum):
+        return value
+    try:
+        return enum[value]
+    except KeyError:
+        return enum(value)
+
+
+def office_option(office):
+    """Office members by name or value, other numeric ids kept as plain strings like office_value"""
+    try:
+        return enum_value(Office, office)
+    except ValueError:
+        if str(office).isdigit():
+            return str(office)
+        raise
+
+
+def profile_options(data: dict) -> dict:
+    """CustomerProfile keyword arguments from one JSON profile entry"""
+    options = {}
+    for key, value in data.items():
+        if key == "id":
+            continue
+        if key not in PROFILE_FIELDS:
+            raise ValueError(f"Unknown profile option {key}")
+        if key in ENUM_FIELDS and value is not None:
+            value = enum_value(ENUM_FIELDS[key], value)
+        elif key in OFFICE_FIELDS and value:
+            if not isinstance(value, list):
+                raise ValueError(f"{key} must be a list of offices")
+            value = [office_option(office) for office in value]
+        options[key] = value
+    return options
+
+
+class Daemon:
+    """Runs the profiles of a JSON config file and applies edits to it without a restart:
+
+    {"drivers": 2, "defaults": {...}, "profiles": [{"id": "boris", "name": ..., ...}]}
+
+    Profiles are matched by "id" (or doc_value). New ones are added, missing ones removed, and
+    changed options are set on the running profile, so browsers and sessions are kept."""
+
+    def __init__(
+        self,
+        path: str,
+        drivers: Optional[int] = None,
+        poll_interval: float = POLL_INTERVAL,
+        orchestrator: Optional[Orchestrator] = None,
+    ):
+        self.path = path
+        self.drivers = drivers
+        self.poll_interval = poll_interval
+        self.orchestrator = orchestrator
+        self.pool: Optional[DriverPool] = None
+        self.profiles: Dict[str, CustomerProfile] = {}
+        self.options: Dict[str, dict] = {}  # last applied options per profile id
+        self.mtime: Optional[float] = None
+        self.stopped = threading.Event()
+
+    def load(self) -> Optional[dict]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"[Daemon] Cannot read {self.path}: {e}")
+            return None
+
+    def changed(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        return True
+
+    def apply(self, config: dict):
+        wanted = {}
+        defaults = config.get("defaults", {})
+        for data in config.get("profiles", []):
+            entry = {**defaults, **data}
+            key = str(entry.get("id") or entry.get("doc_value"))
+            try:
+                options = profile_options(entry)
+                if key not in self.options or options != self.options[key]:
+                    CustomerProfile(**options)  # validate before touching the running one
+            except (TypeError, ValueError, AssertionError) as e:
+                logging.error(f"[Daemon] Profile {key} ignored: {e}")
+                if key in self.options:
+                    wanted[key] = self.options[key]  # keep running the last good version
+                continue
+            wanted[key] = options
+
+        for key in list(self.profiles):
+            if key not in wanted:
+                logging.info(f"[Daemon] Removing {key}")
+                self.orchestrator.remove(self.profiles.pop(key))  # type: ignore
+                del self.options[key]
+
+        for key, options in wanted.items():
+            old = self.options.get(key)
+            if old == options:
+                continue
+            if old is None or any(old.get(f) != options.get(f) for f in REPLACE_FIELDS):
+                if old is not None:
+                    self.orchestrator.remove(self.profiles[key])  # type: ignore
+                logging.info(f"[Daemon] Adding {key}")
+                self.profiles[key] = CustomerProfile(**options)
+                self.orchestrator.add(self.profiles[key])  # type: ignore
+            else:
+                self.retune(key, old, options)
+            self.options[key] = options
+
+    def retune(self, key: str, old: dict, options: dict):
+        """Sets changed options on the running profile, dropped ones go back to their default"""
+        profile = self.profiles[key]
+        fresh = CustomerProfile(**options)
+        changed = sorted(k for k in set(old) | set(options) if old.get(k) != options.get(k))
+        for name in changed:
+            setattr(profile, name, getattr(fresh, name))
+        profile.compile_preferences()
+        logging.info(f"[Daemon] Retuned {key}: {', '.join(changed)}")
+
+    def watch(self):
+        while not self.stopped.wait(self.poll_interval):
+            if self.changed():
+                config = self.load()
+                if config is not None:
+                    self.apply(config)
+
+    def start(self) -> Orchestrator:
+        self.changed()
+        config = self.load() or {}
+        if self.orchestrator is None:
+            drivers = self.drivers or config.get("drivers", 2)
+            self.orchestrator = Orchestrator(
+                [], drivers=drivers, cycles=config.get("cycles", DAEMON_CYCLES), keep_alive=True
+            )
+        self.apply(config)
+        threading.Thread(target=self.watch, name="daemon-config", daemon=True).start()
+        return self.orchestrator
+
+    def stop(self):
+        self.stopped.set()
+        if self.orchestrator:
+            self.orchestrator.stop()
+
+    def run(self):
+        orchestrator = self.start()
+        if orchestrator.pool is None and self.profiles:
+            orchestrator.pool = self.pool = DriverPool(
+                list(self.profiles.values()), size=orchestrator.drivers
+            ).start()
+        try:
+            return orchestrator.run()
+        finally:
+            self.stop()
+            if self.pool:
+                self.pool.close()
+
+
+def run_daemon(path: str, drivers: Optional[int] = None):
+    logging.basicConfig(format="%(asctime)s - %(threadName)s - %(message)s", level=logging.INFO)
+    return Daemon(path, drivers=drivers).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the profiles of a config file, live")
+    parser.add_argument("config", help="JSON file, edits are applied while running")
+    parser.add_argument("--drivers", type=int, help="Browsers to run (config 'drivers', or 2)")
+    args = parser.parse_args()
+    try:
+        run_daemon(args.config, args.drivers)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
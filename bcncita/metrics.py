@@ -0,0 +1,156 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+__all__ = ["registry", "start_metrics_server"]
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{format_labels(k)} {v}" for k, v in sorted(self.values.items())]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values: Dict[Labels, list] = {}  # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            data = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                data[idx] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def count(self, **labels) -> int:
+        data = self.values.get(tuple(sorted(labels.items())))
+        return data[-1] if data else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, data in sorted(self.values.items()):
+                cumulative = 0
+                for bound, hits in zip(self.buckets, data):
+                    cumulative += hits
+                    le = format_labels(key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = format_labels(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {data[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {data[-2]}")
+                lines.append(f"{self.name}_count{format_labels(key)} {data[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))  # type: ignore
+
+    def histogram(self, name: str, help: str, buckets=BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))  # type: ignore
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")  # type: ignore
+            lines.append(f"# TYPE {metric.name} {metric.kind}")  # type: ignore
+            lines.extend(metric.samples())  # type: ignore
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+step_seconds = registry.histogram("cita_step_seconds", "Time spent in each step of a cycle")
+outcomes = registry.counter("cita_outcomes_total", "Cycle outcomes")
+step_bytes = registry.counter("cita_step_bytes_total", "Bytes downloaded by the browser per step")
+step_requests = registry.counter("cita_step_requests_total", "Browser requests per step")
+blocked_requests = registry.counter("cita_blocked_requests_total", "Requests cut by lean mode")
+browser_recycles = registry.counter(
+    "cita_browser_recycles_total", "Browsers replaced by the watchdog"
+)
+
+
+@contextmanager
+def timed(step: str):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        step_seconds.observe(time.monotonic() - start, step=step)
+
+
+def outcome(name: str):
+    outcomes.inc(outcome=name)
+
+
+_servers: Dict[int, ThreadingHTTPServer] = {}
+_servers_lock = threading.Lock()
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> Optional[ThreadingHTTPServer]:
+    """Serves the registry in Prometheus text format on http://host:port/metrics"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            data = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    with _servers_lock:
+        if port not in _servers:
+            server = ThreadingHTTPServer((host, port), Handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+            logging.info(f"Metrics on http://{host}:{server.server_address[1]}/metrics")
+            _servers[port] = server
+        return _servers[port]
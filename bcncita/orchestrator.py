@@ -0,0 +1,282 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+from .bus import Sighting, sighting_bus
+from .cita import (
+    CLUSTER_RETRY,
+    CYCLES,
+    CustomerProfile,
+    attempt_cita,
+    cluster_booked,
+    cluster_turn,
+    endpoint_key,
+    fast_forward_urls,
+    init_wedriver,
+    prepare_profile,
+    quit_driver,
+    recycle_if_bloated,
+    schedule_delay,
+    sighting_key,
+)
+from .pool import DriverPool
+from .ratecontrol import rate_controller
+
+__all__ = ["Orchestrator", "orchestrate"]
+
+REPORT_INTERVAL = 60  # seconds between throughput reports
+DRIVER_RETRY = 30  # seconds before a profile whose browser could not be had is tried again
+
+
+class Orchestrator:
+    """Round-robins many CustomerProfiles over a bounded number of browsers"""
+
+    def __init__(
+        self,
+        profiles: List[CustomerProfile],
+        drivers: int = 2,
+        cycles: int = CYCLES,
+        driver_factory: Callable = init_wedriver,
+        report_interval: int = REPORT_INTERVAL,
+        pool: Optional[DriverPool] = None,
+        keep_alive: bool = False,
+        driver_retry: float = DRIVER_RETRY,
+    ):
+        self.drivers = drivers
+        self.driver_retry = driver_retry
+        self.keep_alive = keep_alive  # Workers wait for new profiles instead of exiting
+        self.pool = pool
+        self.cycles = cycles
+        self.driver_factory = driver_factory
+        self.report_interval = report_interval
+
+        self.queue: Deque[CustomerProfile] = deque()
+        self.booked: List[CustomerProfile] = []
+        self.attempts: Dict[int, int] = {}  # id(profile) -> attempts made
+        self.due: Dict[int, float] = {}  # id(profile) -> monotonic time of its next attempt
+        self.removed: Set[int] = set()  # id(profile) of profiles not to requeue
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.done = threading.Event()
+        self._timestamps: Deque[float] = deque()
+        for profile in profiles:
+            self.add(profile)
+
+    def add(self, profile: CustomerProfile):
+        profile.exit_on_success = False  # Others keep running after a booking
+        profile.wait_for_endpoint = False  # Cooling endpoints are requeued, not slept on
+        prepare_profile(profile)
+        with self.cond:
+            self.removed.discard(id(profile))
+            self.attempts.setdefault(id(profile), 0)
+            self.queue.append(profile)
+            self.cond.notify_all()
+
+    def remove(self, profile: CustomerProfile):
+        """Drops a profile, an attempt already running is let finish"""
+        with self.cond:
+            self.removed.add(id(profile))
+            self.queue = deque(p for p in self.queue if p is not profile)
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.keep_alive = False
+            self.queue.clear()
+            self.cond.notify_all()
+
+    def next_profile(self) -> Optional[CustomerProfile]:
+        """First queued profile that is due, profiles paced by their scheduler wait their turn"""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                for profile in self.queue:
+                    if self.due.get(id(profile), 0) <= now:
+                        self.queue.remove(profile)
+                        self.in_flight += 1
+                        return profile
+                if not self.queue and not self.in_flight and not self.keep_alive:
+                    return None
+                self.cond.wait(
+                    min(self.due.get(id(p), 0) for p in self.queue) - now if self.queue else None
+                )
+
+    def finish(self, profile: CustomerProfile, result):
+        delay = schedule_delay(profile) if not result else 0
+        delay = max(delay, rate_controller.retry_after(endpoint_key(profile)))
+        with self.cond:
+            self.in_flight -= 1
+            self.attempts[id(profile)] += 1
+            self._timestamps.append(time.monotonic())
+            if result:
+                logging.info(f"\033[32m[Orchestrator] {profile.name} booked, retiring\033[0m")
+                self.booked.append(profile)
+            elif id(profile) in self.removed:
+                pass
+            elif self.attempts[id(profile)] < self.cycles:
+                self.due[id(profile)] = time.monotonic() + delay
+                self.queue.append(profile)
+            else:
+                logging.error(f"[Orchestrator] {profile.name}: FAIL")
+            self.cond.notify_all()
+
+    def skip(self, profile: CustomerProfile):
+        """Gives back a profile whose worker leases are all held by other nodes"""
+        booked = cluster_booked(profile)
+        with self.cond:
+            self.in_flight -= 1
+            if booked:
+                logging.info(f"[Orchestrator] {profile.name} booked by another node, retiring")
+            elif id(profile) not in self.removed:
+                self.due[id(profile)] = time.monotonic() + CLUSTER_RETRY
+                self.queue.append(profile)
+            self.cond.notify_all()
+
+    def retry(self, profile: CustomerProfile, delay: float):
+        """Gives back a profile that got no attempt, without counting one"""
+        with self.cond:
+            self.in_flight -= 1
+            if id(profile) not in self.removed:
+                self.due[id(profile)] = time.monotonic() + delay
+                self.queue.append(profile)
+            self.cond.notify_all()
+
+    def dispose(self, driver):
+        if driver is None:
+            return
+        if self.pool:
+            self.pool.discard(driver)
+        else:
+            quit_driver(driver)
+
+    def wake(self, sighting: Sighting):
+        """Profiles paced on the sighted province and operation become due at once"""
+        with self.cond:
+            for profile in self.queue:
+                if sighting_key(profile) == sighting.key and not rate_controller.retry_after(
+                    endpoint_key(profile)
+                ):
+                    self.due[id(profile)] = 0
+            self.cond.notify_all()
+
+    def attempts_per_minute(self) -> int:
+        with self.cond:
+            horizon = time.monotonic() - 60
+            while self._timestamps and self._timestamps[0] < horizon:
+                self._timestamps.popleft()
+            return len(self._timestamps)
+
+    def report(self):
+        while not self.done.wait(self.report_interval):
+            logging.info(
+                f"[Orchestrator] {self.attempts_per_minute()} attempts/min, "
+                f"{len(self.queue) + self.in_flight} active, {len(self.booked)} booked"
+            )
+
+    def worker(self):
+        driver = None
+        owner = None
+        try:
+            while True:
+                profile = self.next_profile()
+                if profile is None:
+                    return
+                if not cluster_turn(profile):
+                    self.skip(profile)
+                    continue
+
+                try:
+                    previous = driver
+                    if driver is None:
+                        driver = (
+                            self.pool.acquire(profile)
+                            if self.pool
+                            else self.driver_factory(profile)
+                        )
+                    elif self.pool:
+                        driver = self.pool.check(driver, profile)
+                    if driver is not previous:
+                        owner = None  # a fresh browser, acquire has set first_load
+
+                    if owner is not None and owner is not profile:
+                        # Never leak one person's session into another one's attempt
+                        if self.pool:
+                            self.pool.wipe(driver)
+                        else:
+                            driver.delete_all_cookies()
+                        profile.first_load = True
+                        if profile.state:
+                            profile.state.restore(driver, profile)
+                except Exception as e:
+                    logging.error(
+                        f"[Orchestrator] {profile.name}: no browser, "
+                        f"retrying in {self.driver_retry}s: {e}"
+                    )
+                    self.dispose(driver)
+                    driver = owner = None
+                    self.retry(profile, self.driver_retry)
+                    continue
+                owner = profile
+
+                logging.info(
+                    f"\033[33m[{profile.name}] Attempt {self.attempts[id(profile)] + 1}/{self.cycles}\033[0m"
+                )
+                result = None
+                try:
+                    result = attempt_cita(driver, profile, *fast_forward_urls(profile))
+                finally:
+                    self.finish(profile, result)
+
+                if not result:
+                    try:
+                        driver = recycle_if_bloated(
+                            driver,
+                            profile,
+                            self.pool.acquire if self.pool else self.driver_factory,
+                            self.pool.discard if self.pool else quit_driver,
+                        )
+                    except Exception as e:
+                        # The bloated browser is gone already, the next profile gets a new one
+                        logging.error(f"[Orchestrator] Browser not recycled: {e}")
+                        driver = owner = None
+        finally:
+            if driver and self.pool:
+                self.pool.release(driver)
+            elif driver:
+                driver.quit()
+
+    def run(self) -> List[CustomerProfile]:
+        reporter = threading.Thread(target=self.report, name="orchestrator-report", daemon=True)
+        reporter.start()
+
+        workers = [
+            threading.Thread(target=self.worker, name=f"worker-{i}", daemon=True)
+            for i in range(self.drivers)
+        ]
+        sighting_bus.subscribe(self.wake)
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        sighting_bus.unsubscribe(self.wake)
+        self.done.set()
+        return self.booked
+
+
+def orchestrate(profiles: List[CustomerProfile], drivers: int = 2, cycles: int = CYCLES):
+    if not profiles:
+        return []
+
+    logging.basicConfig(
+        format="%(asctime)s - %(threadName)s - %(message)s",
+        level=logging.INFO,
+        **profiles[0].log_settings,  # type: ignore
+    )
+    pool = DriverPool(profiles, size=drivers).start()
+    try:
+        return Orchestrator(profiles, drivers=drivers, cycles=cycles, pool=pool).run()
+    finally:
+        pool.close()
@@ -0,0 +1,302 @@
+import re
+from dataclasses import dataclass, field
+from enum import Enum
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urljoin
+
+SKIP_TEXT_TAGS = ("script", "style", "head", "title")
+
+
+class PageState(str, Enum):
+    INSTRUCTIONS = "instructions"
+    PERSONAL_INFO = "personal_info"
+    SOLICITUD = "solicitud"
+    OFFICES = "offices"
+    NO_CITAS = "no_citas"
+    CONTACT_INFO = "contact_info"
+    SLOT_LIST = "slot_list"
+    SLOT_GRID = "slot_grid"
+    CONFIRMATION = "confirmation"
+    BOOKED = "booked"
+    WRONG_CODE = "wrong_code"
+    REJECTED = "rejected"
+    UNKNOWN = "unknown"
+
+
+# First match wins: [state, "id" or "text", marker]. Shared by CLASSIFY_JS and classify().
+PAGE_RULES = [
+    [PageState.REJECTED.value, "text", "The requested URL was rejected"],
+    [PageState.BOOKED.value, "text", "CITA CONFIRMADA Y GRABADA"],
+    [PageState.WRONG_CODE.value, "text", "Lo sentimos, el código introducido no es correcto"],
+    [PageState.CONFIRMATION.value, "text", "Debe confirmar los datos de la cita asignada"],
+    [PageState.SLOT_LIST.value, "text", "DISPONE DE 5 MINUTOS"],
+    [PageState.SLOT_GRID.value, "text", "Seleccione una de las siguientes citas disponibles"],
+    [PageState.NO_CITAS.value, "text", "En este momento no hay citas disponibles"],
+    [PageState.OFFICES.value, "text", "Seleccione la oficina donde solicitar la cita"],
+    [PageState.CONTACT_INFO.value, "id", "txtTelefonoCitado"],
+    [PageState.SOLICITUD.value, "id", "btnConsultar"],
+    [PageState.PERSONAL_INFO.value, "id", "txtIdCitado"],
+    [PageState.INSTRUCTIONS.value, "id", "btnEntrar"],
+    [PageState.INSTRUCTIONS.value, "text", "INTERNET CITA PREVIA"],
+]
+
+
+@dataclass
+class Form:
+    id: Optional[str] = None
+    action: str = ""
+    method: str = "get"
+    fields: Dict[str, str] = field(default_factory=dict)  # name -> current value
+    options: Dict[str, List[Tuple[str, str]]] = field(
+        default_factory=dict
+    )  # select -> [(value, text)]
+    ids: Dict[str, Tuple[str, str]] = field(default_factory=dict)  # element id -> (name, value)
+    element_ids: Set[str] = field(default_factory=set)
+
+    def name_of(self, element_id: str) -> Optional[str]:
+        found = self.ids.get(element_id)
+        return found[0] if found else None
+
+    def set(self, element_id: str, value: str) -> bool:
+        name = self.name_of(element_id)
+        if not name:
+            return False
+        self.fields[name] = value
+        return True
+
+    def check(self, element_id: str) -> bool:
+        """Select a radio or checkbox by its id"""
+        if element_id not in self.ids:
+            return False
+        name, value = self.ids[element_id]
+        self.fields[name] = value
+        return True
+
+    def select_by_text(self, element_id: str, text: str) -> bool:
+        name = self.name_of(element_id)
+        for value, option_text in self.options.get(name or "", []):
+            if option_text == text:
+                self.fields[name] = value  # type: ignore
+                return True
+        return False
+
+
+class Page(HTMLParser):
+    """Minimal DOM summary of an ICP page: forms, element ids and visible text"""
+
+    def __init__(self, html: str, url: str = ""):
+        super().__init__(convert_charrefs=True)
+        self.url = url
+        self.forms: List[Form] = []
+        self.elements: Dict[str, Dict[str, str]] = {}  # id -> attributes (incl. tag)
+        self._chunks: List[str] = []
+        self._skip = 0
+        self._form: Optional[Form] = None
+        self._select: Optional[str] = None
+        self._option: Optional[List[str]] = None
+        self.feed(html)
+        self.close()
+        self.text = re.sub(r"[ \t\r\f\v]+", " ", "".join(self._chunks)).strip()
+
+    def handle_starttag(self, tag, attrs):
+        attributes = {k: v or "" for k, v in attrs}
+        attributes["tag"] = tag
+        if attributes.get("id"):
+            self.elements[attributes["id"]] = attributes
+
+        if tag in SKIP_TEXT_TAGS:
+            self._skip += 1
+        elif tag in ("br", "p", "div", "tr", "li", "h1", "h2", "h3", "table"):
+            self._chunks.append("\n")
+        elif tag in ("option", "td", "th", "label", "span"):
+            self._chunks.append(" ")
+
+        if tag == "option" or tag == "select":
+            self._flush_option()
+
+        if tag == "form":
+            self._form = Form(
+                id=attributes.get("id"),
+                action=urljoin(self.url, attributes.get("action", "")),
+                method=attributes.get("method", "get").lower(),
+            )
+            self.forms.append(self._form)
+        elif self._form is None:
+            return
+
+        if attributes.get("id"):
+            self._form.element_ids.add(attributes["id"])
+
+        if tag == "input":
+            self._add_input(attributes)
+        elif tag == "textarea":
+            self._add_field(attributes, attributes.get("name", ""), "")
+        elif tag == "select":
+            self._select = attributes.get("name") or attributes.get("id")
+            if self._select:
+                self._form.options[self._select] = []
+                self._add_field(attributes, self._select, "")
+        elif tag == "option" and self._select:
+            self._option = [attributes.get("value", ""), ""]
+            if "selected" in attributes or not self._form.options[self._select]:
+                self._form.fields[self._select] = attributes.get("value", "")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TEXT_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag == "form":
+            self._form = None
+        elif tag in ("select", "option"):
+            self._flush_option()
+            if tag == "select":
+                self._select = None
+
+    def handle_data(self, data):
+        if self._option is not None:
+            self._option[1] += data
+        if not self._skip:
+            self._chunks.append(data)
+
+    def _flush_option(self):
+        if self._form is not None and self._select and self._option is not None:
+            value, text = self._option
+            self._form.options[self._select].append((value, text.strip()))
+        self._option = None
+
+    def _add_input(self, attributes: Dict[str, str]):
+        kind = attributes.get("type", "text").lower()
+        name = attributes.get("name", "")
+        value = attributes.get("value", "")
+        if kind in ("button", "submit", "reset", "image"):
+            return
+        if kind in ("radio", "checkbox"):
+            if attributes.get("id") and name:
+                self._form.ids[attributes["id"]] = (name, value or "on")  # type: ignore
+            if "checked" in attributes and name:
+                self._form.fields[name] = value or "on"  # type: ignore
+            return
+        self._add_field(attributes, name, value)
+
+    def _add_field(self, attributes: Dict[str, str], name: str, value: str):
+        if not name:
+            return
+        self._form.fields[name] = value  # type: ignore
+        if attributes.get("id"):
+            self._form.ids[attributes["id"]] = (name, value)  # type: ignore
+
+    def has(self, element_id: str) -> bool:
+        return element_id in self.elements
+
+    def form_with(self, element_id: str) -> Optional[Form]:
+        for form in self.forms:
+            if element_id in form.element_ids:
+                return form
+        return self.forms[0] if self.forms else None
+
+
+def parse_page(html: str, url: str = "") -> Page:
+    return Page(html, url)
+
+
+def classify(page: Page) -> PageState:
+    """Python twin of CLASSIFY_JS"""
+    for state, kind, marker in PAGE_RULES:
+        if page.has(marker) if kind == "id" else marker in page.text:
+            return PageState(state)
+    return PageState.UNKNOWN
+
+
+VOID_TAGS = ("area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source")
+
+
+class SlotParser(HTMLParser):
+    """Python twin of SLOT_GRID_JS and DATE_SLOTS_JS, for pages read outside the browser"""
+
+    def __init__(self, html: str):
+        super().__init__(convert_charrefs=True)
+        self.grid: Optional[dict] = None
+        self.labels: List[str] = []
+        self._table = 0  # nesting depth inside CitaMAP_HORAS
+        self._section = ""
+        self._text: Optional[List[str]] = None  # text of the current date header or row header
+        self._label: Optional[List] = None  # [depth, chunks] of the current lCita_ element
+        self.feed(html)
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        attributes = {k: v or "" for k, v in attrs}
+        element_id = attributes.get("id", "")
+
+        if self._label is not None and tag not in VOID_TAGS:
+            self._label[0] += 1
+        elif element_id.startswith("lCita_"):
+            self._label = [0 if tag in VOID_TAGS else 1, []]
+            if tag in VOID_TAGS:
+                self._end_label()
+
+        if tag == "table":
+            if self._table:
+                self._table += 1
+            elif element_id == "CitaMAP_HORAS":
+                self._table = 1
+                self.grid = {"dates": [], "rows": []}
+            return
+        if not self._table:
+            return
+
+        if tag in ("thead", "tbody"):
+            self._section = tag
+        elif tag == "tr" and self._section == "tbody":
+            self.grid["rows"].append(["", []])  # type: ignore
+        elif tag == "th" and self._section == "thead":
+            if attributes.get("class", "").startswith("colFecha"):
+                self._text = []
+        elif tag == "th" and self._section == "tbody" and self.grid["rows"]:  # type: ignore
+            self._text = []
+        elif tag == "td" and self._section == "tbody" and self.grid["rows"]:  # type: ignore
+            self.grid["rows"][-1][1].append(None)  # type: ignore
+        elif element_id.startswith("HUECO") and self.grid["rows"]:  # type: ignore
+            cells = self.grid["rows"][-1][1]  # type: ignore
+            if cells and cells[-1] is None:
+                cells[-1] = element_id
+
+    def handle_endtag(self, tag):
+        if self._label is not None and tag not in VOID_TAGS:
+            self._label[0] -= 1
+            if self._label[0] <= 0:
+                self._end_label()
+
+        if not self._table:
+            return
+        if tag == "table":
+            self._table -= 1
+        elif tag in ("thead", "tbody"):
+            self._section = ""
+        elif tag == "th" and self._text is not None:
+            text = "".join(self._text).strip()
+            if self._section == "thead":
+                self.grid["dates"].append(text)  # type: ignore
+            else:
+                self.grid["rows"][-1][0] = text  # type: ignore
+            self._text = None
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+        if self._label is not None:
+            self._label[1].append(data)
+
+    def _end_label(self):
+        self.labels.append("".join(self._label[1]).strip())  # type: ignore
+        self._label = None
+
+
+def slot_grid(html: str) -> Optional[dict]:
+    """Same {dates, rows} structure SLOT_GRID_JS returns, None without a CitaMAP_HORAS table"""
+    return SlotParser(html).grid
+
+
+def date_slots(html: str) -> List[str]:
+    """Same "CITA n: ..." labels DATE_SLOTS_JS returns, in document order"""
+    return SlotParser(html).labels
@@ -0,0 +1,408 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from typing import Any, Callable, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+import backoff
+import requests
+from requests.adapters import HTTPAdapter
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+from .bus import sighting_bus
+from .cita import (
+    CYCLES,
+    DELAY,
+    REFRESH_PAGE_CYCLES,
+    USER_AGENT,
+    CustomerProfile,
+    OperationType,
+    cita_selection,
+    endpoint_key,
+    fast_forward_urls,
+    init_wedriver,
+    log_backoff,
+    observe_release,
+    office_candidates,
+    pace,
+    personal_info_values,
+    prepare_profile,
+    publish_sighting,
+    recycle_if_bloated,
+    sighting_key,
+    speaker,
+)
+from .metrics import outcome, timed
+from .page import Form, Page, PageState, classify, parse_page
+from .ratecontrol import EndpointUnavailable, RateController, rate_controller
+from .state import load_cookies
+
+__all__ = ["HttpPoller", "poll_cita"]
+
+SLOT_STATES = (PageState.SLOT_LIST, PageState.SLOT_GRID)
+
+# Sends the poller's last request from the browser: a form built on the fly and submitted natively
+REPLAY_POST_JS = """
+const [action, fields] = arguments;
+const form = document.createElement("form");
+form.method = "post";
+form.action = action;
+for (const [name, value] of fields) {
+    const input = document.createElement("input");
+    input.type = "hidden";
+    input.name = name;
+    input.value = value;
+    form.appendChild(input);
+}
+document.body.appendChild(form);
+HTMLFormElement.prototype.submit.call(form);
+"""
+
+
+def new_session(pool_size: int = 10) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT})
+    return session
+
+
+class HttpPoller:
+    """Walks the cita flow over plain HTTP and wakes a browser only when slots are offered"""
+
+    def __init__(
+        self,
+        context: CustomerProfile,
+        driver_factory: Callable = init_wedriver,
+        session: Optional[requests.Session] = None,
+        rates: Optional[RateController] = None,
+        office: Optional[str] = None,
+    ):
+        self.context = context
+        self.office = office  # Set on the extra sessions of an office scan
+        self.driver_factory = driver_factory
+        self.driver: Any = None
+        self.session = session or new_session()
+        self.rates = rates or rate_controller
+        self.endpoint = endpoint_key(context)
+        self.fast_forward_url, self.fast_forward_url2 = fast_forward_urls(context)
+        self._last_request: tuple = ()
+
+    def request(self, method: str, url: str, data: Optional[dict] = None) -> Page:
+        self._last_request = (method, url, data)
+        resp = self.session.request(method, url, data=data, timeout=DELAY)
+        resp.raise_for_status()
+        if self.context.recorder:
+            self.context.recorder.record(
+                urlparse(resp.url).path.split("/")[-1], resp.url, resp.text
+            )
+        return parse_page(resp.text, resp.url)
+
+    def submit(self, form: Form, action: Optional[str] = None) -> Page:
+        url = urljoin(form.action, action) if action else form.action
+        if form.method == "get" and not action:
+            return self.request("GET", url + "?" + requests.compat.urlencode(form.fields))
+        return self.request("POST", url, dict(form.fields))
+
+    def throttle(self):
+        wait = self.rates.acquire(self.endpoint)
+        if wait > 0:
+            if self.rates.retry_after(self.endpoint):
+                time.sleep(wait)
+            else:
+                sighting_bus.sleep(sighting_key(self.context), wait)
+
+    def failed(self) -> EndpointUnavailable:
+        self.rates.record(self.endpoint, False)
+        return EndpointUnavailable(
+            self.endpoint, self.rates.backoff(self.endpoint), self.context.wait_for_endpoint
+        )
+
+    def refresh(self) -> Page:
+        self.throttle()
+        start = time.monotonic()
+        try:
+            page = self.request(*self._last_request)
+        except requests.RequestException:
+            self.rates.record(self.endpoint, False)
+            raise
+        self.rates.record(
+            self.endpoint, classify(page) is not PageState.REJECTED, time.monotonic() - start
+        )
+        return page
+
+    @backoff.on_exception(
+        backoff.runtime,
+        EndpointUnavailable,
+        value=lambda e: e.retry_after,
+        jitter=None,
+        giveup=lambda e: not e.wait,  # type: ignore[attr-defined]
+        max_tries=(10 if os.environ.get("CITA_TEST") else None),
+        on_backoff=log_backoff,
+        logger=None,
+    )
+    def initial_page(self) -> Page:
+        retry_after = self.rates.retry_after(self.endpoint)
+        if retry_after:
+            raise EndpointUnavailable(self.endpoint, retry_after, self.context.wait_for_endpoint)
+
+        self.throttle()
+        start = time.monotonic()
+        try:
+            self.request("GET", self.fast_forward_url)
+            page = self.request("GET", self.fast_forward_url2)
+        except requests.RequestException:
+            raise self.failed()
+        if classify(page) is not PageState.INSTRUCTIONS:
+            raise self.failed()
+        self.rates.record(self.endpoint, True, time.monotonic() - start)
+        return page
+
+    def cycle(self) -> Optional[Page]:
+        """One walk through the flow, the slots page if any were offered.
+
+        With office_scan > 1 the first candidate office goes on in this session while the next
+        ones are walked at the same time in sessions of their own: the site keeps one office per
+        session. The most preferred office offering slots wins, and its session is kept."""
+        self.context.current_office = None
+        offices = self.offices()
+        if offices is None:
+            return None
+        form, candidates = offices
+
+        scanners = [
+            HttpPoller(self.context, self.driver_factory, rates=self.rates, office=office)
+            for office in candidates[1 : self.context.office_scan]
+        ]
+        if scanners:
+            logging.info(
+                f"[Step 2/6] Office selection -> scanning "
+                f"{', '.join(candidates[: len(scanners) + 1])} in separate sessions"
+            )
+        with ThreadPoolExecutor(max_workers=max(len(scanners), 1)) as executor:
+            futures = [executor.submit(scanner.scan) for scanner in scanners]
+            offers = [self.offer(form, candidates[0])]
+            offers += [future.result() for future in futures]
+
+        winner = next(
+            (i for i, offer in enumerate(offers) if offer and classify(offer) in SLOT_STATES),
+            None,
+        )
+        for i, scanner in enumerate(scanners, start=1):
+            if i != winner:
+                scanner.session.close()
+        if winner is None:
+            logging.info("[Step 4/6] Cita attempt -> missed selection")
+            outcome("missed_selection")
+            observe_release(self.context, False)
+            return None
+
+        if winner:
+            scanner = scanners[winner - 1]
+            self.session.close()
+            self.session, self._last_request = scanner.session, scanner._last_request
+        self.context.current_office = candidates[winner]
+        logging.info("[Step 4/6] Cita attempt -> selection hit!")
+        outcome("selection_hit")
+        observe_release(self.context, True)
+        return offers[winner]
+
+    def scan(self) -> Optional[Page]:
+        """Walks a session of its own to the slots page of self.office"""
+        try:
+            offices = self.offices()
+            if offices is None or self.office not in offices[1]:
+                return None
+            return self.offer(offices[0], self.office)
+        except Exception as e:
+            logging.error(f"[Scan] Office {self.office}: {e}")
+            return None
+
+    def offices(self) -> Optional[Tuple[Form, List[str]]]:
+        """Walks to the office selection page: its form and the offices to try, in order"""
+        with timed("initial_page"):
+            page = self.initial_page()
+
+        # 1. Instructions page:
+        if not page.has("btnEntrar"):
+            logging.error("Instructions page has no btnEntrar")
+            return None
+        page = self.submit(page.form_with("btnEntrar"))  # type: ignore
+
+        # 2. Personal info:
+        logging.info("[Step 1/6] Personal info")
+        form = page.form_with("txtIdCitado")
+        if not form or not page.has("txtIdCitado"):
+            logging.error("Personal info form not found")
+            return None
+        with timed("personal_info"):
+            fill_personal_info(form, self.context)
+            page = self.submit(form)
+
+        wait_exact_time(self.context)
+
+        # 3. Solicitar cita:
+        with timed("office_selection"):
+            page = self.submit(page.form_with("btnConsultar") or Form(action=page.url), "acCitar")
+            return self.office_selection(page)
+
+    def offer(self, form: Form, office: str) -> Optional[Page]:
+        """Picks the office and sends the contact info, the page the site answers with"""
+        with timed("office_selection"):
+            form.set("idSede", office)
+            page = self.submit(form)
+
+        # 4. Contact info:
+        form = page.form_with("txtTelefonoCitado")  # type: ignore
+        if not form or not page.has("txtTelefonoCitado"):
+            logging.error("Contact info form not found")
+            return None
+        logging.info("[Step 3/6] Contact info")
+        with timed("contact_info"):
+            form.set("txtTelefonoCitado", self.context.phone)
+            form.set("emailUNO", self.context.email)
+            form.set("emailDOS", self.context.email)
+            if self.context.operation_code == OperationType.SOLICITUD_ASILO:
+                form.set("txtObservaciones", self.context.reason_or_type)
+            return self.submit(form, "acOfertarCita")
+
+    def observe(self, hit: bool):
+        if not self.office:  # scan sessions leave it to the poller that started them
+            observe_release(self.context, hit)
+
+    def office_selection(self, page: Page) -> Optional[Tuple[Form, List[str]]]:
+        for i in range(REFRESH_PAGE_CYCLES):
+            state = classify(page)
+            if state is PageState.OFFICES:
+                logging.info("[Step 2/6] Office selection")
+                form = page.form_with("idSede")
+                candidates = office_choices(form, self.context) if form else []
+                if self.office:
+                    candidates = [self.office] if self.office in candidates else []
+                if not candidates:
+                    outcome("no_offices")
+                    self.observe(False)
+                    page = self.refresh()
+                    continue
+
+                if not self.office:
+                    self.context.current_office = candidates[0]
+                    publish_sighting(self.context)
+                return form, candidates  # type: ignore
+            elif state is PageState.NO_CITAS:
+                outcome("no_citas")
+                self.observe(False)
+                page = self.refresh()
+                continue
+            else:
+                logging.info("[Step 2/6] Office selection -> No offices")
+                outcome("no_offices")
+                self.observe(False)
+                return None
+
+        return None
+
+    def hand_off(self):
+        """Moves the HTTP session into a browser, which sends the request that reached the slots
+        page once more, then picks a slot and confirms.
+
+        The site keeps no slots page to reload: acOfertarCita answers the contact form POST. The
+        browser replays that POST with the session's cookies, so the site sees the same session
+        submitting the same form, as if the browser had walked the flow itself"""
+        if not self.driver:
+            self.driver = self.driver_factory(self.context)
+
+        cookies = [
+            {"name": cookie.name, "value": cookie.value, "path": cookie.path or "/"}
+            for cookie in self.session.cookies
+        ]
+        load_cookies(self.driver, self.context.icp_url, cookies)
+        self.replay(*self._last_request)
+        self.context.first_load = False
+        return cita_selection(self.driver, self.context)
+
+    def replay(self, method: str, url: str, data: Optional[dict] = None):
+        if method == "GET":
+            self.driver.get(url)
+            return
+        old = self.driver.find_element(By.TAG_NAME, "html")
+        self.driver.execute_script(REPLAY_POST_JS, url, list((data or {}).items()))
+        WebDriverWait(self.driver, DELAY).until(EC.staleness_of(old))
+
+    def run(self, cycles: int = CYCLES):
+        for i in range(cycles):
+            try:
+                if not pace(self.context):
+                    if self.driver:
+                        self.driver.quit()
+                    return False
+                logging.info(f"\033[33m[Attempt {i + 1}/{cycles}]\033[0m")
+                hit = self.cycle()
+                if hit and self.hand_off():
+                    logging.info("WIN")
+                    return True
+                if self.driver:
+                    self.driver = recycle_if_bloated(
+                        self.driver, self.context, self.driver_factory
+                    )
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                logging.error(f"SMTH BROKEN: {e}")
+                outcome("error")
+                continue
+
+        logging.error("FAIL")
+        speaker.say("FAIL")
+        if self.driver:
+            self.driver.quit()
+        return False
+
+
+def fill_personal_info(form: Form, context: CustomerProfile):
+    """Same FORM_SPECS values the browser fills with FILL_FORM_JS"""
+    radios, fields, selects = personal_info_values(context)
+    for ids in radios:
+        for radio in ids:
+            if form.check(radio):
+                break
+    for element_id, value in fields.items():
+        form.set(element_id, value)
+    for element_id, text in selects.items():
+        form.select_by_text(element_id, text)
+
+
+def office_choices(form: Form, context: CustomerProfile) -> List[str]:
+    name = form.name_of("idSede") or "idSede"
+    return office_candidates([value for value, _ in form.options.get(name, [])], context)
+
+
+def pick_office(form: Form, context: CustomerProfile) -> Optional[str]:
+    candidates = office_choices(form, context)
+    return candidates[0] if candidates else None
+
+
+def wait_exact_time(context: CustomerProfile, timeout: int = 1200):
+    if not context.wait_exact_time:
+        return
+
+    deadline = time.monotonic() + timeout
+    while [dt.now().minute, dt.now().second] not in context.wait_exact_time:
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for exact time")
+        time.sleep(0.1)
+
+
+def poll_cita(
+    context: CustomerProfile, cycles: int = CYCLES, driver_factory: Callable = init_wedriver
+):
+    logging.basicConfig(
+        format="%(asctime)s - %(message)s", level=logging.INFO, **context.log_settings  # type: ignore
+    )
+    prepare_profile(context)
+    return HttpPoller(context, driver_factory=driver_factory).run(cycles)
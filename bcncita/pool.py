@@ -0,0 +1,256 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Union
+
+from selenium.common.exceptions import WebDriverException
+
+from .cita import CustomerProfile, fast_forward_urls, init_wedriver, quit_driver
+
+__all__ = ["DriverPool"]
+
+MAX_USES = 50  # recycle a browser after this many attempts
+ACQUIRE_TIMEOUT = 600  # seconds to wait for a browser before giving up
+LAUNCH_RETRY = 5  # seconds before relaunching a browser that failed to start, doubled each time
+LAUNCH_RETRY_MAX = 300
+WARM_UP_TIMEOUT = 120  # seconds the warm-up load may take, a slow one leaves the browser cold
+
+
+def browser_options(context: CustomerProfile) -> tuple:
+    """What init_wedriver builds a browser from, profiles differing here can't share one"""
+    return (
+        context.chrome_driver_path,
+        context.chrome_profile_path,
+        context.chrome_profile_name,
+        context.lean_browser,
+        context.count_traffic,
+        context.icp_url,
+    )
+
+
+class DriverPool:
+    """Keeps pre-launched, pre-warmed browsers ready to be handed out.
+
+    Each browser is launched from the options of the profile it is meant for, so profiles with
+    their own Chrome user data directory get browsers of their own (one at a time per directory)."""
+
+    def __init__(
+        self,
+        profiles: Union[CustomerProfile, List[CustomerProfile]],
+        size: int = 2,
+        driver_factory: Callable = init_wedriver,
+        max_uses: int = MAX_USES,
+        launch_retry: float = LAUNCH_RETRY,
+    ):
+        self.profiles = profiles if isinstance(profiles, list) else [profiles]
+        self.size = size
+        self.driver_factory = driver_factory
+        self.max_uses = max_uses
+        self.launch_retry = launch_retry
+        self.idle: List = []
+        self.owners: Dict[int, CustomerProfile] = {}  # id(driver) -> profile it was launched for
+        self.launching: List[CustomerProfile] = []
+        self.warm: Set[int] = set()
+        self.uses: Dict[int, int] = {}
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.closed = False
+
+    def start(self):
+        with self.cond:
+            for i in range(self.size):
+                context = self.profiles[i % len(self.profiles)]
+                if self.can_launch(context):
+                    self.launch(context)
+        return self
+
+    def capacity(self, context: CustomerProfile) -> int:
+        # Chrome locks its user data directory: a second browser on it would fail to start
+        return 1 if context.chrome_profile_path else self.size
+
+    def live(self, context: CustomerProfile) -> int:
+        options = browser_options(context)
+        return sum(browser_options(c) == options for c in [*self.owners.values(), *self.launching])
+
+    def can_launch(self, context: CustomerProfile) -> bool:
+        """Called with the lock held"""
+        total = len(self.owners) + len(self.launching)
+        return total < self.size and self.live(context) < self.capacity(context)
+
+    def launch(self, context: CustomerProfile):
+        """Called with the lock held"""
+        self.launching.append(context)
+        threading.Thread(
+            target=self._launch, args=(context,), name="driver-pool-launch", daemon=True
+        ).start()
+
+    def _launch(self, context: CustomerProfile):
+        delay = self.launch_retry
+        driver = None
+        while not self.closed:
+            try:
+                driver = self.driver_factory(context)
+                break
+            except Exception as e:
+                logging.error(f"[DriverPool] Unable to launch browser, retrying in {delay}s: {e}")
+                self.stopped.wait(delay)
+                delay = min(delay * 2, LAUNCH_RETRY_MAX)
+
+        warm = driver is not None and self.warm_up(driver, context)
+        with self.cond:
+            self.launching.remove(context)
+            if driver is not None and not self.closed:
+                self.owners[id(driver)] = context
+                self.uses[id(driver)] = 0
+                if warm:
+                    self.warm.add(id(driver))
+                self.idle.append(driver)
+                driver = None
+            self.cond.notify_all()
+        if driver is not None:
+            driver.quit()
+
+    def warm_up(self, driver, context: CustomerProfile) -> bool:
+        """Pay the slow first load once, before anyone is waiting for the browser. A failure only
+        leaves the browser cold"""
+        fast_forward_url, _ = fast_forward_urls(context)
+        try:
+            driver.delete_all_cookies()
+            driver.set_page_load_timeout(WARM_UP_TIMEOUT)
+            driver.get(fast_forward_url)
+            driver.execute_script("window.localStorage.clear();")
+            driver.execute_script("window.sessionStorage.clear();")
+            return True
+        except Exception as e:
+            logging.error(f"[DriverPool] Warm-up failed, browser kept cold: {e}")
+            return False
+        finally:
+            try:
+                driver.set_page_load_timeout(50)
+            except Exception:
+                pass
+
+    @staticmethod
+    def healthy(driver) -> bool:
+        try:
+            driver.execute_script("return document.readyState")
+            return len(driver.window_handles) > 0
+        except WebDriverException:
+            return False
+
+    def take(self, context: CustomerProfile):
+        """An idle browser for the profile, launching or swapping one in if there is none.
+        Called with the lock held"""
+        if self.closed:
+            return None
+        options = browser_options(context)
+        for driver in self.idle:
+            if browser_options(self.owners[id(driver)]) == options:
+                self.idle.remove(driver)
+                return driver
+
+        if any(browser_options(c) == options for c in self.launching):
+            return None
+        if self.can_launch(context):
+            self.launch(context)
+        elif self.idle and self.live(context) < self.capacity(context):
+            # Full of browsers for other profiles: an idle one makes room
+            stale = self.idle.pop(0)
+            self.forget(stale)
+            threading.Thread(target=quit_driver, args=(stale,), daemon=True).start()
+            self.launch(context)
+        return None
+
+    def acquire(self, context: Optional[CustomerProfile] = None, timeout: float = ACQUIRE_TIMEOUT):
+        """A healthy browser for the profile, TimeoutError if none is ready in time"""
+        context = context or self.profiles[0]
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.cond:
+                while True:
+                    driver = self.take(context)
+                    if driver is not None:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self.closed:
+                        raise TimeoutError(f"[DriverPool] No browser ready after {timeout}s")
+                    self.cond.wait(remaining)
+            if self.healthy(driver):
+                break
+            self.discard(driver)
+
+        with self.cond:
+            warm = id(driver) in self.warm
+        context.first_load = not warm
+        return driver
+
+    def check(self, driver, context: Optional[CustomerProfile] = None):
+        """Count one use of the driver, swapping it for a fresh one if it is worn out or dead, or
+        for another one if it was launched with other options than the profile's"""
+        context = context or self.profiles[0]
+        with self.cond:
+            self.uses[id(driver)] = self.uses.get(id(driver), 0) + 1
+            worn_out = self.uses[id(driver)] > self.max_uses
+            owner = self.owners.get(id(driver))
+
+        if owner is not None and browser_options(owner) != browser_options(context):
+            self.release(driver)
+            return self.acquire(context)
+        if not worn_out and self.healthy(driver):
+            return driver
+
+        logging.info("[DriverPool] Recycling browser")
+        self.discard(driver)
+        return self.acquire(context)
+
+    def release(self, driver):
+        if self.closed or not self.healthy(driver):
+            self.discard(driver)
+            return
+
+        try:
+            self.wipe(driver)
+        except WebDriverException:
+            self.discard(driver)
+            return
+        with self.cond:
+            self.idle.append(driver)
+            self.cond.notify_all()
+
+    def wipe(self, driver):
+        """Deletes the browser's cookies: its session is gone, so the next load is a cold one"""
+        driver.delete_all_cookies()
+        with self.cond:
+            self.warm.discard(id(driver))
+
+    def forget(self, driver) -> Optional[CustomerProfile]:
+        """Called with the lock held"""
+        self.uses.pop(id(driver), None)
+        self.warm.discard(id(driver))
+        return self.owners.pop(id(driver), None)
+
+    def discard(self, driver):
+        with self.cond:
+            context = self.forget(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self.cond:
+            if not self.closed and context is not None and self.can_launch(context):
+                self.launch(context)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.stopped.set()
+            idle, self.idle = self.idle, []
+            for driver in idle:
+                self.forget(driver)
+            self.cond.notify_all()
+        for driver in idle:
+            try:
+                driver.quit()
+            except Exception:
+                pass
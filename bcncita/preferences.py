@@ -0,0 +1,132 @@
+import re
+from dataclasses import dataclass, field
+from datetime import date, datetime as dt
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+__all__ = ["SlotMatcher"]
+
+DATE_FORMAT = "%d/%m/%Y"
+DATE_PATTERN = re.compile(r"\d{2}/\d{2}/\d{4}")
+TIME_PATTERN = re.compile(r"\b(\d{1,2}):(\d{2})\b")
+MINUTES_PER_DAY = 24 * 60
+
+
+@lru_cache(maxsize=1024)
+def parse_date(text: str) -> Optional[date]:
+    found = DATE_PATTERN.search(text)
+    return dt.strptime(found.group(0), DATE_FORMAT).date() if found else None
+
+
+@lru_cache(maxsize=1024)
+def parse_minutes(text: str) -> Optional[int]:
+    found = TIME_PATTERN.search(text)
+    return int(found.group(1)) * 60 + int(found.group(2)) if found else None
+
+
+def office_value(office: Any) -> str:
+    """Office members and plain office ids ("16") alike"""
+    return str(getattr(office, "value", office))
+
+
+@dataclass
+class SlotMatcher:
+    """Profile slot constraints compiled once: date windows, time windows, weekdays and offices"""
+
+    date_windows: List[Tuple[int, int]] = field(default_factory=list)  # date ordinals, inclusive
+    minutes: Optional[bytearray] = None  # 1 for every accepted minute of the day, None = any
+    weekdays: Optional[FrozenSet[int]] = None  # 0 = Monday
+    office_rank: Dict[str, int] = field(default_factory=dict)
+    excluded_offices: FrozenSet[str] = frozenset()
+    _dates: Dict[date, bool] = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_profile(cls, context: Any) -> "SlotMatcher":
+        date_windows = list(context.date_windows or [])
+        if context.min_date or context.max_date:
+            date_windows.append([context.min_date, context.max_date])
+        time_windows = list(context.time_windows or [])
+        if context.min_time or context.max_time:
+            time_windows.append([context.min_time, context.max_time])
+
+        minutes = None
+        if time_windows:
+            minutes = bytearray(MINUTES_PER_DAY)
+            for start, end in time_windows:
+                first = parse_minutes(start) if start else 0
+                last = parse_minutes(end) if end else MINUTES_PER_DAY - 1
+                minutes[first : last + 1] = b"\x01" * (last + 1 - first)  # type: ignore
+
+        return cls(
+            date_windows=[
+                (
+                    parse_date(start).toordinal() if start else date.min.toordinal(),  # type: ignore
+                    parse_date(end).toordinal() if end else date.max.toordinal(),  # type: ignore
+                )
+                for start, end in date_windows
+            ],
+            minutes=minutes,
+            weekdays=frozenset(context.weekdays) if context.weekdays else None,
+            office_rank={office_value(o): i for i, o in enumerate(context.offices or [])},
+            excluded_offices=frozenset(office_value(o) for o in (context.except_offices or [])),
+        )
+
+    def accepts_date(self, day: date) -> bool:
+        accepted = self._dates.get(day)
+        if accepted is None:
+            ordinal = day.toordinal()
+            accepted = (
+                not self.date_windows
+                or any(start <= ordinal <= end for start, end in self.date_windows)
+            ) and (self.weekdays is None or day.weekday() in self.weekdays)
+            self._dates[day] = accepted
+        return accepted
+
+    def accepts_time(self, minute: Optional[int]) -> bool:
+        return self.minutes is None or minute is None or bool(self.minutes[minute])
+
+    def accepts_office(self, office: Optional[str]) -> bool:
+        return office is None or office not in self.excluded_offices
+
+    def office_score(self, office: Optional[str]) -> int:
+        """Position in the preferred offices list, unlisted offices come last"""
+        return self.office_rank.get(office, len(self.office_rank)) if office else 0
+
+    def rank_offices(self, offices: List[str]) -> Tuple[List[str], List[str]]:
+        """Offered offices split into the preferred ones, best first, and the others not excluded"""
+        preferred = sorted((o for o in offices if o in self.office_rank), key=self.office_score)
+        others = [o for o in offices if o not in self.office_rank and self.accepts_office(o)]
+        return preferred, others
+
+    def best_label(self, labels: List[str]) -> Optional[int]:
+        """Index of the best "CITA n: Día dd/mm/yyyy a las hh:mm" style label"""
+        best, best_score = None, None
+        for idx, label in enumerate(labels):
+            day = parse_date(label)
+            minute = parse_minutes(label)
+            if day is None or not self.accepts_date(day) or not self.accepts_time(minute):
+                continue
+            score = (day, minute or 0)
+            if best_score is None or score < best_score:
+                best, best_score = idx, score
+        return best
+
+    def best_slot(self, grid: dict, office: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """Earliest acceptable (date, HUECO id) of a grid read with SLOT_GRID_JS"""
+        if not self.accepts_office(office):
+            return None
+
+        columns = [(text, parse_date(text)) for text in grid["dates"]]
+        accepted = [day is not None and self.accepts_date(day) for _, day in columns]
+        best, best_score = None, None
+        for appt_time, cells in grid["rows"]:
+            minute = parse_minutes(appt_time)
+            if not self.accepts_time(minute):
+                continue
+            for (text, day), ok, slot in zip(columns, accepted, cells):
+                if not slot or not ok:
+                    continue
+                score = (day, minute or 0)
+                if best_score is None or score < best_score:
+                    best, best_score = (text, slot), score
+        return best
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Hashable, Optional
+
+__all__ = ["EndpointUnavailable", "RateController"]
+
+MIN_INTERVAL = 1.0  # seconds between requests to an endpoint at best
+START_INTERVAL = 5.0  # the old fixed refresh cadence
+MAX_INTERVAL = 60.0
+SLOW_FACTOR = 2.0  # responses this much slower than usual widen the interval
+FAILURE_THRESHOLD = 3  # consecutive failures that open the circuit
+COOLDOWN = 30.0  # first open period, doubles on every reopening
+MAX_COOLDOWN = 350.0  # the old fixed initial_page backoff
+
+
+class EndpointUnavailable(Exception):
+    """The endpoint rejected us or its circuit is open. ``retry_after`` is when to try again"""
+
+    def __init__(self, endpoint: Hashable, retry_after: float, wait: bool = True):
+        super().__init__(f"{endpoint} unavailable, retry in {retry_after:.0f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        self.wait = (
+            wait  # False: the caller has other work, hand the wait back instead of sleeping
+        )
+
+
+@dataclass
+class EndpointState:
+    interval: float = START_INTERVAL
+    latency: float = 0  # moving average of successful responses, seconds
+    next_slot: float = 0  # monotonic time the next request may go out
+    failures: int = 0  # consecutive
+    opened: int = 0  # consecutive circuit openings
+    open_until: float = 0
+
+
+class RateController:
+    """Shared pacing and circuit breaker per endpoint (province, operation category).
+
+    Successes narrow the interval between requests, slow responses and error pages widen it,
+    and a run of failures opens the circuit for every worker hitting the same endpoint."""
+
+    def __init__(
+        self,
+        start_interval: float = START_INTERVAL,
+        min_interval: float = MIN_INTERVAL,
+        max_interval: float = MAX_INTERVAL,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        cooldown: float = COOLDOWN,
+        max_cooldown: float = MAX_COOLDOWN,
+    ):
+        self.start_interval = start_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.endpoints: Dict[Hashable, EndpointState] = {}
+        self.lock = threading.Lock()
+
+    def state(self, endpoint: Hashable) -> EndpointState:
+        with self.lock:
+            return self.endpoints.setdefault(endpoint, EndpointState(self.start_interval))
+
+    def acquire(self, endpoint: Hashable) -> float:
+        """Reserves the next request slot, returns the seconds to wait for it"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.endpoints.setdefault(endpoint, EndpointState(self.start_interval))
+            slot = max(now, state.next_slot, state.open_until)
+            state.next_slot = slot + state.interval
+            return slot - now
+
+    def retry_after(self, endpoint: Hashable) -> float:
+        """Seconds until the circuit closes, 0 when requests may go out"""
+        with self.lock:
+            state = self.endpoints.get(endpoint)
+            return max(0.0, state.open_until - time.monotonic()) if state else 0.0
+
+    def record(self, endpoint: Hashable, ok: bool, latency: Optional[float] = None):
+        with self.lock:
+            state = self.endpoints.setdefault(endpoint, EndpointState(self.start_interval))
+            if ok:
+                slow = (
+                    latency is not None and state.latency and latency > SLOW_FACTOR * state.latency
+                )
+                state.interval = (
+                    min(self.max_interval, state.interval * 1.25)
+                    if slow
+                    else max(self.min_interval, state.interval * 0.9)
+                )
+                if latency is not None:
+                    state.latency = (
+                        latency if not state.latency else 0.8 * state.latency + 0.2 * latency
+                    )
+                state.failures = state.opened = 0
+                return
+
+            state.interval = min(self.max_interval, state.interval * 2)
+            state.failures += 1
+            if state.failures >= self.failure_threshold:
+                cooldown = min(self.max_cooldown, self.cooldown * 2**state.opened)
+                state.open_until = time.monotonic() + cooldown
+                state.failures = 0
+                state.opened += 1
+                logging.error(f"[Rate] {endpoint} keeps failing, pausing it for {cooldown:.0f}s")
+
+    def backoff(self, endpoint: Hashable) -> float:
+        """How long to wait after a failure: the open circuit, otherwise the widened interval"""
+        return self.retry_after(endpoint) or self.state(endpoint).interval
+
+
+rate_controller = RateController()
@@ -0,0 +1,45 @@
+import gzip
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterator
+
+__all__ = ["SessionRecorder", "load_session"]
+
+
+@dataclass
+class Snapshot:
+    step: str
+    url: str
+    html: str
+    time: float = 0
+
+
+class SessionRecorder:
+    """Appends every visited page to a gzipped JSON lines archive: {time, step, url, html}"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, "at", encoding="utf-8")
+
+    def record(self, step: str, url: str, html: str):
+        line = json.dumps({"time": time.time(), "step": step, "url": url, "html": html})
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()  # keep the archive readable if the bot is killed
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_session(path: str) -> Iterator[Snapshot]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield Snapshot(**json.loads(line))
+        except (EOFError, ValueError):
+            pass  # archive of a killed bot: no gzip trailer or a cut last line
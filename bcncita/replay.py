@@ -0,0 +1,162 @@
+import argparse
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.common.by import By
+
+from .cita import (
+    CLASSIFY_JS,
+    DATE_SLOTS_JS,
+    SLOT_GRID_JS,
+    CustomerProfile,
+    DocType,
+    find_best_date_slots,
+    find_best_slot,
+    page_state,
+)
+from .page import Page, PageState, classify, date_slots, slot_grid
+from .poller import pick_office
+from .recorder import Snapshot, load_session
+
+__all__ = ["ReplayDriver", "replay_session"]
+
+
+class ReplayElement:
+    def __init__(self, attributes: Dict[str, str], text: str = ""):
+        self.attributes = attributes
+        self.text = text
+
+    def get_attribute(self, name: str) -> Optional[str]:
+        return self.attributes.get(name)
+
+
+class ReplayDriver:
+    """Stands in for the webdriver over a recorded page, for the read-only parts of the flow"""
+
+    def __init__(self, snapshot: Optional[Snapshot] = None):
+        self.snapshot: Optional[Snapshot] = None
+        self._page: Optional[Page] = None
+        if snapshot:
+            self.load(snapshot)
+
+    def load(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+        self._page = None
+
+    @property
+    def page(self) -> Page:
+        if self._page is None:
+            self._page = Page(self.page_source, self.current_url)
+        return self._page
+
+    @property
+    def current_url(self) -> str:
+        return self.snapshot.url if self.snapshot else ""
+
+    @property
+    def page_source(self) -> str:
+        return self.snapshot.html if self.snapshot else ""
+
+    def execute_script(self, script: str, *args) -> Any:
+        if script == SLOT_GRID_JS:
+            return slot_grid(self.page_source)
+        if script == DATE_SLOTS_JS:
+            return date_slots(self.page_source)
+        if script == CLASSIFY_JS:
+            return classify(self.page).value
+        raise NotImplementedError("No Python equivalent for this script")
+
+    def find_element(self, by: str = By.ID, value: str = "") -> ReplayElement:
+        if by == By.TAG_NAME and value == "body":
+            return ReplayElement({"tag": "body"}, self.page.text)
+        if by == By.ID and self.page.has(value):
+            return ReplayElement(self.page.elements[value])
+        raise NoSuchElementException(f"{by}={value} not in {self.current_url}")
+
+    def find_elements(self, by: str = By.ID, value: str = "") -> List[ReplayElement]:
+        try:
+            return [self.find_element(by, value)]
+        except NoSuchElementException:
+            return []
+
+
+@dataclass
+class Decision:
+    snapshot: Snapshot
+    kind: str  # "office", "grid", "list" or "" when the page has nothing to decide
+    choice: Any = None
+    state: PageState = PageState.UNKNOWN
+
+
+def decide(driver: ReplayDriver, context: CustomerProfile) -> Decision:
+    """What the bot would pick on the loaded page"""
+    snapshot = driver.snapshot
+    state = page_state(driver)
+    grid = driver.execute_script(SLOT_GRID_JS)
+    if grid:
+        return Decision(snapshot, "grid", find_best_slot(grid, context), state)  # type: ignore
+    if driver.page.has("lCita_1"):
+        return Decision(snapshot, "list", find_best_date_slots(driver, context), state)  # type: ignore
+    form = driver.page.form_with("idSede")
+    if driver.page.has("idSede") and form:
+        context.current_office = pick_office(form, context)
+        return Decision(snapshot, "office", context.current_office, state)  # type: ignore
+    return Decision(snapshot, "", state=state)  # type: ignore
+
+
+def replay_session(path: str, context: CustomerProfile) -> List[Decision]:
+    """Feeds a recorded session through the same slot and office choices the bot makes"""
+    driver = ReplayDriver()
+    decisions = []
+    for snapshot in load_session(path):
+        driver.load(snapshot)
+        decisions.append(decide(driver, context))
+    return decisions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded session and time parsing")
+    parser.add_argument("session", help="Archive written with record_session")
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--min-date")
+    parser.add_argument("--max-date")
+    parser.add_argument("--min-time")
+    parser.add_argument("--max-time")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+
+    context = CustomerProfile(
+        name="REPLAY",
+        doc_type=DocType.PASSPORT,
+        doc_value="0",
+        phone="0",
+        email="replay@localhost",
+        min_date=args.min_date,
+        max_date=args.max_date,
+        min_time=args.min_time,
+        max_time=args.max_time,
+    )
+    snapshots = list(load_session(args.session))
+    driver = ReplayDriver()
+    for snapshot in snapshots:
+        driver.load(snapshot)
+        decision = decide(driver, context)
+        if not decision.kind:
+            continue
+
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            driver.load(snapshot)
+            decide(driver, context)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        print(
+            f"{snapshot.step:<20} {decision.kind:<6} {elapsed * 1e6:>9.0f} us"
+            f"  {len(snapshot.html):>7} bytes  -> {decision.choice}"
+        )
+
+
+if __name__ == "__main__":
+    main()
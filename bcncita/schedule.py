@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime as dt
+from typing import Any, Dict, List, Optional
+
+from .preferences import office_value
+
+__all__ = ["AdaptiveScheduler", "ReleaseModel"]
+
+BUCKET_MINUTES = 10
+BUCKETS = 7 * 24 * 60 // BUCKET_MINUTES  # 10 minute buckets of the week, 0 = Monday 00:00
+SAVE_INTERVAL = 60  # seconds between model writes, hits are written at once
+
+
+def bucket_of(when: dt) -> int:
+    return (when.weekday() * 24 * 60 + when.hour * 60 + when.minute) // BUCKET_MINUTES
+
+
+def seconds_to_bucket(when: dt, ahead: int) -> float:
+    """Seconds from ``when`` to the start of the bucket ``ahead`` buckets later"""
+    into = (when.minute % BUCKET_MINUTES) * 60 + when.second + when.microsecond / 1e6
+    return ahead * BUCKET_MINUTES * 60 - into
+
+
+def release_keys(context: Any, office: Optional[str] = None) -> List[str]:
+    """Model keys of a profile: province/operation, plus province/operation/office if known"""
+    key = f"{context.province.value}/{context.operation_code.value}"
+    return [key, f"{key}/{office}"] if office else [key]
+
+
+class ReleaseModel:
+    """Attempts and selection hits per week bucket, per province/operation(/office), kept in JSON"""
+
+    def __init__(self, path: Optional[str] = None, save_interval: float = SAVE_INTERVAL):
+        self.path = path
+        self.save_interval = save_interval
+        # key -> {"attempts": [per bucket], "hits": [per bucket]}
+        self.stats: Dict[str, Dict[str, List[int]]] = {}
+        self.lock = threading.Lock()
+        self._saved_at = time.monotonic()
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:  # type: ignore
+                stats = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Release model {self.path}: {e}")
+            return
+        with self.lock:
+            self.stats = {
+                key: value
+                for key, value in stats.items()
+                if len(value.get("attempts", ())) == BUCKETS
+                and len(value.get("hits", ())) == BUCKETS
+            }
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps(self.stats)
+            self._saved_at = time.monotonic()
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def observe(self, keys: List[str], hit: bool, when: Optional[dt] = None):
+        bucket = bucket_of(when or dt.now())
+        with self.lock:
+            for key in keys:
+                stats = self.stats.setdefault(
+                    key, {"attempts": [0] * BUCKETS, "hits": [0] * BUCKETS}
+                )
+                stats["attempts"][bucket] += 1
+                stats["hits"][bucket] += int(hit)
+            due = hit or time.monotonic() - self._saved_at > self.save_interval
+        if due:
+            try:
+                self.save()
+            except OSError as e:
+                logging.error(f"Release model {self.path}: {e}")
+
+    def attempts(self, key: str) -> int:
+        stats = self.stats.get(key)
+        return sum(stats["attempts"]) if stats else 0
+
+    def rate(self, key: str, bucket: Optional[int] = None) -> float:
+        """Smoothed hit rate of a bucket and its neighbours, or of the whole week without a bucket"""
+        stats = self.stats.get(key)
+        if not stats:
+            return 0
+        if bucket is None:
+            attempts, hits = sum(stats["attempts"]), sum(stats["hits"])
+        else:
+            near = [(bucket + i) % BUCKETS for i in (-1, 0, 1)]
+            attempts = sum(stats["attempts"][b] for b in near)
+            hits = sum(stats["hits"][b] for b in near)
+        baseline = (sum(stats["hits"]) + 1) / (sum(stats["attempts"]) + 2)
+        return (hits + baseline) / (attempts + 1)  # pulled towards the weekly rate when unsure
+
+
+class AdaptiveScheduler:
+    """Paces attempts by the learned release times: full speed in hot windows, sparse probes in dead
+    hours so the model keeps learning"""
+
+    def __init__(
+        self,
+        model: ReleaseModel,
+        min_attempts: int = 200,  # observations needed before the model is trusted
+        dead_ratio: float = 0.2,  # buckets under this share of the weekly rate are dead hours
+        idle_pause: float = 30,  # max pause in lukewarm buckets
+        max_pause: float = 900,  # longest sleep in dead hours, one probe attempt after it
+    ):
+        self.model = model
+        self.min_attempts = min_attempts
+        self.dead_ratio = dead_ratio
+        self.idle_pause = idle_pause
+        self.max_pause = max_pause
+
+    def observe(self, context: Any, hit: bool):
+        self.model.observe(release_keys(context, context.current_office), hit)
+
+    def key(self, context: Any) -> Optional[str]:
+        """Most specific key with enough data: the first preferred office, then province/operation"""
+        office = office_value(context.offices[0]) if context.offices else None
+        for key in reversed(release_keys(context, office)):
+            if self.model.attempts(key) >= self.min_attempts:
+                return key
+        return None
+
+    def delay(self, context: Any, now: Optional[dt] = None) -> float:
+        key = self.key(context)
+        if key is None:
+            return 0
+
+        now = now or dt.now()
+        bucket = bucket_of(now)
+        baseline = self.model.rate(key)
+        ratio = self.model.rate(key, bucket) / baseline
+        if ratio >= 1:
+            return 0
+        if ratio >= self.dead_ratio:
+            return self.idle_pause * (1 - ratio)
+
+        for ahead in range(1, BUCKETS):
+            if seconds_to_bucket(now, ahead) >= self.max_pause:
+                break
+            if self.model.rate(key, (bucket + ahead) % BUCKETS) >= self.dead_ratio * baseline:
+                return seconds_to_bucket(now, ahead)
+        return self.max_pause
+
+
+_models: Dict[str, ReleaseModel] = {}
+_models_lock = threading.Lock()
+
+
+def release_model(path: str) -> ReleaseModel:
+    """One shared model per file, so profiles of the same province and operation learn together"""
+    with _models_lock:
+        if path not in _models:
+            _models[path] = ReleaseModel(path)
+        return _models[path]
@@ -0,0 +1,401 @@
+import argparse
+import hashlib
+import html
+import random
+import secrets
+import string
+import threading
+import time
+from base64 import b64encode
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from .captcha import ImageCaptchaAnswer, ImageCaptchaBackend
+
+__all__ = ["FakeImageBackend", "Scenario", "Simulator"]
+
+COUNTRIES = ["ALBANIA", "ARGENTINA", "CHINA", "RUSIA", "UCRANIA", "VENEZUELA"]
+OFFICES = ["14", "16", "18", "27"]
+
+NO_CITAS = "En este momento no hay citas disponibles."
+REJECTED = "The requested URL was rejected. Please consult with your administrator."
+
+LAYOUT = """<!DOCTYPE html>
+<html><head><title>Cita Previa Simulator</title>
+<script>
+function submitForm(action) {{
+  const form = document.forms[0];
+  if (action) {{ form.action = action; }}
+  form.submit();
+}}
+{script}
+</script></head>
+<body><h1>INTERNET CITA PREVIA</h1>
+{body}
+</body></html>"""
+
+
+@dataclass
+class Scenario:
+    """What the simulated site does. ``outcomes`` is consumed one entry per acCitar request
+    ("offices", "no_citas", "no_offices" or "error") and ``slot_outcomes`` one entry per
+    acOfertarCita request ("grid", "list" or "none"); when exhausted the probabilities apply."""
+
+    offices: float = 1.0  # probability of getting the office selection page
+    slots: float = 1.0  # probability of getting the slots page after contact info
+    error_rate: float = 0.0  # probability of a rejected (throttled) page on any request
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # random extra seconds added to every response
+    captcha: Optional[str] = None  # None, "recaptcha" or "image"
+    slot_page: str = "grid"  # "grid" (CitaMAP_HORAS) or "list" (lCita_ radios)
+    sms_code: bool = False  # ask for an SMS code on the confirmation page
+    office_ids: List[str] = field(default_factory=lambda: list(OFFICES))
+    full_offices: List[str] = field(default_factory=list)  # offices that never offer slots
+    dates: List[str] = field(default_factory=lambda: ["21/03/2023", "22/03/2023", "23/03/2023"])
+    times: List[str] = field(default_factory=lambda: ["09:00", "09:10", "10:20", "12:40"])
+    outcomes: List[str] = field(default_factory=list)
+    slot_outcomes: List[str] = field(default_factory=list)
+
+
+class Simulator:
+    def __init__(
+        self, scenario: Optional[Scenario] = None, host: str = "127.0.0.1", port: int = 0
+    ):
+        self.scenario = scenario or Scenario()
+        self.requests: Counter = Counter()  # page -> count
+        self.captcha_answers: Dict[str, str] = {}  # sha1 of image bytes -> text
+        self.sessions: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{str(host)}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="icp-simulator", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _next(self, scripted: List[str], probability: float, hit: str, miss: str) -> str:
+        with self.lock:
+            if scripted:
+                return scripted.pop(0)
+        return hit if random.random() < probability else miss
+
+    def _handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.respond({})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode("utf-8")
+                self.respond({k: v[-1] for k, v in parse_qs(body).items()})
+
+            def respond(self, form: Dict[str, str]):
+                url = urlparse(self.path)
+                page = url.path.rstrip("/").split("/")[-1]
+                form.update({k: v[-1] for k, v in parse_qs(url.query).items()})
+                status, content, cookie = simulator.render(page, form, self.headers.get("Cookie"))
+
+                delay = simulator.scenario.latency + random.random() * simulator.scenario.jitter
+                if delay:
+                    time.sleep(delay)
+
+                data = content.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                if cookie:
+                    self.send_header("Set-Cookie", f"JSESSIONID={cookie}; Path=/")
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def _session(self, cookie_header: Optional[str]) -> Optional[dict]:
+        for part in (cookie_header or "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "JSESSIONID":
+                return self.sessions.get(value)
+        return None
+
+    def render(self, page: str, form: Dict[str, str], cookie_header: Optional[str]):
+        with self.lock:
+            self.requests[page] += 1
+
+        if random.random() < self.scenario.error_rate:
+            return 200, f"<html><body>{REJECTED}</body></html>", None
+
+        if page == "citar":
+            token = secrets.token_hex(8)
+            with self.lock:
+                self.sessions[token] = {}
+            return 200, LAYOUT.format(script="", body="<p>Cita previa</p>"), token
+
+        session = self._session(cookie_header)
+        if session is None:
+            return 200, "<html><body>Su sesión ha caducado.</body></html>", None
+
+        renderer = getattr(self, f"page_{page}", None)
+        if renderer is None:
+            return 404, "<html><body>Not found</body></html>", None
+        script, body = renderer(form, session)
+        return 200, LAYOUT.format(script=script, body=body), None
+
+    def page_acInfo(self, form, session):
+        return "", (
+            '<form action="acEntrada" method="post">'
+            "<p>Información del trámite</p>"
+            '<input type="button" id="btnEntrar" value="Entrar" onclick="submitForm()">'
+            "</form>"
+        )
+
+    def page_acEntrada(self, form, session):
+        countries = "".join(f'<option value="{i}">{c}</option>' for i, c in enumerate(COUNTRIES))
+        return "", (
+            '<form action="acValidarEntrada" method="post">'
+            '<input type="radio" id="rdbTipoDocNie" name="rdbTipoDoc" value="N.I.E." checked>'
+            '<input type="radio" id="rdbTipoDocPas" name="rdbTipoDoc" value="PASAPORTE">'
+            '<input type="radio" id="rdbTipoDocDni" name="rdbTipoDoc" value="D.N.I.">'
+            '<input type="text" id="txtIdCitado" name="txtIdCitado">'
+            '<input type="text" id="txtDesCitado" name="txtDesCitado">'
+            '<input type="text" id="txtAnnoCitado" name="txtAnnoCitado">'
+            f'<select id="txtPaisNac" name="txtPaisNac"><option value="">Seleccionar</option>{countries}</select>'
+            '<input type="button" id="btnEnviar" value="Aceptar" onclick="submitForm()">'
+            "</form>"
+        )
+
+    def page_acValidarEntrada(self, form, session):
+        session["person"] = {k: v for k, v in form.items() if k.startswith(("txt", "rdb"))}
+        script = (
+            "function enviar(op) { submitForm(op === 'solicitud' ? 'acCitar' : 'acConsultar'); }"
+        )
+        return script, (
+            '<form action="acCitar" method="post">'
+            '<input type="button" id="btnEnviar" value="Solicitar Cita" onclick="enviar(\'solicitud\')">'
+            '<input type="button" id="btnConsultar" value="Consultar" onclick="enviar(\'consulta\')">'
+            "</form>"
+        )
+
+    def page_acCitar(self, form, session):
+        outcome = self._next(self.scenario.outcomes, self.scenario.offices, "offices", "no_citas")
+        if outcome == "no_citas":
+            return "", f"<p>{NO_CITAS}</p>"
+        if outcome == "no_offices":
+            return "", "<p>No hay oficinas disponibles para el trámite seleccionado.</p>"
+        if outcome == "error":
+            return "", f"<p>{REJECTED}</p>"
+
+        options = "".join(
+            f'<option value="{o}">Oficina {o}</option>' for o in self.scenario.office_ids
+        )
+        return "", (
+            "<p>Seleccione la oficina donde solicitar la cita</p>"
+            '<form action="acVerFormulario" method="post">'
+            f'<select id="idSede" name="idSede"><option value="">Seleccionar</option>{options}</select>'
+            '<input type="button" id="btnSiguiente" value="Siguiente" onclick="submitForm()">'
+            "</form>"
+        )
+
+    def page_acVerFormulario(self, form, session):
+        session["office"] = form.get("idSede")
+        script = "function enviar() { submitForm('acOfertarCita'); }"
+        return script, (
+            '<form action="acOfertarCita" method="post">'
+            '<input type="text" id="txtTelefonoCitado" name="txtTelefonoCitado">'
+            '<input type="text" id="emailUNO" name="emailUNO">'
+            '<input type="text" id="emailDOS" name="emailDOS">'
+            '<textarea id="txtObservaciones" name="txtObservaciones"></textarea>'
+            '<input type="button" id="btnSiguiente" value="Siguiente" onclick="enviar()">'
+            "</form>"
+        )
+
+    def captcha(self, session) -> str:
+        if self.scenario.captcha == "recaptcha":
+            return (
+                '<input type="hidden" id="reCAPTCHA_site_key" value="simulator-site-key">'
+                '<input type="hidden" id="action" value="cita">'
+                '<input type="hidden" id="g-recaptcha-response" name="g-recaptcha-response">'
+            )
+        if self.scenario.captcha == "image":
+            answer = "".join(random.choice(string.ascii_lowercase) for _ in range(5))
+            image = b"SIMULATED-CAPTCHA-" + secrets.token_bytes(8)
+            with self.lock:
+                self.captcha_answers[hashlib.sha1(image).hexdigest()] = answer
+            session["captcha"] = answer
+            src = "data:image/png;base64," + b64encode(image).decode("ascii")
+            return (
+                f'<img id="captcha-image" class="img-thumbnail" src="{src}">'
+                '<input type="text" id="captcha" name="captcha">'
+            )
+        return ""
+
+    def page_acOfertarCita(self, form, session):
+        session["contact"] = {k: v for k, v in form.items() if k.startswith(("txt", "email"))}
+        if session.get("office") in self.scenario.full_offices:
+            outcome = "none"
+        else:
+            outcome = self._next(
+                self.scenario.slot_outcomes, self.scenario.slots, self.scenario.slot_page, "none"
+            )
+        if outcome == "none":
+            return "", f"<p>{NO_CITAS}</p>"
+
+        if outcome == "list":
+            script = "function envia() { if (confirm('¿Confirma la cita?')) { submitForm(); } }"
+            items = "".join(
+                f'<input type="radio" name="rdbCita" value="{i}">'
+                f'<span id="lCita_{i}">CITA {i}: Día {d} a las {t}</span><br>'
+                for i, (d, t) in enumerate(zip(self.scenario.dates, self.scenario.times), start=1)
+            )
+            return script, (
+                "<p>DISPONE DE 5 MINUTOS PARA CONFIRMAR LA CITA</p>"
+                f'<form action="acVerificarCita" method="post">{self.captcha(session)}{items}'
+                '<input type="button" id="btnSiguiente" value="Siguiente" onclick="envia()">'
+                "</form>"
+            )
+
+        script = (
+            "function confirmarHueco(obj, id) {"
+            "  document.getElementById('txtIdHueco').value = id;"
+            "  if (confirm('¿Confirma la cita?')) { submitForm(); }"
+            "}"
+        )
+        header = "".join(f'<th class="colFecha">{d}</th>' for d in self.scenario.dates)
+        rows = ""
+        for r, appt_time in enumerate(self.scenario.times):
+            cells = ""
+            for c in range(len(self.scenario.dates)):
+                if (r + c) % 2 == 0:
+                    hueco = 1000 + r * 10 + c
+                    cells += f'<td><span id="HUECO{hueco}">Libre</span></td>'
+                else:
+                    cells += "<td></td>"
+            rows += f"<tr><th>{appt_time}</th>{cells}</tr>"
+        return script, (
+            "<p>Seleccione una de las siguientes citas disponibles</p>"
+            f'<form action="acVerificarCita" method="post">{self.captcha(session)}'
+            '<input type="hidden" id="txtIdHueco" name="txtIdHueco">'
+            f'<table id="CitaMAP_HORAS"><thead><tr><th></th>{header}</tr></thead>'
+            f"<tbody>{rows}</tbody></table>"
+            "</form>"
+        )
+
+    def page_acVerificarCita(self, form, session):
+        expected = session.pop("captcha", None)
+        if expected and form.get("captcha") != expected:
+            return "", "<p>El código de seguridad introducido no es correcto.</p>"
+        session["slot"] = form.get("txtIdHueco") or form.get("rdbCita")
+
+        sms = (
+            '<input type="text" id="txtCodigoVerificacion" name="txtCodigoVerificacion">'
+            if self.scenario.sms_code
+            else ""
+        )
+        return "", (
+            "<p>Debe confirmar los datos de la cita asignada</p>"
+            '<form action="acGrabarCita" method="post">'
+            '<input type="checkbox" id="chkTotal" name="chkTotal">'
+            '<input type="checkbox" id="enviarCorreo" name="enviarCorreo">'
+            f"{sms}"
+            '<input type="button" id="btnConfirmar" value="Confirmar" onclick="submitForm()">'
+            "</form>"
+        )
+
+    def page_acGrabarCita(self, form, session):
+        code = html.escape(secrets.token_hex(6).upper())
+        session["booked"] = code
+        return "", (
+            "<p>CITA CONFIRMADA Y GRABADA</p>"
+            f'<p>Justificante de cita: <span id="justificanteFinal">{code}</span></p>'
+            '<input type="button" id="btnImprimir" value="Imprimir">'
+        )
+
+
+class FakeImageBackend(ImageCaptchaBackend):
+    """Answers the simulator's image captchas after a delay, wrong with the given probability"""
+
+    def __init__(
+        self, simulator: Simulator, name: str = "fake", delay: float = 0, error_rate: float = 0
+    ):
+        self.simulator = simulator
+        self.name = name
+        self.delay = delay
+        self.error_rate = error_rate
+        self.reported: List[ImageCaptchaAnswer] = []
+
+    def solve(self, image: bytes, cancelled: threading.Event) -> Optional[ImageCaptchaAnswer]:
+        if cancelled.wait(self.delay):
+            return None
+        answer = self.simulator.captcha_answers.get(hashlib.sha1(image).hexdigest())
+        if answer is None:
+            return None
+        if random.random() < self.error_rate:
+            answer = answer[::-1] + "x"
+        return ImageCaptchaAnswer(answer, self)
+
+    def report_incorrect(self, answer: ImageCaptchaAnswer):
+        self.reported.append(answer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local ICP cita previa simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--offices", type=float, default=1.0)
+    parser.add_argument("--slots", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--captcha", choices=["recaptcha", "image"])
+    parser.add_argument("--slot-page", choices=["grid", "list"], default="grid")
+    parser.add_argument("--sms-code", action="store_true")
+    args = parser.parse_args()
+
+    scenario = Scenario(
+        offices=args.offices,
+        slots=args.slots,
+        error_rate=args.error_rate,
+        latency=args.latency,
+        jitter=args.jitter,
+        captcha=args.captcha,
+        slot_page=args.slot_page,
+        sms_code=args.sms_code,
+    )
+    simulator = Simulator(scenario, host=args.host, port=args.port)
+    print(f"Serving ICP simulator on {simulator.url}, set icp_url to it")
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+__all__ = ["SmsReceiver"]
+
+SMS_CODE_PATTERN = re.compile("CODIGO (.*), DE")
+TOKEN_ENV = "CITA_SMS_TOKEN"
+
+
+def find_code(text: str) -> Optional[str]:
+    match = SMS_CODE_PATTERN.search(text or "")
+    return match.group(1) if match else None
+
+
+def flatten(node) -> list:
+    if isinstance(node, dict):
+        return [v for value in node.values() for v in flatten(value)]
+    if isinstance(node, list):
+        return [v for value in node for v in flatten(value)]
+    return [str(node)]
+
+
+def message_text(body: bytes, content_type: str) -> str:
+    """Whatever an SMS forwarder posted, flattened to text: JSON values, form values or raw body"""
+    raw = body.decode("utf-8", errors="replace")
+    if "json" in content_type:
+        try:
+            return "\n".join(flatten(json.loads(raw)))
+        except ValueError:
+            pass
+    if "x-www-form-urlencoded" in content_type:
+        return "\n".join(v for values in parse_qs(raw).values() for v in values)
+    return raw
+
+
+class SmsReceiver:
+    """Local webhook SMS forwarders POST to: http://host:port/<token>/<phone> (or /<token>/ for
+    any profile). The token is a shared secret, posts without it are refused"""
+
+    def __init__(self, token: str, host: str = "127.0.0.1", port: int = 0):
+        if not token:
+            raise ValueError("An SMS receiver token is required")
+        self.token = token
+        self.host = host
+        self.codes: Dict[str, str] = {}  # phone ("" = not addressed) -> code
+        self.cond = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{str(host)}:{port}"
+
+    def start(self):
+        threading.Thread(
+            target=self.server.serve_forever, name="sms-receiver", daemon=True
+        ).start()
+        logging.info(f"SMS receiver listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                secret, _, phone = self.path.split("?")[0].strip("/").partition("/")
+                if not hmac.compare_digest(secret.encode(), receiver.token.encode()):
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                text = message_text(self.rfile.read(length), self.headers.get("Content-Type", ""))
+                code = find_code(text)
+                if code:
+                    receiver.deliver(phone.strip("/"), code)
+                self.send_response(200 if code else 202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        return Handler
+
+    def deliver(self, phone: str, code: str):
+        with self.cond:
+            self.codes[phone] = code
+            self.cond.notify_all()
+
+    def arm(self, phone: str):
+        """Forget stale codes; call before the page that triggers the SMS is loaded"""
+        with self.cond:
+            self.codes.pop(phone, None)
+            self.codes.pop("", None)
+
+    def wait(self, phone: str, timeout: float) -> Optional[str]:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                code = self.codes.pop(phone, None) or self.codes.pop("", None)
+                if code:
+                    return code
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+
+_receivers: Dict[int, SmsReceiver] = {}
+_receivers_lock = threading.Lock()
+
+
+def sms_receiver(port: int, token: Optional[str] = None, host: str = "127.0.0.1") -> SmsReceiver:
+    """One shared receiver per port, profiles are told apart by phone number"""
+    token = token or os.environ.get(TOKEN_ENV)
+    if not token:
+        raise ValueError(f"Set sms_receiver_token or {TOKEN_ENV} to use sms_receiver_port")
+    with _receivers_lock:
+        if port not in _receivers:
+            _receivers[port] = SmsReceiver(token, host, port).start()
+        receiver = _receivers[port]
+    if (receiver.token, receiver.host) != (token, host):
+        raise ValueError(f"SMS receiver on port {port} already runs with another token or host")
+    return receiver
@@ -1,5 +1,18 @@
+import atexit
+import json
+import logging
 import os
+import queue
+import subprocess
+import threading
+import time
+from datetime import datetime as dt
 from shutil import which
+from typing import Dict, List, Optional
+from urllib.request import Request, urlopen
+
+COALESCE = 30  # seconds during which a repeated informational phrase is dropped
+FLUSH_TIMEOUT = 5  # seconds given to pending notifications at exit
 
 
 class eSpeakSpeaker:
@@ -34,3 +47,126 @@ def new_speaker():
         if cls.is_applicable():
             return cls()
     raise ValueError("Please download wsay (Windows) or espeak (Linux). See README for more info")
+
+
+class logSpeaker:
+    """Fallback for headless servers: phrases only go to the log"""
+
+    def say(self, phrase):
+        logging.warning(f"[Speaker] {phrase}")
+
+
+class WebhookSink:
+    """POSTs {"message": phrase, "time": iso time} as JSON, e.g. to a chat bot or a local listener"""
+
+    def __init__(self, url: str, timeout: float = 10):
+        self.url = url
+        self.timeout = timeout
+
+    def say(self, phrase):
+        data = json.dumps({"message": phrase, "time": dt.now().isoformat()}).encode("utf-8")
+        request = Request(self.url, data=data, headers={"Content-Type": "application/json"})
+        with urlopen(request, timeout=self.timeout):
+            pass
+
+
+class FileSink:
+    def __init__(self, path: str):
+        self.path = path
+
+    def say(self, phrase):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(f"{dt.now().isoformat()} {phrase}\n")
+
+
+class DesktopSink:
+    """Desktop pop-up through notify-send (Linux) or osascript (macOS)"""
+
+    @classmethod
+    def is_applicable(cls):
+        return which("notify-send") is not None or which("osascript") is not None
+
+    def say(self, phrase):
+        if which("notify-send"):
+            subprocess.run(["notify-send", "Cita bot", phrase], timeout=10)
+        elif which("osascript"):
+            script = f'display notification {json.dumps(phrase)} with title "Cita bot"'
+            subprocess.run(["osascript", "-e", script], timeout=10)
+
+
+class Notifier:
+    """Queues phrases for a background thread that hands them to every sink, so a spoken alert
+    never blocks the browser. An informational phrase repeated within ``coalesce`` seconds is
+    dropped, prompts asking the user to act are always delivered."""
+
+    def __init__(self, sinks: Optional[list] = None, coalesce: float = COALESCE):
+        self.sinks: List = list(sinks) if sinks is not None else []
+        self.speech: Optional[list] = None if sinks is None else []  # found on first use
+        self.coalesce = coalesce
+        self.queue: queue.Queue = queue.Queue()
+        self.last_sent: Dict[str, float] = {}
+        self.dropped: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def add_sink(self, sink):
+        with self.lock:
+            if not any(type(s) is type(sink) and vars(s) == vars(sink) for s in self.sinks):
+                self.sinks.append(sink)
+
+    def say(self, phrase: str, repeat: int = 1, prompt: bool = False):
+        """Returns at once; speech sinks say the phrase ``repeat`` times, other sinks once.
+        A ``prompt`` needs the user to act, so it is never coalesced"""
+        now = time.monotonic()
+        with self.lock:
+            recent = now - self.last_sent.get(phrase, -self.coalesce) < self.coalesce
+            if recent and not prompt:
+                self.dropped[phrase] = self.dropped.get(phrase, 0) + 1
+                return
+            self.last_sent[phrase] = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="notifier", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+        self.queue.put((phrase, repeat))
+
+    def flush(self, timeout: float = FLUSH_TIMEOUT) -> bool:
+        """Waits for queued phrases to be delivered, True if everything went out in time"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self.queue.unfinished_tasks
+
+    def run(self):
+        while True:
+            phrase, repeat = self.queue.get()
+            try:
+                self.dispatch(phrase, repeat)
+            finally:
+                self.queue.task_done()
+
+    def dispatch(self, phrase: str, repeat: int):
+        if self.speech is None:
+            try:
+                self.speech = [new_speaker()]
+            except ValueError as e:
+                logging.warning(e)
+                self.speech = [logSpeaker()]
+
+        with self.lock:
+            dropped = self.dropped.pop(phrase, 0)
+            sinks = list(self.sinks)
+        if dropped:
+            logging.info(f"[Speaker] {phrase} repeated {dropped} more times")
+
+        for sink in self.speech:
+            for i in range(repeat):
+                self._deliver(sink, phrase)
+        for sink in sinks:
+            self._deliver(sink, phrase)
+
+    def _deliver(self, sink, phrase: str):
+        try:
+            sink.say(phrase)
+        except Exception as e:
+            logging.error(f"Notification sink {type(sink).__name__} failed: {e}")
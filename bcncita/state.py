@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+__all__ = ["StateStore", "load_cookies", "site_cookies", "state_store"]
+
+STATE_TTL = 30 * 60  # seconds a saved session is trusted, the site drops idle sessions anyway
+SAVE_INTERVAL = 60  # seconds between writes of an unchanged session
+COOKIE_KEYS = ("name", "value", "path", "domain", "secure", "httpOnly", "expiry")
+
+
+def state_key(context: Any) -> str:
+    return f"{context.province.value}/{context.operation_code.value}/{context.doc_value}"
+
+
+def same_site(domain: str, host: str) -> bool:
+    domain = domain.lstrip(".")
+    return host == domain or host.endswith("." + domain)
+
+
+def site_cookies(driver: Any, icp_url: str) -> List[dict]:
+    """The browser's cookies for the ICP site, in a form add_cookie takes back"""
+    host = urlparse(icp_url).hostname
+    if not host:
+        return []
+    return [
+        {k: c[k] for k in COOKIE_KEYS if k in c}
+        for c in driver.get_cookies()
+        if same_site(c.get("domain", host), host)
+    ]
+
+
+def load_cookies(driver: Any, icp_url: str, cookies: List[dict]):
+    if urlparse(driver.current_url).hostname != urlparse(icp_url).hostname:
+        driver.get(icp_url)  # cookies can only be set on the site's own pages
+    for cookie in cookies:
+        driver.add_cookie({k: v for k, v in cookie.items() if k != "domain"})
+
+
+class StateStore:
+    """Session state per profile kept in a JSON file across restarts: the site's cookies and the
+    reCAPTCHA site key and action. A restored session skips the slow first load of initial_page"""
+
+    def __init__(self, path: str, ttl: float = STATE_TTL, save_interval: float = SAVE_INTERVAL):
+        self.path = path
+        self.ttl = ttl
+        self.save_interval = save_interval
+        # key -> {"saved": epoch, "host": str, "cookies": [...], "site_key": str, "action": str}
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"State store {self.path}: {e}")
+            return
+        with self.lock:
+            self.entries = {k: v for k, v in entries.items() if isinstance(v, dict)}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error(f"State store {self.path}: {e}")
+
+    def entry(self, context: Any) -> Optional[Dict[str, Any]]:
+        """The saved state of a profile if it is fresh and was taken on the same site"""
+        with self.lock:
+            entry = self.entries.get(state_key(context))
+        if not entry or time.time() - entry.get("saved", 0) > self.ttl:
+            return None
+        if entry.get("host") != urlparse(context.icp_url).hostname:
+            return None
+        return entry
+
+    def cookies(self, context: Any) -> List[dict]:
+        entry = self.entry(context)
+        now = time.time()
+        return [c for c in entry["cookies"] if c.get("expiry", now + 1) > now] if entry else []
+
+    def restore_captcha(self, context: Any):
+        """Site key and action, so reCAPTCHA pre-solving starts before the form is seen"""
+        entry = self.entry(context)
+        if entry and entry.get("site_key") and not context.recaptcha_site_key:
+            context.recaptcha_site_key = entry["site_key"]
+            context.recaptcha_action = entry.get("action")
+
+    def restore(self, driver: Any, context: Any) -> bool:
+        """Loads the saved cookies into the browser, True if the first load can be skipped"""
+        cookies = self.cookies(context)
+        if not cookies:
+            return False
+        try:
+            load_cookies(driver, context.icp_url, cookies)
+        except Exception as e:
+            logging.error(f"State store: cannot restore session: {e}")
+            return False
+        logging.info(f"State store: session of {context.name} restored")
+        context.first_load = False
+        return True
+
+    def remember(self, driver: Any, context: Any):
+        """Saves the browser's session for the site, written at once if it changed"""
+        entry = {
+            "host": urlparse(context.icp_url).hostname,
+            "cookies": site_cookies(driver, context.icp_url),
+            "site_key": context.recaptcha_site_key,
+            "action": context.recaptcha_action,
+        }
+        key = state_key(context)
+        with self.lock:
+            old = self.entries.get(key, {})
+            changed = any(old.get(k) != v for k, v in entry.items())
+            if not changed and time.time() - old.get("saved", 0) < self.save_interval:
+                return
+            self.entries[key] = {**entry, "saved": time.time()}
+        self.save()
+
+    def forget(self, context: Any):
+        """Drops a session the site did not accept"""
+        with self.lock:
+            dropped = self.entries.pop(state_key(context), None)
+        if dropped:
+            self.save()
+
+
+_stores: Dict[str, StateStore] = {}
+_stores_lock = threading.Lock()
+
+
+def state_store(path: str) -> StateStore:
+    """One store per file, shared by the profiles and workers of a process"""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
@@ -0,0 +1,79 @@
+import json
+import logging
+from typing import Any, List
+from urllib.parse import urlparse
+
+from .metrics import blocked_requests, step_bytes, step_requests
+
+__all__ = ["TrafficMeter", "lean_patterns"]
+
+# Never read by the bot. The image captcha is a data: URI and reCAPTCHA lives on google.com and
+# gstatic.com, so neither is touched. Stylesheets stay: visibility checks depend on them.
+SITE_ASSETS = ("*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico", "*.webp", "*.bmp")
+ANY_ASSETS = ("*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot", "*.mp4", "*.webm", "*.mp3")
+TRACKERS = (
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*facebook.net*",
+    "*hotjar.com*",
+)
+
+
+def lean_patterns(icp_url: str) -> List[str]:
+    """URL patterns for Network.setBlockedURLs"""
+    host = urlparse(icp_url).hostname
+    return [f"*{host}/{pattern}" for pattern in SITE_ASSETS] + list(ANY_ASSETS + TRACKERS)
+
+
+def enable_lean(driver: Any, icp_url: str):
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": lean_patterns(icp_url)})
+
+
+class TrafficMeter:
+    """Requests and bytes of a browser per step, read from Chrome's performance log.
+
+    Each read drains the log, so what a step is charged with is everything since the previous
+    step: the page load that led to it and its refreshes."""
+
+    def __init__(self):
+        self.requests = 0
+        self.blocked = 0
+        self.bytes = 0
+
+    def collect(self, driver: Any, step: str):
+        try:
+            entries = driver.get_log("performance")
+        except Exception as e:
+            logging.debug(f"[Traffic] no performance log: {e}")
+            return
+
+        requests = blocked = size = 0
+        for entry in entries:
+            try:
+                message = json.loads(entry["message"])["message"]
+            except (KeyError, ValueError):
+                continue
+            method = message.get("method")
+            if method == "Network.requestWillBeSent":
+                requests += 1
+            elif method == "Network.loadingFinished":
+                size += int(message["params"].get("encodedDataLength", 0))
+            elif method == "Network.loadingFailed" and message["params"].get("blockedReason"):
+                blocked += 1
+
+        step_requests.inc(requests, step=step)
+        step_bytes.inc(size, step=step)
+        blocked_requests.inc(blocked, step=step)
+        self.requests += requests
+        self.blocked += blocked
+        self.bytes += size
+
+    def end_cycle(self, driver: Any):
+        self.collect(driver, "other")
+        logging.info(
+            f"[Traffic] {self.requests} requests ({self.blocked} blocked), "
+            f"{self.bytes / 1024:.0f} kB this cycle"
+        )
+        self.requests = self.blocked = self.bytes = 0
@@ -0,0 +1,118 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+try:
+    import psutil
+except ImportError:  # /proc is read directly on Linux
+    psutil = None
+
+__all__ = ["MemoryWatchdog", "Usage", "tree_usage"]
+
+
+@dataclass
+class Usage:
+    rss: int = 0  # bytes, summed over the process tree (shared pages count once per process)
+    fds: int = 0  # open file descriptors (handles on Windows)
+    processes: int = 0
+
+
+def children_map() -> Dict[int, List[int]]:
+    children: Dict[int, List[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue  # exited meanwhile
+        ppid = int(stat[stat.rindex(")") + 2 :].split()[1])  # comm may hold spaces and parens
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def process_tree(pid: int) -> List[int]:
+    children = children_map()
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+
+def proc_usage(pid: int) -> Usage:
+    usage = Usage(processes=1)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage.rss = int(line.split()[1]) * 1024
+                    break
+        usage.fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        pass  # exited, or fds of a process we may not read
+    return usage
+
+
+def tree_usage(pid: int) -> Optional[Usage]:
+    """Memory and handles of a process and all its descendants, None where they can't be read"""
+    total = Usage()
+    if psutil:
+        try:
+            root = psutil.Process(pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+        for process in processes:
+            try:
+                total.rss += process.memory_info().rss
+                total.fds += (
+                    process.num_fds() if hasattr(process, "num_fds") else process.num_handles()
+                )
+                total.processes += 1
+            except psutil.Error:
+                continue
+        return total
+
+    if not os.path.isdir(f"/proc/{pid}"):
+        return None
+    for member in process_tree(pid):
+        usage = proc_usage(member)
+        total.rss += usage.rss
+        total.fds += usage.fds
+        total.processes += usage.processes
+    return total
+
+
+def driver_pid(driver: Any) -> Optional[int]:
+    """chromedriver's pid: Chrome and its renderers are its descendants"""
+    process = getattr(getattr(driver, "service", None), "process", None)
+    return getattr(process, "pid", None)
+
+
+class MemoryWatchdog:
+    """Flags a browser whose process tree outgrew its limits, so it is recycled between cycles"""
+
+    def __init__(self, max_rss_mb: int = 0, max_fds: int = 0):
+        self.max_rss_mb = max_rss_mb
+        self.max_fds = max_fds
+
+    def usage(self, driver: Any) -> Optional[Usage]:
+        pid = driver_pid(driver)
+        return tree_usage(pid) if pid else None
+
+    def bloated(self, driver: Any) -> Optional[str]:
+        """Why the browser should be recycled, None while it is within limits"""
+        usage = self.usage(driver)
+        if usage is None:
+            return None
+        rss_mb = usage.rss / 2**20
+        logging.debug(f"[Watchdog] {rss_mb:.0f} MB, {usage.fds} fds, {usage.processes} processes")
+        if self.max_rss_mb and rss_mb > self.max_rss_mb:
+            return f"{rss_mb:.0f} MB over {self.max_rss_mb} MB"
+        if self.max_fds and usage.fds > self.max_fds:
+            return f"{usage.fds} open files over {self.max_fds}"
+        return None
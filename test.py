@@ -1,17 +1,64 @@
+import itertools
+import json
 import logging
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from base64 import b64decode
+from datetime import datetime
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import requests
+from selenium.common.exceptions import (
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
 
 from bcncita import (
     CustomerProfile,
     DocType,
+    HttpPoller,
     Office,
     OperationType,
     Province,
     init_wedriver,
+    metrics,
     start_with,
     try_cita,
 )
+from bcncita.bus import Sighting, SightingBus
+from bcncita.captcha import HedgedImageSolver, RecaptchaTokenPool
+from bcncita.cita import (
+    cluster_key,
+    cluster_turn,
+    office_candidates,
+    prepare_profile,
+    recycle_if_bloated,
+    settle,
+)
+from bcncita.cluster import Coordinator, RemoteCoordinator, serve
+from bcncita.daemon import Daemon
+from bcncita.orchestrator import Orchestrator
+from bcncita.page import PageState
+from bcncita.pool import DriverPool
+from bcncita.ratecontrol import EndpointUnavailable, RateController
+from bcncita.replay import replay_session
+from bcncita.schedule import AdaptiveScheduler, ReleaseModel, release_keys
+from bcncita.simulator import FakeImageBackend, Scenario, Simulator
+from bcncita.sms import SmsReceiver
+from bcncita.speaker import Notifier
+from bcncita.state import StateStore
+from bcncita.traffic import TrafficMeter, lean_patterns
+from bcncita.watchdog import MemoryWatchdog, tree_usage
 
 
 class TestBot(unittest.TestCase):
@@ -59,6 +106,967 @@ class TestBot(unittest.TestCase):
             )
 
 
+class TestSimulator(unittest.TestCase):
+    def customer(self, simulator: Simulator, **kwargs):
+        return CustomerProfile(
+            name="BORIS JOHNSON",
+            doc_type=DocType.PASSPORT,
+            doc_value="132435465",
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+            icp_url=simulator.url,
+            **kwargs,
+        )
+
+    def poller(self, context: CustomerProfile, **kwargs):
+        return HttpPoller(
+            context, rates=RateController(start_interval=0, min_interval=0), **kwargs
+        )
+
+    def test_http_poller_hit(self):
+        with Simulator(Scenario(captcha="image")) as simulator:
+            poller = self.poller(self.customer(simulator, offices=[Office.BARCELONA]))
+            with self.assertLogs(None, level=logging.INFO) as logs:
+                page = poller.cycle()
+
+        self.assertIsNotNone(page)
+        self.assertTrue(page.has("CitaMAP_HORAS"))
+        self.assertIn("INFO:root:[Step 4/6] Cita attempt -> selection hit!", logs.output)
+        self.assertEqual(simulator.requests["acVerFormulario"], 1)
+
+    def test_hand_off_replays_slots_request(self):
+        class Driver:
+            """Stands in for Chrome: cookies, navigation and the replayed form go over HTTP"""
+
+            def __init__(self):
+                self.cookies = {}
+                self.current_url = "data:,"
+                self.page_source = ""
+                self.posts = []
+
+            def load(self, resp):
+                self.current_url, self.page_source = resp.url, resp.text
+
+            def get(self, url):
+                self.load(requests.get(url, cookies=self.cookies, timeout=5))
+
+            def add_cookie(self, cookie):
+                self.cookies[cookie["name"]] = cookie["value"]
+
+            def find_element(self, by, value):
+                driver, source = self, self.page_source
+
+                class Element:
+                    def is_enabled(self):
+                        if driver.page_source is not source:
+                            raise StaleElementReferenceException()
+                        return True
+
+                return Element()
+
+            def execute_script(self, script, url, fields):
+                self.posts.append((url, dict(fields)))
+                self.load(requests.post(url, data=dict(fields), cookies=self.cookies, timeout=5))
+
+        with Simulator(Scenario(slot_outcomes=["grid", "list"])) as simulator:
+            driver = Driver()
+            poller = self.poller(self.customer(simulator), driver_factory=lambda context: driver)
+            page = poller.cycle()
+            pages = []
+            with mock.patch(
+                "bcncita.poller.cita_selection", lambda d, c: pages.append(d.page_source) or True
+            ):
+                self.assertTrue(poller.hand_off())
+
+        self.assertTrue(page.has("CitaMAP_HORAS"))
+        self.assertEqual(driver.cookies["JSESSIONID"], poller.session.cookies["JSESSIONID"])
+        ((url, fields),) = driver.posts
+        self.assertEqual((url, fields), poller._last_request[1:])
+        self.assertTrue(url.endswith("/acOfertarCita"))
+        self.assertIn("lCita_1", pages[0])  # the site answered the replayed contact form
+        self.assertEqual(simulator.requests["acOfertarCita"], 2)
+
+    @unittest.skipUnless(shutil.which("chromedriver"), "needs chromedriver")
+    def test_hand_off_books_slot(self):
+        with Simulator(Scenario(slot_outcomes=["grid", "grid"])) as simulator:
+            context = self.customer(
+                simulator,
+                chrome_driver_path=shutil.which("chromedriver"),
+                min_date="22/03/2023",
+                exit_on_success=False,
+                sms_webhook_token="unused",  # the simulator asks for no SMS code
+            )
+            poller = self.poller(context)
+            self.assertIsNotNone(poller.cycle())
+            try:
+                self.assertTrue(poller.hand_off())
+            finally:
+                if poller.driver:
+                    poller.driver.quit()
+
+        (session,) = [s for s in simulator.sessions.values() if "booked" in s]
+        self.assertEqual(session["slot"], "1011")  # the earliest slot on or after min_date
+        self.assertEqual(simulator.requests["citar"], 1)
+
+    def test_office_scan_keeps_preferred_office_with_slots(self):
+        with Simulator(Scenario(full_offices=["27"])) as simulator:
+            context = self.customer(
+                simulator,
+                offices=[Office.MATARO, Office.BADALONA, Office.BARCELONA],
+                office_scan=3,
+            )
+            poller = self.poller(context)
+            page = poller.cycle()
+
+        self.assertTrue(page.has("CitaMAP_HORAS"))
+        self.assertEqual(context.current_office, Office.BADALONA.value)
+        session = simulator.sessions[poller.session.cookies["JSESSIONID"]]
+        self.assertEqual(session["office"], Office.BADALONA.value)
+        self.assertEqual(simulator.requests["citar"], 3)
+        self.assertEqual(simulator.requests["acOfertarCita"], 3)
+
+    def test_http_poller_no_offices(self):
+        with Simulator(Scenario(outcomes=["no_offices"])) as simulator:
+            poller = self.poller(self.customer(simulator))
+            with self.assertLogs(None, level=logging.INFO) as logs:
+                page = poller.cycle()
+
+        self.assertIsNone(page)
+        self.assertIn("INFO:root:[Step 2/6] Office selection -> No offices", logs.output)
+        self.assertEqual(simulator.requests["acOfertarCita"], 0)
+
+    def test_personal_info_per_doc_type(self):
+        cases = [
+            (DocType.DNI, OperationType.CERTIFICADOS_NIE, {"rdbTipoDoc": "D.N.I."}),
+            (DocType.NIE, OperationType.CERTIFICADOS_NIE, {"rdbTipoDoc": "N.I.E."}),
+            (
+                DocType.PASSPORT,
+                OperationType.SOLICITUD_ASILO,
+                {"rdbTipoDoc": "PASAPORTE", "txtAnnoCitado": "1980", "txtPaisNac": "3"},
+            ),
+        ]
+        with Simulator(Scenario(outcomes=["no_offices"] * len(cases))) as simulator:
+            for doc_type, operation, expected in cases:
+                context = self.customer(simulator, operation_code=operation, year_of_birth="1980")
+                context.doc_type = doc_type
+                poller = self.poller(context)
+                poller.cycle()
+                person = simulator.sessions[poller.session.cookies["JSESSIONID"]]["person"]
+
+                # Year and country only where the operation asks for them, blanks are not posted
+                expected = {
+                    "txtIdCitado": "132435465",
+                    "txtDesCitado": "BORIS JOHNSON",
+                    **expected,
+                }
+                self.assertEqual(person, expected, doc_type)
+
+    def test_circuit_breaker(self):
+        with Simulator(Scenario(error_rate=1.0)) as simulator:
+            poller = self.poller(self.customer(simulator, wait_for_endpoint=False))
+            poller.rates.failure_threshold = 2
+            for i in range(3):
+                with self.assertRaises(EndpointUnavailable) as raised:
+                    poller.cycle()
+
+        self.assertGreater(raised.exception.retry_after, 25)
+        self.assertEqual(simulator.requests["citar"], 2)
+
+    def test_metrics(self):
+        no_offices = metrics.outcomes.value(outcome="no_offices")
+        loads = metrics.step_seconds.count(step="initial_page")
+        with Simulator(Scenario(outcomes=["no_offices"])) as simulator:
+            self.poller(self.customer(simulator)).cycle()
+
+        self.assertEqual(metrics.outcomes.value(outcome="no_offices"), no_offices + 1)
+        self.assertEqual(metrics.step_seconds.count(step="initial_page"), loads + 1)
+        text = metrics.registry.render()
+        self.assertIn("# TYPE cita_step_seconds histogram", text)
+        self.assertIn('cita_step_seconds_bucket{step="initial_page",le="+Inf"}', text)
+
+    def test_record_and_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "session.jsonl.gz")
+            with Simulator(Scenario(slot_outcomes=["grid", "list"])) as simulator:
+                context = self.customer(simulator, record_session=path, min_date="22/03/2023")
+                prepare_profile(context)
+                poller = self.poller(context)
+                poller.cycle()
+                poller.cycle()
+            context.recorder.close()
+            decisions = [d for d in replay_session(path, context) if d.kind]
+
+        self.assertEqual([d.kind for d in decisions], ["office", "grid", "office", "list"])
+        self.assertEqual(
+            [d.state for d in decisions],
+            [PageState.OFFICES, PageState.SLOT_GRID, PageState.OFFICES, PageState.SLOT_LIST],
+        )
+        self.assertEqual(decisions[1].choice, ("22/03/2023", "HUECO1011"))
+        self.assertEqual(decisions[3].choice, 2)
+
+    def test_hedged_image_captcha(self):
+        with Simulator(Scenario(captcha="image")) as simulator:
+            page = self.poller(self.customer(simulator)).cycle()
+            image = b64decode(page.elements["captcha-image"]["src"].split(",")[1])
+
+            slow = FakeImageBackend(simulator, "slow", delay=5)
+            fast = FakeImageBackend(simulator, "fast", delay=0.1)
+            solver = HedgedImageSolver([slow, fast], hedge=2)
+            answer = solver.solve(image)
+
+        self.assertEqual(answer.backend, fast)
+        self.assertIn(answer.text, simulator.captcha_answers.values())
+        solver.report_incorrect()
+        self.assertEqual(solver.stats["fast"].incorrect, 1)
+        self.assertEqual(fast.reported, [answer])
+
+        with mock.patch.object(fast, "solve", wraps=fast.solve) as solve:
+            HedgedImageSolver([fast]).solve(image)
+        self.assertEqual(solve.call_count, 1)  # hedging is opt-in, submissions cost money
+
+
+class TestRecaptchaTokenPool(unittest.TestCase):
+    class Solver:
+        def __init__(self, token, delay=0.0):
+            self.token = token
+            self.delay = delay
+            self.err_string = ""
+
+        def solve_and_return_solution(self):
+            time.sleep(self.delay)
+            if not self.token:
+                self.err_string = "ERROR_NO_SLOT_AVAILABLE"
+            return self.token
+
+    def pool(self, token, delay=0.0):
+        solvers = []
+
+        def new_solver(api_key, website_url, site_key, action):
+            solvers.append(self.Solver(token, delay))
+            return solvers[-1]
+
+        patcher = mock.patch("bcncita.captcha.new_recaptcha_solver", new_solver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pool = RecaptchaTokenPool("api-key", "https://example.org", size=1)
+        self.addCleanup(pool.stop)
+        return pool, solvers
+
+    def test_expired_tokens_are_skipped(self):
+        pool, _ = self.pool("unused")
+        now = time.monotonic()
+        pool.tokens[("site", "cita")].extend([(now - 1, "old", None), (now + 60, "fresh", None)])
+
+        self.assertEqual(pool.get("site", "cita"), ("fresh", None))
+        self.assertIsNone(pool.get("site", "cita"))
+
+    def test_get_waits_for_a_solve(self):
+        pool, solvers = self.pool("token", delay=0.2)
+        pool.register("site", "cita")
+        pool.start()
+
+        self.assertIsNone(pool.get("site", "cita"))  # nothing solved yet, no timeout
+        self.assertEqual(pool.get("site", "cita", timeout=5), ("token", solvers[0]))
+
+    def test_pauses_after_failure(self):
+        pool, solvers = self.pool(0)
+        pool.register("site", "cita")
+        with self.assertLogs(None, level=logging.ERROR) as logs:
+            pool.start()
+            self.assertIsNone(pool.get("site", "cita", timeout=1.5))
+
+        self.assertEqual(len(solvers), 1)  # the pool ticks every second, paused for 30
+        self.assertGreater(pool.paused_until[("site", "cita")], time.monotonic() + 25)
+        self.assertIn("ERROR:root:Anticaptcha: ERROR_NO_SLOT_AVAILABLE", logs.output)
+
+
+class TestSmsReceiver(unittest.TestCase):
+    def post(self, receiver, path, body, content_type):
+        request = Request(
+            f"{receiver.url}{path}", data=body.encode(), headers={"Content-Type": content_type}
+        )
+        with urlopen(request, timeout=5) as resp:
+            return resp.status
+
+    def test_receives_codes(self):
+        receiver = SmsReceiver("s3cret").start()
+        sms = "Su CODIGO 428571, DE CITA PREVIA"
+        try:
+            self.post(
+                receiver,
+                "/s3cret/600000000",
+                json.dumps({"sms": {"text": sms}}),
+                "application/json",
+            )
+            receiver.arm("600000000")
+            self.assertIsNone(receiver.wait("600000000", 0.1))  # came before arm: stale
+
+            form = urlencode({"from": "CITA", "body": sms})
+            timer = threading.Timer(
+                0.1, self.post, (receiver, "/s3cret/", form, "application/x-www-form-urlencoded")
+            )
+            timer.start()
+            self.assertEqual(receiver.wait("600000000", 5), "428571")
+            timer.join()
+
+            self.assertEqual(
+                self.post(receiver, "/s3cret/600000000", "no code here", "text/plain"), 202
+            )
+            self.assertEqual(self.post(receiver, "/s3cret/611111111", sms, "text/plain"), 200)
+            self.assertIsNone(receiver.wait("600000000", 0.1))
+            self.assertEqual(receiver.wait("611111111", 0), "428571")
+
+            for path in ("/600000000", "/wrong/600000000"):
+                with self.assertRaises(HTTPError) as raised:
+                    self.post(receiver, path, sms, "text/plain")
+                self.assertEqual(raised.exception.code, 404)
+            self.assertIsNone(receiver.wait("600000000", 0))
+        finally:
+            receiver.stop()
+
+
+class TestSlotMatcher(unittest.TestCase):
+    grid = {
+        "dates": ["LUNES 20/03/2023", "MARTES 21/03/2023", "MIÉRCOLES 22/03/2023"],
+        "rows": [
+            ["9:00", ["HUECO1", None, "HUECO3"]],
+            ["10:30", [None, "HUECO5", "HUECO6"]],
+            ["17:00", ["HUECO7", "HUECO8", None]],
+        ],
+    }
+
+    def customer(self, **kwargs):
+        return CustomerProfile(
+            name="BORIS JOHNSON",
+            doc_type=DocType.PASSPORT,
+            doc_value="132435465",
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+            **kwargs,
+        )
+
+    def test_earliest_slot_without_constraints(self):
+        self.assertEqual(
+            self.customer().slot_matcher.best_slot(self.grid), ("LUNES 20/03/2023", "HUECO1")
+        )
+
+    def test_windows_and_weekdays(self):
+        customer = self.customer(
+            time_windows=[["08:00", "08:30"], ["10:00", "11:00"]],
+            date_windows=[["21/03/2023", None]],
+            weekdays=[2],
+        )
+        self.assertEqual(
+            customer.slot_matcher.best_slot(self.grid), ("MIÉRCOLES 22/03/2023", "HUECO6")
+        )
+
+    def test_legacy_limits(self):
+        customer = self.customer(min_date="21/03/2023", min_time="12:00")
+        self.assertEqual(
+            customer.slot_matcher.best_slot(self.grid), ("MARTES 21/03/2023", "HUECO8")
+        )
+        labels = ["CITA 1: Día 20/03/2023 a las 17:00", "CITA 2: Día 21/03/2023 a las 09:00"]
+        self.assertIsNone(customer.slot_matcher.best_label(labels))
+        self.assertEqual(self.customer(max_date="20/03/2023").slot_matcher.best_label(labels), 0)
+
+    def test_office_candidates(self):
+        offered = ["", "14", "16", "18", "27"]
+        customer = self.customer(
+            offices=[Office.BADALONA, Office.BARCELONA], except_offices=["27"]
+        )
+        candidates = office_candidates(offered, customer)
+        self.assertEqual(candidates[:2], ["18", "16"])
+        self.assertEqual(sorted(candidates[2:]), ["14"])
+
+    def test_office_exclusion_and_rank(self):
+        customer = self.customer(
+            offices=["27", Office.BARCELONA], except_offices=[Office.BADALONA, "14"]
+        )
+        matcher = customer.slot_matcher
+        self.assertFalse(matcher.accepts_office("18"))
+        self.assertFalse(matcher.accepts_office("14"))
+        self.assertIsNone(matcher.best_slot(self.grid, "18"))
+        self.assertEqual([matcher.office_score(o) for o in ("27", "16", "99")], [0, 1, 2])
+        self.assertEqual(
+            office_candidates(["", "16", "14", "18", "99", "27"], customer), ["27", "16", "99"]
+        )
+
+
+class TestScheduler(unittest.TestCase):
+    def test_learns_release_window(self):
+        context = CustomerProfile(
+            name="BORIS JOHNSON",
+            doc_type=DocType.PASSPORT,
+            doc_value="132435465",
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "releases.json")
+            model = ReleaseModel(path)
+            for day in range(20, 25):  # Monday 20/03/2023 to Friday
+                for hour, minute in itertools.product(range(7, 20), range(0, 60, 10)):
+                    when = datetime(2023, 3, day, hour, minute)
+                    for i in range(5):
+                        model.observe(release_keys(context), hour == 9 and i < 3, when)
+            model.save()
+            scheduler = AdaptiveScheduler(ReleaseModel(path))
+
+        self.assertEqual(scheduler.delay(context, datetime(2023, 3, 27, 9, 2)), 0)
+        self.assertEqual(scheduler.delay(context, datetime(2023, 3, 27, 8, 45)), 300)
+        self.assertEqual(scheduler.delay(context, datetime(2023, 3, 27, 15, 0)), 900)
+
+    def test_plain_office_id(self):
+        context = CustomerProfile(
+            name="BORIS JOHNSON",
+            doc_type=DocType.PASSPORT,
+            doc_value="132435465",
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+            offices=["27"],
+        )
+        model = ReleaseModel()
+        for i in range(10):
+            model.observe(release_keys(context, "27"), False)
+        scheduler = AdaptiveScheduler(model, min_attempts=10)
+        self.assertEqual(scheduler.key(context), release_keys(context, "27")[1])
+        self.assertEqual(scheduler.delay(context, datetime(2023, 3, 27, 9, 2)), 0)
+
+
+class TestNotifier(unittest.TestCase):
+    def test_background_and_coalesced(self):
+        class SlowSink:
+            said: list = []
+
+            def say(self, phrase):
+                time.sleep(0.2)
+                self.said.append(phrase)
+
+        notifier = Notifier([SlowSink()])
+        start = time.monotonic()
+        for i in range(5):
+            notifier.say("ALARM")
+        notifier.say("FAIL")
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertTrue(notifier.flush())
+        self.assertEqual(SlowSink.said, ["ALARM", "FAIL"])
+
+    def test_prompts_not_coalesced(self):
+        said = []
+
+        class Sink:
+            def say(self, phrase):
+                said.append(phrase)
+
+        notifier = Notifier([Sink()])
+        notifier.say("FAIL")
+        notifier.say("FAIL")
+        notifier.say("ENTER THE SHORT CODE FROM SMS", prompt=True)
+        notifier.say("ENTER THE SHORT CODE FROM SMS", prompt=True)
+        self.assertTrue(notifier.flush())
+        self.assertEqual(said, ["FAIL"] + ["ENTER THE SHORT CODE FROM SMS"] * 2)
+
+
+class TestSettle(unittest.TestCase):
+    class Driver:
+        def __init__(self, loads_after=None):
+            self.loads_after = loads_after  # readyState checks until "complete", None = never
+            self.checks = 0
+
+        def execute_script(self, script):
+            self.checks += 1
+            done = self.loads_after is not None and self.checks > self.loads_after
+            return "complete" if done else "loading"
+
+    def customer(self, **kwargs):
+        return CustomerProfile(
+            name="BORIS JOHNSON",
+            doc_type=DocType.PASSPORT,
+            doc_value="132435465",
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+            **kwargs,
+        )
+
+    def test_fixed_sleep(self):
+        driver = self.Driver()
+        with mock.patch("bcncita.cita.time.sleep") as sleep:
+            self.assertTrue(settle(driver, self.customer(), 5))
+        sleep.assert_called_once_with(5)
+        self.assertEqual(driver.checks, 0)
+
+    def test_condition_met(self):
+        driver = self.Driver(loads_after=2)
+        start = time.monotonic()
+        self.assertTrue(settle(driver, self.customer(readiness_waits=True), 5))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(driver.checks, 3)
+
+    def test_step_budget(self):
+        context = self.customer(readiness_waits=True, step_budget=0.3)
+        start = time.monotonic()
+        with self.assertLogs(None, level=logging.INFO) as logs:
+            self.assertFalse(settle(self.Driver(), context, 5))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIn("INFO:root:Page not ready within 0.3s budget, going on", logs.output)
+
+
+class TestStateStore(unittest.TestCase):
+    class Driver:
+        current_url = "https://icp.administracionelectronica.gob.es/icpplus/index.html"
+
+        def __init__(self, cookies=()):
+            self.cookies = list(cookies)
+
+        def get_cookies(self):
+            return self.cookies
+
+        def add_cookie(self, cookie):
+            self.cookies.append(cookie)
+
+    def customer(self):
+        return CustomerProfile(
+            name="BORIS JOHNSON",
+            doc_type=DocType.PASSPORT,
+            doc_value="132435465",
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+        )
+
+    def test_restores_fresh_session(self):
+        context = self.customer()
+        context.recaptcha_site_key, context.recaptcha_action = "site-key", "action"
+        cookies = [
+            {
+                "name": "JSESSIONID",
+                "value": "1",
+                "path": "/",
+                "domain": "icp.administracionelectronica.gob.es",
+            },
+            {"name": "TS01", "value": "2", "domain": ".gob.es", "expiry": int(time.time()) + 600},
+            {"name": "old", "value": "3", "domain": ".gob.es", "expiry": int(time.time()) - 1},
+            {"name": "ads", "value": "4", "domain": ".example.com"},
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            StateStore(path).remember(self.Driver(cookies), context)
+
+            restarted = self.customer()
+            driver = self.Driver()
+            store = StateStore(path)
+            store.restore_captcha(restarted)
+            self.assertTrue(store.restore(driver, restarted))
+            self.assertEqual([c["name"] for c in driver.cookies], ["JSESSIONID", "TS01"])
+            self.assertFalse(restarted.first_load)
+            self.assertEqual(restarted.recaptcha_site_key, "site-key")
+
+            store.forget(restarted)
+            self.assertFalse(StateStore(path).restore(self.Driver(), restarted))
+            self.assertFalse(StateStore(path, ttl=-1).restore(self.Driver(), context))
+
+
+class TestTraffic(unittest.TestCase):
+    def test_counts_per_step(self):
+        def entry(method, **params):
+            return {"message": json.dumps({"message": {"method": method, "params": params}})}
+
+        class Driver:
+            log = [
+                entry("Network.requestWillBeSent"),
+                entry("Network.loadingFinished", encodedDataLength=2048),
+                entry("Network.requestWillBeSent"),
+                entry("Network.loadingFailed", blockedReason="inspector"),
+            ]
+
+            def get_log(self, kind):
+                log, self.log = self.log, []
+                return log
+
+        blocked = metrics.blocked_requests.value(step="initial_page")
+        size = metrics.step_bytes.value(step="initial_page")
+        meter = TrafficMeter()
+        meter.collect(Driver(), "initial_page")
+
+        self.assertEqual((meter.requests, meter.blocked, meter.bytes), (2, 1, 2048))
+        self.assertEqual(metrics.blocked_requests.value(step="initial_page"), blocked + 1)
+        self.assertEqual(metrics.step_bytes.value(step="initial_page"), size + 2048)
+        patterns = lean_patterns("https://icp.administracionelectronica.gob.es")
+        self.assertIn("*icp.administracionelectronica.gob.es/*.png", patterns)
+        self.assertFalse([p for p in patterns if "google.com" in p or "gstatic" in p])
+
+
+class TestSightingBus(unittest.TestCase):
+    def test_wakes_same_procedure_only(self):
+        bus = SightingBus()
+        woken = {}
+
+        def sleeper(key):
+            start = time.monotonic()
+            woken[key] = (bus.sleep(key, 0.5), time.monotonic() - start)
+
+        threads = [
+            threading.Thread(target=sleeper, args=(key,)) for key in (("8", "4010"), ("8", "4036"))
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        bus.publish(Sighting("8", "4010", "16"))
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(woken[("8", "4010")][0])
+        self.assertLess(woken[("8", "4010")][1], 0.3)
+        self.assertEqual(woken[("8", "4036")][0], False)
+        self.assertEqual(bus.recent(("8", "4010"), 60).office, "16")
+        self.assertIsNone(bus.recent(("8", "4036"), 60))
+
+
+class TestCluster(unittest.TestCase):
+    def test_leases(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cluster.db")
+            a, b, c = (Coordinator(path, node=node) for node in "abc")
+            server = serve(path, 0, "secret")
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            remote = RemoteCoordinator(url, "secret", node="r")
+            with self.assertRaises(HTTPError):
+                RemoteCoordinator(url, "guess", node="r").claim_worker("boris", 2)
+
+            self.assertTrue(a.claim_worker("boris", 2))
+            self.assertTrue(a.claim_worker("boris", 2))  # renewal, not a second lease
+            self.assertTrue(b.claim_worker("boris", 2))
+            self.assertFalse(c.claim_worker("boris", 2))
+            self.assertFalse(remote.claim_worker("boris", 2))
+            b.release_worker("boris")
+            self.assertTrue(remote.claim_worker("boris", 2))
+
+            self.assertTrue(a.acquire_booking("boris"))
+            self.assertFalse(remote.acquire_booking("boris"))
+            a.finish_booking("boris", False)
+            self.assertTrue(remote.acquire_booking("boris"))
+            remote.finish_booking("boris", True)
+            self.assertTrue(a.is_booked("boris"))
+            self.assertFalse(a.acquire_booking("boris"))
+            self.assertFalse(a.claim_worker("boris", 2))
+
+            self.assertIsNone(remote.last_sighting("8/4010"))
+            remote.sight("8/4010", "16")
+            self.assertAlmostEqual(a.last_sighting("8/4010"), time.time(), delta=5)
+
+            context = CustomerProfile(
+                name="BORIS JOHNSON",
+                doc_type=DocType.PASSPORT,
+                doc_value="132435465",
+                phone="600000000",
+                email="ghtvgdr@affecting.org",
+            )
+            context.coordinator = remote
+            self.assertTrue(cluster_turn(context))
+            leased = [row[0] for row in a.db.execute("SELECT profile FROM workers")]
+            self.assertIn(cluster_key(context), leased)
+            self.assertFalse([key for key in leased if "132435465" in key])
+            server.shutdown()
+            server.server_close()
+            for coordinator in (a, b, c):
+                coordinator.close()
+
+
+class TestWatchdog(unittest.TestCase):
+    def test_recycles_bloated_browser(self):
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+        try:
+            usage = tree_usage(os.getpid())
+            self.assertGreaterEqual(usage.processes, 2)
+            self.assertGreater(usage.rss, 2**20)
+            self.assertGreater(usage.fds, 0)
+
+            class Driver(TestStateStore.Driver):
+                service = type("Service", (), {"process": child})
+                quit_calls = 0
+
+                def quit(self):
+                    Driver.quit_calls += 1
+
+            cookies = [
+                {
+                    "name": "JSESSIONID",
+                    "value": "1",
+                    "domain": "icp.administracionelectronica.gob.es",
+                }
+            ]
+            context = CustomerProfile(
+                name="BORIS JOHNSON",
+                doc_type=DocType.PASSPORT,
+                doc_value="132435465",
+                phone="600000000",
+                email="ghtvgdr@affecting.org",
+            )
+            context.watchdog = MemoryWatchdog(max_rss_mb=10**6)
+            driver = Driver(cookies)
+            self.assertIs(recycle_if_bloated(driver, context), driver)
+
+            context.watchdog = MemoryWatchdog(max_rss_mb=1)
+            fresh = recycle_if_bloated(driver, context, launch=lambda context: Driver())
+            self.assertIsNot(fresh, driver)
+            self.assertEqual(Driver.quit_calls, 1)
+            self.assertEqual([c["name"] for c in fresh.cookies], ["JSESSIONID"])
+            self.assertFalse(context.first_load)
+        finally:
+            child.kill()
+            child.wait()
+
+
+class TestDriverPool(unittest.TestCase):
+    class Driver:
+        def __init__(self, context, slow=False):
+            self.context = context
+            self.slow = slow
+            self.window_handles = ["main"]
+            self.quit_calls = 0
+
+        def delete_all_cookies(self):
+            pass
+
+        def set_page_load_timeout(self, seconds):
+            pass
+
+        def get(self, url):
+            if self.slow:
+                raise TimeoutException("warm-up too slow")
+
+        def execute_script(self, script):
+            return "complete"
+
+        def quit(self):
+            self.quit_calls += 1
+
+    def customer(self, **kwargs):
+        return CustomerProfile(
+            name="BORIS JOHNSON",
+            doc_type=DocType.PASSPORT,
+            doc_value="132435465",
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+            **kwargs,
+        )
+
+    def test_relaunches_failed_browser(self):
+        launches = []
+
+        def factory(context):
+            launches.append(context)
+            if len(launches) < 3:
+                raise WebDriverException("chromedriver crashed")
+            return self.Driver(context, slow=True)
+
+        context = self.customer()
+        with self.assertLogs(None, level=logging.ERROR):
+            pool = DriverPool(context, size=1, driver_factory=factory, launch_retry=0.05).start()
+            driver = pool.acquire(context, timeout=5)
+        pool.close()
+
+        self.assertEqual(len(launches), 3)
+        self.assertIs(driver.context, context)
+        self.assertTrue(context.first_load)  # warm-up failed: the browser is kept, but cold
+
+    def test_recycles_and_follows_profile_options(self):
+        alice = self.customer(chrome_profile_path="/tmp/alice")
+        bob = self.customer(chrome_profile_path="/tmp/bob")
+        pool = DriverPool([alice, bob], size=2, driver_factory=self.Driver, max_uses=1).start()
+
+        driver = pool.acquire(alice, timeout=5)
+        self.assertIs(driver.context, alice)
+        self.assertFalse(alice.first_load)
+        self.assertIs(pool.check(driver, alice), driver)
+        fresh = pool.check(driver, alice)
+        self.assertIsNot(fresh, driver)
+        self.assertEqual(driver.quit_calls, 1)
+        self.assertIs(fresh.context, alice)
+
+        other = pool.check(fresh, bob)  # alice's browser can't serve bob's user data directory
+        self.assertIs(other.context, bob)
+        pool.release(other)
+        pool.close()
+        self.assertEqual(other.quit_calls, 1)
+
+    def test_released_browser_is_cold(self):
+        context = self.customer()
+        pool = DriverPool(context, size=1, driver_factory=self.Driver).start()
+        driver = pool.acquire(context, timeout=5)
+        self.assertFalse(context.first_load)
+
+        pool.release(driver)  # its cookies are wiped
+        self.assertIs(pool.acquire(context, timeout=5), driver)
+        self.assertTrue(context.first_load)
+        pool.close()
+
+    def test_acquire_times_out(self):
+        def factory(context):
+            raise WebDriverException("no chrome")
+
+        context = self.customer()
+        with self.assertLogs(None, level=logging.ERROR):
+            pool = DriverPool(context, size=1, driver_factory=factory, launch_retry=0.05).start()
+            with self.assertRaises(TimeoutError):
+                pool.acquire(context, timeout=0.2)
+        pool.close()
+
+
+class TestOrchestrator(unittest.TestCase):
+    Driver = TestDriverPool.Driver
+
+    def customer(self, name):
+        return CustomerProfile(
+            name=name,
+            doc_type=DocType.PASSPORT,
+            doc_value=name,
+            phone="600000000",
+            email="ghtvgdr@affecting.org",
+        )
+
+    def run_orchestrator(self, profiles, booked=(), **kwargs):
+        attempts = []
+
+        def attempt_cita(driver, context, *urls):
+            attempts.append(context.name)
+            return context.name in booked or None
+
+        with mock.patch("bcncita.orchestrator.attempt_cita", attempt_cita):
+            orchestrator = Orchestrator(profiles, **kwargs)
+            orchestrator.run()
+        return orchestrator, attempts
+
+    def test_round_robin_and_retire(self):
+        profiles = [self.customer(name) for name in ("ALICE", "BOB", "CAROL")]
+        orchestrator, attempts = self.run_orchestrator(
+            profiles, booked=("BOB",), drivers=1, cycles=3, driver_factory=self.Driver
+        )
+
+        self.assertEqual(attempts, ["ALICE", "BOB", "CAROL", "ALICE", "CAROL", "ALICE", "CAROL"])
+        self.assertEqual(orchestrator.booked, [profiles[1]])
+        self.assertEqual(orchestrator.attempts_per_minute(), 7)
+        orchestrator._timestamps.appendleft(time.monotonic() - 61)
+        self.assertEqual(orchestrator.attempts_per_minute(), 7)
+
+    def test_browser_failure_requeues(self):
+        launches = []
+
+        def factory(context):
+            launches.append(context)
+            if len(launches) == 1:
+                raise WebDriverException("chromedriver crashed")
+            return self.Driver(context)
+
+        profile = self.customer("ALICE")
+        with self.assertLogs(None, level=logging.ERROR):
+            orchestrator, attempts = self.run_orchestrator(
+                [profile], drivers=1, cycles=2, driver_factory=factory, driver_retry=0
+            )
+
+        self.assertEqual(len(launches), 2)
+        self.assertEqual(attempts, ["ALICE", "ALICE"])
+        self.assertEqual((orchestrator.in_flight, orchestrator.attempts[id(profile)]), (0, 2))
+
+    def test_first_load_follows_pool(self):
+        profiles = [self.customer(name) for name in ("ALICE", "BOB")]
+        pool = DriverPool(profiles, size=1, driver_factory=self.Driver, max_uses=1).start()
+        first_loads = []
+
+        def attempt_cita(driver, context, *urls):
+            first_loads.append((context.name, context.first_load))
+
+        with mock.patch("bcncita.orchestrator.attempt_cita", attempt_cita):
+            Orchestrator(profiles, drivers=1, cycles=2, pool=pool).run()
+        pool.close()
+
+        # A warm browser from the pool skips the first load, one wiped for another profile doesn't
+        self.assertEqual(
+            first_loads, [("ALICE", False), ("BOB", True), ("ALICE", False), ("BOB", True)]
+        )
+
+
+class TestDaemon(unittest.TestCase):
+    def test_reload(self):
+        boris = {
+            "id": "boris",
+            "name": "BORIS JOHNSON",
+            "doc_type": "PASSPORT",
+            "doc_value": "132435465",
+            "phone": "600000000",
+            "email": "ghtvgdr@affecting.org",
+        }
+        config = {"defaults": {"province": "BARCELONA"}, "profiles": [boris]}
+        orchestrator = Orchestrator([], keep_alive=True)
+        daemon = Daemon("profiles.json", orchestrator=orchestrator)
+
+        daemon.apply(config)
+        profile = daemon.profiles["boris"]
+        self.assertEqual(profile.province, Province.BARCELONA)
+        self.assertEqual(list(orchestrator.queue), [profile])
+
+        boris.update(offices=["BADALONA"], min_date="21/03/2023")
+        daemon.apply(config)
+        self.assertIs(daemon.profiles["boris"], profile)
+        self.assertEqual(profile.offices, [Office.BADALONA])
+
+        boris.update(offices=["BADALONA", "27", 99])
+        daemon.apply(config)
+        self.assertIs(daemon.profiles["boris"], profile)
+        self.assertEqual(profile.offices, [Office.BADALONA, "27", "99"])
+        boris.update(offices=["BADALONA"])
+        daemon.apply(config)
+        self.assertEqual(
+            profile.slot_matcher.best_label(["CITA 1: Día 20/03/2023 a las 17:00"]), None
+        )
+
+        boris.update(doc_type="NIE", doc_value="X1234567L", offices="bad")
+        with self.assertLogs(None, level=logging.ERROR):
+            daemon.apply(config)
+        self.assertIs(daemon.profiles["boris"], profile)
+
+        del boris["offices"]
+        daemon.apply(config)
+        self.assertIsNot(daemon.profiles["boris"], profile)
+        self.assertEqual(list(orchestrator.queue), [daemon.profiles["boris"]])
+
+        profile = daemon.profiles["boris"]
+        boris.update(state_file="state.json")
+        daemon.apply(config)
+        self.assertIsNot(daemon.profiles["boris"], profile)
+        self.assertEqual(daemon.profiles["boris"].state_file, "state.json")
+        self.assertEqual(list(orchestrator.queue), [daemon.profiles["boris"]])
+
+        config["profiles"] = []
+        daemon.apply(config)
+        self.assertEqual(list(orchestrator.queue), [])
+
+
+class TestImport(unittest.TestCase):
+    IMPORT_BUDGET = 0.1  # seconds for a bare `import bcncita`
+
+    def test_import_is_cheap(self):
+        code = (
+            "import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import bcncita\n"
+            "elapsed = time.perf_counter() - start\n"
+            "assert not {'selenium', 'requests'} & set(sys.modules), 'heavy import'\n"
+            "from bcncita import CustomerProfile\n"
+            "assert not {'anticaptchaofficial', 'requests'} & set(sys.modules), 'heavy import'\n"
+            "from bcncita.cita import speaker\n"
+            "speaker.say('test')\n"
+            "print(elapsed)\n"
+        )
+        # No espeak, say or wsay on this PATH
+        env = dict(os.environ, PATH=os.path.dirname(sys.executable))
+        result = subprocess.run(
+            [sys.executable, "-c", code], env=env, capture_output=True, text=True, timeout=60
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertLess(float(result.stdout), self.IMPORT_BUDGET)
+
+
 if __name__ == "__main__":
     if not os.environ.get("CITA_TEST"):
         os._exit(0)